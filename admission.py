@@ -0,0 +1,150 @@
+"""
+Admission control for the TTC Delay Prediction API
+Model-backed and routing endpoints run under a concurrency limit per endpoint
+class. A request that cannot start within the queue-time budget is shed with a
+503 and Retry-After rather than joining a backlog that makes every request slow;
+cheap cached reads are not queued at all
+"""
+
+import asyncio
+import json
+import re
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Pattern, Tuple
+from metrics import REGISTRY, Histogram, observe_request_stage
+
+ADMISSION_WAIT_SECONDS = REGISTRY.register(Histogram(
+    "ttc_admission_wait_seconds", "Time requests spent queued for admission by endpoint class and outcome",
+    labelnames=("class", "outcome")))
+
+
+class AdmissionClass:
+    """Concurrency limit and first-come, first-served wait queue for one class of endpoints"""
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self.admitted = 0
+        self.queued = 0
+        self.shed_queue_full = 0
+        self.shed_timeout = 0
+
+    async def acquire(self) -> bool:
+        """Wait for a slot; False when the request should be shed instead"""
+        if self.active < self.max_concurrency and not self._waiters:
+            self.active += 1
+            self.admitted += 1
+            return True
+        if len(self._waiters) >= self.max_queue or self.queue_timeout <= 0:
+            self.shed_queue_full += 1
+            return False
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        self.queued += 1
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            # The slot may have been handed over just as the budget ran out
+            if not (future.done() and not future.cancelled()):
+                self.shed_timeout += 1
+                ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - start, self.name, "shed")
+                return False
+        except asyncio.CancelledError:
+            # The client went away; pass on a slot that was already handed to it
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        finally:
+            if future in self._waiters:
+                self._waiters.remove(future)
+        self.admitted += 1
+        ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - start, self.name, "admitted")
+        return True
+
+    def release(self):
+        """Hand the slot to the longest-waiting request, or free it"""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self) -> Dict[str, int]:
+        """Limits, current occupancy and counters"""
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "queue_depth": len(self._waiters),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "shed_queue_full": self.shed_queue_full,
+            "shed_timeout": self.shed_timeout
+        }
+
+
+def _path_pattern(template: str) -> Pattern:
+    """Regex for a route template such as /stations/{station}/heatmap"""
+    parts = re.split(r"\{[^}]+\}", template)
+    return re.compile("[^/]+".join(re.escape(part) for part in parts) + "$")
+
+
+class AdmissionMiddleware:
+    """Pure ASGI middleware admitting requests by endpoint class
+
+    routes maps route templates to their admission class; other paths pass
+    straight through. Shed requests get a 503 with a Retry-After of
+    retry_after seconds.
+    """
+
+    def __init__(self, app, routes: Dict[str, AdmissionClass], retry_after: int = 1, enabled: bool = True):
+        self.app = app
+        self.exact: Dict[str, AdmissionClass] = {}
+        self.patterns: List[Tuple[Pattern, AdmissionClass]] = []
+        for template, admission in routes.items():
+            if "{" in template:
+                self.patterns.append((_path_pattern(template), admission))
+            else:
+                self.exact[template] = admission
+        self.retry_after = retry_after
+        self.enabled = enabled
+
+    def classify(self, path: str) -> Optional[AdmissionClass]:
+        """Admission class for a request path, or None when it is not limited"""
+        admission = self.exact.get(path)
+        if admission is None:
+            for pattern, candidate in self.patterns:
+                if pattern.match(path):
+                    return candidate
+        return admission
+
+    async def __call__(self, scope, receive, send):
+        admission = self.classify(scope["path"]) if scope["type"] == "http" and self.enabled else None
+        if admission is None:
+            await self.app(scope, receive, send)
+            return
+
+        if not await admission.acquire():
+            body = json.dumps({"detail": f"Server busy ({admission.name} requests); retry shortly"}).encode("utf-8")
+            await send({
+                "type": "http.response.start",
+                "status": 503,
+                "headers": [(b"content-type", b"application/json"),
+                            (b"content-length", str(len(body)).encode()),
+                            (b"retry-after", str(self.retry_after).encode())]
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+        observe_request_stage("admission_wait")
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            admission.release()
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+Latency/throughput benchmark for the TTC Delay Prediction API
+Drives the app in-process over ASGI, through a local uvicorn server, or against
+any running instance, with a weighted mix of realistic and invalid requests
+
+    python benchmark.py --target asgi --concurrency 16 --duration 20
+    python benchmark.py --target uvicorn --output before.json
+    python benchmark.py --target http://127.0.0.1:8000 --compare before.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import socket
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+
+CODES = ["MUIS", "SEC", "SIG", "PAS", "TRA", "OPE", "MED", "INV"]
+TIME_PREFERENCES = ["any", "rush_hour", "off_peak"]
+
+# Rows per /predict/batch request in the mix
+BATCH_ROWS = 100
+
+
+class Scenario:
+    """One kind of request in the mix: builds (method, path, json body, headers) from a RNG
+
+    If etags is given, ETags from responses are stored in it by path so the
+    scenario can send conditional requests.
+    """
+
+    def __init__(self, name: str, weight: float, build: Callable[[random.Random], Tuple[str, str, Optional[object], Dict]],
+                 etags: Optional[Dict[str, str]] = None):
+        self.name = name
+        self.weight = weight
+        self.build = build
+        self.etags = etags
+
+
+async def prediction_pairs(client, details: Dict[str, Dict]) -> List[Tuple[str, str]]:
+    """(line, station) pairs the target's model can score, from /predict/options
+
+    Targets without that endpoint get every registry station paired with each
+    line stopping there.
+    """
+    response = await client.get("/predict/options")
+    if response.status_code == 200:
+        pairs = [(line, station) for line, names in response.json()["lines"].items() for station in names]
+    else:
+        pairs = [(line, station) for station, info in details.items() for line in info.get("lines", [info["line"]])]
+    if not pairs:
+        raise RuntimeError("The target offers no line and station pairs to predict")
+    return pairs
+
+
+def scenarios(stations: List[str], pairs: List[Tuple[str, str]]) -> List[Scenario]:
+    """Default request mix; unknown names exercise the 400 fallback paths
+
+    pairs are the (line, station) pairs predictions are drawn from.
+    """
+    def scenario(rng, station=None, day=None):
+        line, known = rng.choice(pairs)
+        return {
+            "Line": line,
+            "Station": station or known,
+            "Code": rng.choice(CODES),
+            "DayOfWeek": rng.randrange(7) if day is None else day
+        }
+
+    etags: Dict[str, str] = {}
+
+    def station_predictions(rng):
+        return "GET", f"/stations/predictions?day_of_week={rng.randrange(7)}&code={rng.choice(CODES)}", None, {}
+
+    def station_predictions_revalidate(rng):
+        path = f"/stations/predictions?day_of_week={rng.randrange(7)}&code=MUIS"
+        return "GET", path, None, {"If-None-Match": etags[path]} if path in etags else {}
+
+    def route(rng):
+        start, end = rng.sample(stations, 2)
+        return "POST", "/route/optimize", {
+            "start_station": start,
+            "end_station": end,
+            "day_of_week": rng.randrange(7),
+            "time_preference": rng.choice(TIME_PREFERENCES),
+            "mode": rng.choice(["k_shortest", "k_shortest", "pareto"]),
+            "max_routes": rng.randint(1, 3)
+        }, {}
+
+    mix = [
+        Scenario("predict", 40, lambda rng: ("POST", "/predict", scenario(rng), {})),
+        Scenario("predict_invalid_day", 10, lambda rng: ("POST", "/predict", scenario(rng, day=rng.randrange(7, 14)), {})),
+        Scenario("predict_unknown_station", 5, lambda rng: ("POST", "/predict", scenario(rng, station="NOT A STATION"), {})),
+        Scenario("predict_batch", 5, lambda rng: ("POST", "/predict/batch", [scenario(rng) for _ in range(BATCH_ROWS)], {})),
+        Scenario("stations_predictions", 10, station_predictions),
+        Scenario("stations_predictions_revalidate", 5, station_predictions_revalidate, etags),
+        Scenario("route_optimize", 20, route),
+        Scenario("route_unknown_station", 2, lambda rng: ("POST", "/route/optimize", {
+            "start_station": "NOT A STATION", "end_station": rng.choice(stations), "day_of_week": 0}, {})),
+        Scenario("index", 3, lambda rng: ("GET", "/", None, {}))
+    ]
+    return mix
+
+
+def summarize(latencies: List[float], statuses: Dict[int, int], seconds: float) -> Dict:
+    """Throughput, latency percentiles in milliseconds and status counts"""
+    if not latencies:
+        return {"requests": 0, "throughput_rps": 0.0, "status": statuses}
+    ms = np.array(latencies) * 1000.0
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {
+        "requests": len(ms),
+        "throughput_rps": len(ms) / seconds,
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+        "max_ms": float(ms.max()),
+        "status": {str(code): count for code, count in sorted(statuses.items())}
+    }
+
+
+async def run_load(client, mix: List[Scenario], concurrency: int, duration: float, seed: int) -> Dict:
+    """Closed-loop load: `concurrency` workers send requests back to back for `duration` seconds"""
+    weights = [scenario.weight for scenario in mix]
+    records: Dict[str, Tuple[List[float], Dict[int, int]]] = {scenario.name: ([], {}) for scenario in mix}
+    deadline = time.perf_counter() + duration
+
+    async def worker(index: int):
+        rng = random.Random(seed + index)
+        while time.perf_counter() < deadline:
+            scenario = rng.choices(mix, weights)[0]
+            method, path, body, headers = scenario.build(rng)
+            start = time.perf_counter()
+            response = await client.request(method, path, json=body, headers=headers)
+            elapsed = time.perf_counter() - start
+            latencies, statuses = records[scenario.name]
+            latencies.append(elapsed)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            if scenario.etags is not None and "etag" in response.headers:
+                scenario.etags[path] = response.headers["etag"]
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    seconds = time.perf_counter() - start
+
+    all_latencies = [latency for latencies, _ in records.values() for latency in latencies]
+    all_statuses: Dict[int, int] = {}
+    for _, statuses in records.values():
+        for code, count in statuses.items():
+            all_statuses[code] = all_statuses.get(code, 0) + count
+    return {
+        "seconds": seconds,
+        "overall": summarize(all_latencies, all_statuses, seconds),
+        "scenarios": {name: summarize(latencies, statuses, seconds) for name, (latencies, statuses) in records.items()}
+    }
+
+
+STAGE_SAMPLE = re.compile(r'^ttc_stage_seconds_(sum|count)\{stage="([^"]+)"\} (\S+)$')
+
+
+async def stage_totals(client) -> Dict[str, List[float]]:
+    """Server-side [seconds, count] per stage from /metrics, empty if the target does not export it"""
+    try:
+        response = await client.get("/metrics")
+    except Exception:
+        return {}
+    totals: Dict[str, List[float]] = {}
+    if response.status_code != 200:
+        return totals
+    for line in response.text.splitlines():
+        match = STAGE_SAMPLE.match(line)
+        if match:
+            kind, name, value = match.groups()
+            totals.setdefault(name, [0.0, 0.0])[kind == "count"] = float(value)
+    return totals
+
+
+def stage_breakdown(before: Dict[str, List[float]], after: Dict[str, List[float]], seconds: float) -> Dict:
+    """Per-stage calls, mean time and share of server time spent in the stage during a run"""
+    breakdown = {}
+    for name, (total, count) in after.items():
+        total -= before.get(name, [0.0, 0.0])[0]
+        count -= before.get(name, [0.0, 0.0])[1]
+        if count > 0:
+            breakdown[name] = {
+                "calls": int(count),
+                "mean_us": total / count * 1e6,
+                "seconds_per_second": total / seconds
+            }
+    return breakdown
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_until_ready(client, timeout: float = 120.0, server: Optional[subprocess.Popen] = None):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError(f"uvicorn exited with status {server.returncode} before the API became ready")
+        try:
+            if (await client.get("/ready")).status_code == 200:
+                return
+        except Exception:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("API did not become ready")
+
+
+async def benchmark(target: str, concurrency: int, duration: float, warmup: float, seed: int) -> Dict:
+    """Run the default mix against a target: 'asgi', 'uvicorn' or a base URL"""
+    import httpx
+
+    server = None
+    if target == "asgi":
+        import main
+        main.load_initial_model()
+        if main.registry.current is None:
+            # The API finds its artifacts relative to the working directory, as the uvicorn target's server does
+            raise RuntimeError(f"No model loaded from {os.getcwd()} ({main.registry.last_error}); run the asgi "
+                               "target from the directory holding the model artifacts, or train one first")
+        transport = httpx.ASGITransport(app=main.app)
+        base_url = "http://benchmark"
+    else:
+        transport = None
+        base_url = target
+        if target == "uvicorn":
+            port = free_port()
+            base_url = f"http://127.0.0.1:{port}"
+            server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port),
+                                       "--log-level", "warning"], cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url=base_url, limits=limits, timeout=60.0) as client:
+            await wait_until_ready(client, server=server)
+            stations = (await client.get("/stations")).json()
+            pairs = await prediction_pairs(client, stations["details"])
+            health = (await client.get("/health")).json()
+            mix = scenarios(stations["stations"], pairs)
+            if warmup > 0:
+                await run_load(client, mix, concurrency, warmup, seed - 1)
+            before = await stage_totals(client)
+            results = await run_load(client, mix, concurrency, duration, seed)
+            results["stages"] = stage_breakdown(before, await stage_totals(client), results["seconds"])
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    results["meta"] = {
+        "target": target,
+        "concurrency": concurrency,
+        "duration": duration,
+        "warmup": warmup,
+        "seed": seed,
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "model_version": health.get("model_version"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count()
+    }
+    return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_results(results: Dict, baseline: Optional[Dict] = None):
+    """Table of per-scenario results, with relative change against a baseline run if given"""
+    def change(new, old):
+        return f" ({(new - old) / old * 100:+5.1f}%)" if old else ""
+
+    rows = [("overall", results["overall"])] + sorted(results["scenarios"].items())
+    print(f"{'scenario':<33}{'requests':>9}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}  status")
+    for name, stats in rows:
+        if not stats["requests"]:
+            continue
+        old = (baseline["overall"] if name == "overall" else baseline["scenarios"].get(name)) if baseline else None
+        line = (f"{name:<33}{stats['requests']:>9}{stats['throughput_rps']:>10.1f}{stats['p50_ms']:>10.2f}"
+                f"{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}  {stats['status']}")
+        print(line)
+        if old and old.get("requests"):
+            print(f"{'  vs baseline':<33}{'':>9}{change(stats['throughput_rps'], old['throughput_rps']):>10}"
+                  f"{change(stats['p50_ms'], old['p50_ms']):>10}{change(stats['p95_ms'], old['p95_ms']):>10}"
+                  f"{change(stats['p99_ms'], old['p99_ms']):>10}")
+
+    if results.get("stages"):
+        old_stages = baseline.get("stages", {}) if baseline else {}
+        print(f"\n{'server stage':<33}{'calls':>9}{'mean us':>10}{'busy %':>10}")
+        for name, stats in sorted(results["stages"].items(), key=lambda item: -item[1]["seconds_per_second"]):
+            old = old_stages.get(name)
+            print(f"{name:<33}{stats['calls']:>9}{stats['mean_us']:>10.1f}{stats['seconds_per_second'] * 100:>10.1f}"
+                  f"{change(stats['mean_us'], old['mean_us']) if old else ''}")
+    else:
+        print("\nNo per-stage breakdown: the target exports no ttc_stage_seconds histograms on /metrics "
+              "(it may be an older version, or running with TTC_METRICS=0)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the TTC Delay Prediction API")
+    parser.add_argument("--target", default="asgi",
+                        help="'asgi' (in-process), 'uvicorn' (local server subprocess) or a base URL (default: asgi)")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients (default: 8)")
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds (default: 10)")
+    parser.add_argument("--warmup", type=float, default=2.0, help="unmeasured seconds before the run (default: 2)")
+    parser.add_argument("--seed", type=int, default=42, help="seed for the request mix (default: 42)")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON results file (default: benchmark_results.json)")
+    parser.add_argument("--compare", metavar="JSON", help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    try:
+        results = asyncio.run(benchmark(args.target, args.concurrency, args.duration, args.warmup, args.seed))
+    except RuntimeError as e:
+        sys.exit(f"Error: {e}")
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.output}")
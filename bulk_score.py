@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""
+Offline bulk scoring for the TTC Delay Prediction model
+Streams a CSV or JSONL file of (Line, Station, Code, DayOfWeek) scenarios in
+fixed-size chunks of lines, scores the chunks across a pool of worker processes
+with the same model version the API would serve, and appends the results in
+input order. The workers answer from the version's probability table, which the
+parent writes once and every worker memory-maps. A checkpoint after every chunk
+lets an interrupted run resume.
+
+    python bulk_score.py scenarios.csv scored.csv
+    python bulk_score.py scenarios.jsonl scored.jsonl --workers 8 --resume
+"""
+
+import argparse
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional, Tuple
+import numpy as np
+from category_encoding import CategoryEncoder, CATEGORICAL_COLUMNS, UNKNOWN
+from model_registry import ModelBundle, ModelRegistry
+from probability_table import DAYS_OF_WEEK, ProbabilityTable
+
+# Artifact names shared with main.py and train_model.py
+MODEL_PATH = "random_forest_model_new_task.pkl"
+ENCODERS_PATH = "label_encoders_new_task.pkl"
+
+FORMATS = ("csv", "jsonl")
+
+# Input lines per chunk; a chunk is the unit of work, of checkpointing and of progress reports
+CHUNK_ROWS = 200_000
+
+# Chunks queued per worker; bounds memory to a few chunks per worker however large the input
+CHUNKS_PER_WORKER = 2
+
+# Imported once in the forkserver, so workers forked from it start with pandas and NumPy loaded
+WORKER_PRELOAD = ["bulk_score"]
+
+# (encoder, score_encoded_batch-like function) used by score_chunk; set by _init_worker in worker
+# processes, or to the loaded bundle's own for in-process scoring
+_worker_scoring: Optional[Tuple[CategoryEncoder, Callable]] = None
+
+
+def _init_worker(table_dir: str, encoder: CategoryEncoder):
+    global _worker_scoring
+    _worker_scoring = (encoder, table_scorer(ProbabilityTable.load(table_dir, encoder, mmap_mode="r")))
+
+
+def table_scorer(table: ProbabilityTable) -> Callable:
+    """ModelBundle.score_encoded_batch() answered from a probability table alone, for rows it covers"""
+    def score(lines: np.ndarray, stations: np.ndarray, codes: np.ndarray, days: np.ndarray,
+              valid: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        predictions = np.zeros(len(days), dtype=np.int64)
+        probabilities = np.zeros(len(days), dtype=np.float64)
+        rows = np.flatnonzero(valid)
+        _, predictions[rows], probabilities[rows] = table.lookup_batch(lines[rows], stations[rows], codes[rows], days[rows])
+        return predictions, probabilities
+    return score
+
+
+def file_format(path: str, given: Optional[str]) -> str:
+    """Format named on the command line, else the one implied by the file extension"""
+    if given:
+        return given
+    return "jsonl" if os.path.splitext(path)[1].lower() in (".jsonl", ".ndjson", ".json") else "csv"
+
+
+def parse_chunk(data: bytes, header: bytes, input_format: str):
+    """DataFrame of one chunk of input lines, plus a per-row error for lines that could not be parsed
+
+    CSV values are kept as text so they are written back exactly as read.
+    """
+    import pandas as pd
+    if input_format == "csv":
+        frame = pd.read_csv(io.BytesIO(header + data), dtype=str, keep_default_na=False)
+        return frame, [None] * len(frame)
+
+    records, errors = [], []
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            error = None if isinstance(record, dict) else "Each line must be a JSON object"
+        except ValueError:
+            record, error = None, "Invalid JSON"
+        records.append(record if error is None else {})
+        errors.append(error)
+    return pd.DataFrame.from_records(records), errors
+
+
+def score_frame(encoder: CategoryEncoder, score: Callable, frame, errors) -> None:
+    """Add prediction, probability and error columns to a parsed chunk, in place
+
+    score takes encoded columns and a validity mask, like ModelBundle.score_encoded_batch().
+    """
+    import pandas as pd
+    n = len(frame)
+    valid = np.array([error is None for error in errors], dtype=bool)
+
+    # Factorize each column so only its distinct values go through the encoder
+    encoded = {}
+    for column in CATEGORICAL_COLUMNS:
+        values = frame[column] if column in frame else pd.Series([None] * n, index=frame.index, dtype=object)
+        codes, uniques = pd.factorize(values)
+        ids = encoder.encode_many(column, uniques.astype(str))
+        # factorize marks missing values with -1, which indexes the UNKNOWN appended here
+        encoded[column] = np.append(ids, UNKNOWN)[codes]
+        missing = codes == -1
+        for i in np.flatnonzero(valid & missing):
+            errors[i] = f"Missing {column}"
+        for i in np.flatnonzero(valid & ~missing & (encoded[column] == UNKNOWN)):
+            errors[i] = f"Unknown {column}: {values.iat[i]!r}"
+        valid &= encoded[column] != UNKNOWN
+
+    days = pd.to_numeric(frame['DayOfWeek'], errors='coerce') if 'DayOfWeek' in frame else pd.Series(np.nan, index=frame.index)
+    days = days.to_numpy(dtype=np.float64, na_value=np.nan)
+    integral = np.isfinite(days) & (days == np.round(days))
+    for i in np.flatnonzero(valid & ~integral):
+        errors[i] = "DayOfWeek must be an integer"
+    valid &= integral
+    in_range = integral & (days >= 0) & (days < DAYS_OF_WEEK)
+    for i in np.flatnonzero(valid & ~in_range):
+        errors[i] = f"DayOfWeek must be between 0 and {DAYS_OF_WEEK - 1}: {int(days[i])}"
+    valid &= in_range
+
+    predictions, probabilities = score(
+        encoded['Line'], encoded['Station'], encoded['Code'], np.where(valid, days, 0).astype(np.int64), valid)
+    frame['prediction'] = pd.arrays.IntegerArray(predictions, ~valid)
+    frame['probability'] = np.where(valid, probabilities, np.nan)
+    frame['error'] = errors
+
+
+def score_chunk(data: bytes, header: bytes, input_format: str, output_format: str,
+                include_header: bool) -> Tuple[bytes, int, int]:
+    """Parse, score and serialize one chunk; returns (output bytes, rows, rows with an error)"""
+    frame, errors = parse_chunk(data, header, input_format)
+    score_frame(*_worker_scoring, frame, errors)
+    if output_format == "csv":
+        text = frame.to_csv(index=False, header=include_header)
+    else:
+        text = frame.to_json(orient="records", lines=True) if len(frame) else ""
+        if text and not text.endswith("\n"):
+            text += "\n"
+    return text.encode("utf-8"), len(frame), int(frame['error'].notna().sum())
+
+
+def read_chunks(f, chunk_rows: int) -> Iterator[Tuple[bytes, int]]:
+    """(lines, offset after them) for successive chunks of an input file opened in binary mode"""
+    while True:
+        lines = list(itertools.islice(f, chunk_rows))
+        if not lines:
+            return
+        yield b"".join(lines), f.tell()
+
+
+class Checkpoint:
+    """Progress of a bulk run, written atomically next to the output after every chunk"""
+
+    def __init__(self, path: str, identity: Dict):
+        self.path = path
+        self.identity = identity
+        self.state = {"input_offset": 0, "output_bytes": 0, "chunks": 0, "rows": 0, "errors": 0, "seconds": 0.0}
+
+    def load(self) -> bool:
+        """Restore saved progress; False if there is none. Raises ValueError if it belongs to another run"""
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path) as f:
+            saved = json.load(f)
+        mismatched = [key for key, value in self.identity.items() if saved.get(key) != value]
+        if mismatched:
+            raise ValueError(f"Checkpoint {self.path} was written for a different run ({', '.join(mismatched)} changed); "
+                             "rerun without --resume to start over")
+        self.state.update({key: saved[key] for key in self.state})
+        return True
+
+    def save(self):
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(dict(self.identity, **self.state), f, indent=2)
+        os.replace(self.path + ".tmp", self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+@contextmanager
+def scoring_executor(workers: int, bundle: ModelBundle) -> Iterator[Executor]:
+    """Process pool of `workers` scoring processes, or a single in-process worker thread
+
+    Workers are forked from a forkserver (spawned where there is none) and
+    memory-map the bundle's probability table from a temporary directory
+    removed on exit, so the table is held in memory once however many there are.
+    """
+    global _worker_scoring
+    if workers <= 1:
+        _worker_scoring = (bundle.category_encoder, bundle.score_encoded_batch)
+        # One thread still overlaps reading and writing with scoring
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            yield executor
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        return
+
+    table_dir = tempfile.mkdtemp(prefix="ttc-table-")
+    try:
+        bundle.probability_table.save(table_dir)
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        if context.get_start_method() == "forkserver":
+            context.set_forkserver_preload(WORKER_PRELOAD)
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                                       initargs=(table_dir, bundle.category_encoder))
+        try:
+            yield executor
+        finally:
+            # Workers still running keep their mappings after the files are removed
+            executor.shutdown(wait=False, cancel_futures=True)
+    finally:
+        shutil.rmtree(table_dir, ignore_errors=True)
+
+
+def format_seconds(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+def bulk_score(input_path: str, output_path: str, bundle: ModelBundle, chunk_rows: int = CHUNK_ROWS,
+               workers: Optional[int] = None, input_format: Optional[str] = None, output_format: Optional[str] = None,
+               resume: bool = False, checkpoint_path: Optional[str] = None) -> Dict:
+    """Score every scenario in input_path into output_path, resuming from the checkpoint if asked
+
+    Returns the final counters. Output rows keep the input's columns and add
+    prediction, probability and error; rows with an error have no prediction.
+    """
+    input_format = file_format(input_path, input_format)
+    output_format = file_format(output_path, output_format)
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and bundle.probability_table is None:
+        print(f"Warning: Model version {bundle.version} has no probability table; scoring in-process")
+        workers = 1
+    stat = os.stat(input_path)
+    checkpoint = Checkpoint(checkpoint_path or output_path + ".checkpoint", {
+        "input": os.path.abspath(input_path),
+        "input_size": stat.st_size,
+        "input_mtime": stat.st_mtime,
+        "input_format": input_format,
+        "output_format": output_format,
+        "chunk_rows": chunk_rows,
+        "model_version": bundle.version
+    })
+    resumed = resume and checkpoint.load()
+    state = checkpoint.state
+    if resumed:
+        print(f"Resuming after {state['rows']:,} rows ({state['chunks']} chunks)")
+    elif resume:
+        print(f"No checkpoint at {checkpoint.path}; starting from the beginning")
+
+    start = time.perf_counter() - state["seconds"]
+    with open(input_path, "rb") as source, open(output_path, "r+b" if resumed else "wb") as out:
+        header = source.readline() if input_format == "csv" else b""
+        if resumed:
+            source.seek(state["input_offset"])
+            # Drop anything written after the last checkpoint
+            out.truncate(state["output_bytes"])
+            out.seek(state["output_bytes"])
+
+        def write(result: Tuple[bytes, int, int], offset: int):
+            data, rows, errors = result
+            out.write(data)
+            out.flush()
+            os.fsync(out.fileno())
+            state.update(input_offset=offset, output_bytes=out.tell(), chunks=state["chunks"] + 1,
+                         rows=state["rows"] + rows, errors=state["errors"] + errors,
+                         seconds=time.perf_counter() - start)
+            checkpoint.save()
+            elapsed = time.perf_counter() - start
+            done = offset / stat.st_size if stat.st_size else 1.0
+            eta = elapsed * (1 - done) / done if done > 0 else 0.0
+            print(f"  {state['rows']:>12,} rows  {done:6.1%}  {state['rows'] / max(elapsed, 1e-9):>10,.0f} rows/s  "
+                  f"{state['errors']:,} errors  elapsed {format_seconds(elapsed)}  eta {format_seconds(eta)}", flush=True)
+
+        pending = deque()
+        try:
+            with scoring_executor(workers, bundle) as executor:
+                for i, (data, offset) in enumerate(read_chunks(source, chunk_rows)):
+                    include_header = output_format == "csv" and i == 0 and not resumed
+                    pending.append((executor.submit(score_chunk, data, header, input_format, output_format,
+                                                    include_header), offset))
+                    while len(pending) >= workers * CHUNKS_PER_WORKER:
+                        future, offset = pending.popleft()
+                        write(future.result(), offset)
+                while pending:
+                    future, offset = pending.popleft()
+                    write(future.result(), offset)
+        except KeyboardInterrupt:
+            print(f"Interrupted after {state['rows']:,} rows; rerun with --resume to continue")
+            raise
+
+    checkpoint.remove()
+    state["seconds"] = time.perf_counter() - start
+    return state
+
+
+def load_bundle(model_dir: str, version: Optional[str] = None) -> ModelBundle:
+    """Newest (or the given) model version, found the same way the API finds it"""
+    registry = ModelRegistry(model_dir, MODEL_PATH, ENCODERS_PATH)
+    versions = registry.available()
+    if version is not None:
+        versions = [entry for entry in versions if entry[0] == version]
+    if not versions:
+        raise FileNotFoundError(f"Model version not found: {version}" if version else "No model artifacts found")
+    name, model_path, encoders_path = versions[-1]
+    return ModelBundle.load(model_path, encoders_path, name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score a CSV or JSONL file of delay scenarios with the TTC delay model")
+    parser.add_argument("input", help="scenario file with Line, Station, Code and DayOfWeek, one record per line")
+    parser.add_argument("output", help="file to write the scored scenarios to")
+    parser.add_argument("--input-format", choices=FORMATS, help="input format (default: from the file extension)")
+    parser.add_argument("--output-format", choices=FORMATS, help="output format (default: from the file extension)")
+    parser.add_argument("--chunksize", type=int, default=CHUNK_ROWS,
+                        help=f"input lines per chunk (default: {CHUNK_ROWS})")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="scoring processes; 1 scores in-process (default: one per core)")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted run from its checkpoint instead of starting over")
+    parser.add_argument("--checkpoint", help="checkpoint file (default: OUTPUT.checkpoint)")
+    parser.add_argument("--model-dir", default=os.environ.get("TTC_MODEL_DIR", "models"),
+                        help="directory of published model versions (default: models)")
+    parser.add_argument("--version", help="model version to score with (default: the newest)")
+    args = parser.parse_args()
+
+    try:
+        bundle = load_bundle(args.model_dir, args.version)
+        print(f"Scoring {args.input} with model version {bundle.version}...")
+        result = bulk_score(args.input, args.output, bundle, args.chunksize, args.workers or None,
+                            args.input_format, args.output_format, args.resume, args.checkpoint)
+    except (FileNotFoundError, ValueError) as e:
+        sys.exit(f"Error: {e}")
+    except KeyboardInterrupt:
+        sys.exit(130)
+    print(f"Scored {result['rows']:,} rows ({result['errors']:,} with errors) in {result['seconds']:.1f}s "
+          f"({result['rows'] / max(result['seconds'], 1e-9):,.0f} rows/s) into {args.output}")
@@ -0,0 +1,57 @@
+"""
+Category encoding layer for the TTC Delay Prediction API
+Built once from the fitted LabelEncoders so per-request encoding is a dict lookup,
+with an explicit UNKNOWN sentinel instead of exceptions for unseen values
+"""
+
+from typing import Dict, Iterable, Optional, Tuple
+import numpy as np
+
+CATEGORICAL_COLUMNS = ['Line', 'Station', 'Code']
+
+# Encoded value for a category the encoders were not fitted on
+UNKNOWN = -1
+
+
+class CategoryEncoder:
+    """Dict and array mappings equivalent to LabelEncoder.transform for each categorical column"""
+
+    def __init__(self, encoders, columns=CATEGORICAL_COLUMNS):
+        self.columns = list(columns)
+        self.classes: Dict[str, np.ndarray] = {
+            column: np.asarray(encoders[column].classes_).astype(str) for column in self.columns
+        }
+        self.index: Dict[str, Dict[str, int]] = {
+            column: {value: code for code, value in enumerate(classes)} for column, classes in self.classes.items()
+        }
+
+    def size(self, column: str) -> int:
+        """Number of known categories in a column"""
+        return len(self.classes[column])
+
+    def encode(self, column: str, value: str) -> int:
+        """Encoded value, or UNKNOWN"""
+        return self.index[column].get(value, UNKNOWN)
+
+    def encode_row(self, line: str, station: str, code: str) -> Tuple[int, int, int]:
+        """Encoded (Line, Station, Code); any unseen value is UNKNOWN"""
+        return (self.index['Line'].get(line, UNKNOWN),
+                self.index['Station'].get(station, UNKNOWN),
+                self.index['Code'].get(code, UNKNOWN))
+
+    def encode_many(self, column: str, values: Iterable[str]) -> np.ndarray:
+        """Vectorized encoding of a whole column; unseen values are UNKNOWN"""
+        index = self.index[column]
+        values = list(values)
+        return np.fromiter((index.get(value, UNKNOWN) for value in values), dtype=np.intp, count=len(values))
+
+    def decode(self, column: str, codes: np.ndarray) -> np.ndarray:
+        """Category names for encoded values"""
+        return self.classes[column][codes]
+
+    def unknown_error(self, line: str, station: str, code: str) -> Optional[str]:
+        """Message naming the first unseen value in a row, or None if all are known"""
+        for column, value in zip(self.columns, (line, station, code)):
+            if value not in self.index[column]:
+                return f"Unknown {column}: {value!r}"
+        return None
@@ -0,0 +1,86 @@
+"""
+Micro-batching inference queue for the TTC Delay Prediction API
+Single-row predictions arriving within a short window are scored together in one
+vectorized model call, and each caller's future is resolved with its own row
+"""
+
+import asyncio
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+class MicroBatcher:
+    """Coalesces concurrent single-row requests into one batched scoring call"""
+
+    def __init__(self, score_rows: Callable[[List[Tuple]], List[Any]], window_ms: float = 2.0, max_rows: int = 256):
+        """score_rows receives the collected rows and returns one result per row;
+        a result that is an Exception instance is raised to that row's caller
+        """
+        self.score_rows = score_rows
+        self.window = window_ms / 1000.0
+        self.max_rows = max_rows
+        self._pending: List[Tuple[Tuple, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+        self._in_flight = 0
+        self._submitted = 0
+        self._batches = 0
+        self._batched_rows = 0
+        self._largest_batch = 0
+
+    async def submit(self, row: Tuple) -> Any:
+        """Queue a row for the next batch and wait for its result"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((row, future))
+        self._submitted += 1
+
+        if len(self._pending) >= self.max_rows:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[Tuple[Tuple, asyncio.Future]]):
+        self._in_flight += len(batch)
+        self._batches += 1
+        self._batched_rows += len(batch)
+        self._largest_batch = max(self._largest_batch, len(batch))
+        try:
+            # Score off the event loop so new requests keep queueing meanwhile
+            results = await asyncio.get_running_loop().run_in_executor(None, self.score_rows, [row for row, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        finally:
+            self._in_flight -= len(batch)
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth and batching counters"""
+        return {
+            "window_ms": self.window * 1000.0,
+            "max_rows": self.max_rows,
+            "queued": len(self._pending),
+            "in_flight": self._in_flight,
+            "submitted": self._submitted,
+            "batches": self._batches,
+            "largest_batch": self._largest_batch,
+            "mean_batch_size": self._batched_rows / self._batches if self._batches else 0.0
+        }
@@ -0,0 +1,228 @@
+"""
+Server-sent live updates for the TTC Delay Prediction API
+Each topic (one station risk map) is scored once per model version, whoever is
+watching it; subscribers get one full snapshot and then only the stations that
+changed, so the cost of an update does not grow with the number of subscribers
+"""
+
+import asyncio
+import json
+import time
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+# Seconds between checks for a new model version, on top of the wake-ups from notify()
+TICK_SECONDS = 5.0
+
+# Seconds of silence after which a comment line is sent to keep proxies from closing the stream
+KEEPALIVE_SECONDS = 15.0
+
+# Events buffered per subscriber; a subscriber that falls further behind is resynced with a snapshot
+QUEUE_SIZE = 16
+
+# Numbers closer than this count as unchanged, so rounding noise from a re-blend is not sent
+DIFF_TOLERANCE = 1e-9
+
+
+def sse_event(event: str, event_id: int, data: Dict) -> bytes:
+    """One server-sent event with a JSON payload"""
+    return f"event: {event}\nid: {event_id}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode("utf-8")
+
+
+def _same(old, new) -> bool:
+    if isinstance(old, float) and isinstance(new, float):
+        return abs(old - new) <= DIFF_TOLERANCE
+    return old == new
+
+
+def diff_rows(previous: Dict[str, Dict], current: Dict[str, Dict]) -> Tuple[List[Dict], List[str]]:
+    """(changed, removed) between two snapshots keyed by station name
+
+    A changed entry holds the station's name and only the fields that differ;
+    a new station is sent whole.
+    """
+    changed = []
+    for name, row in current.items():
+        old = previous.get(name, {})
+        fields = {key: value for key, value in row.items() if key not in old or not _same(old[key], value)}
+        if fields:
+            fields["name"] = name
+            changed.append(fields)
+    removed = [name for name in previous if name not in current]
+    return changed, removed
+
+
+class Subscriber:
+    """One open stream: a bounded queue of encoded events"""
+
+    def __init__(self, queue_size: int = QUEUE_SIZE):
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        # Set once the first snapshot is queued; diffs before that are already part of it
+        self.ready = False
+
+
+class Topic:
+    """Latest snapshot of one stream and the subscribers watching it"""
+
+    def __init__(self, key: Hashable):
+        self.key = key
+        self.version: Optional[str] = None
+        self.rows: Dict[str, Dict] = {}
+        self.sequence = 0
+        self.snapshot_event = b""
+        self.subscribers: List[Subscriber] = []
+
+
+class Broadcaster:
+    """Fans station snapshots and diffs out to server-sent event subscribers
+
+    snapshot(key) returns (version, station rows with a "name") and runs in the
+    default executor; a topic is rescored when the version reported by
+    current_version() changes, checked every tick_seconds and whenever
+    notify() is called.
+    """
+
+    def __init__(self, snapshot: Callable[[Hashable], Tuple[str, List[Dict]]],
+                 current_version: Callable[[], Optional[str]], max_subscribers: int = 1000,
+                 tick_seconds: float = TICK_SECONDS, keepalive_seconds: float = KEEPALIVE_SECONDS,
+                 queue_size: int = QUEUE_SIZE):
+        self.snapshot = snapshot
+        self.current_version = current_version
+        self.max_subscribers = max_subscribers
+        self.tick_seconds = tick_seconds
+        self.keepalive_seconds = keepalive_seconds
+        self.queue_size = queue_size
+        self.topics: Dict[Hashable, Topic] = {}
+        self.subscribers = 0
+        self.snapshots = 0
+        self.diffs = 0
+        self.events_sent = 0
+        self.resyncs = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._refresh_lock: Optional[asyncio.Lock] = None
+
+    def notify(self):
+        """Ask for a rescore now; safe to call from any thread"""
+        loop, wake = self._loop, self._wake
+        if loop is not None and wake is not None:
+            loop.call_soon_threadsafe(wake.set)
+
+    async def run(self):
+        """Rescore topics whose version is out of date, every tick and on notify()"""
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.tick_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            for topic in list(self.topics.values()):
+                try:
+                    await self._refresh(topic)
+                except Exception as e:
+                    print(f"Warning: Could not refresh live updates for {topic.key}: {e}")
+
+    async def _refresh(self, topic: Topic):
+        if self._refresh_lock is None:
+            self._refresh_lock = asyncio.Lock()
+        # One rescore at a time, so a burst of new subscribers or notifications scores a topic once
+        async with self._refresh_lock:
+            if topic.version is not None and topic.version == self.current_version():
+                return
+            version, rows = await asyncio.get_running_loop().run_in_executor(None, self.snapshot, topic.key)
+            if version == topic.version:
+                return
+            keyed = {row["name"]: row for row in rows}
+            first = topic.version is None
+            changed, removed = diff_rows(topic.rows, keyed)
+
+            topic.version, topic.rows = version, keyed
+            topic.sequence += 1
+            topic.snapshot_event = sse_event("snapshot", topic.sequence, {"version": version, "stations": rows})
+            self.snapshots += 1
+            if first:
+                return
+            diff = {"version": version, "changed": changed}
+            if removed:
+                diff["removed"] = removed
+            self._publish(topic, sse_event("diff", topic.sequence, diff))
+            self.diffs += 1
+
+    def _publish(self, topic: Topic, event: bytes):
+        """Queue an event, encoded once, for every subscriber of a topic"""
+        for subscriber in topic.subscribers:
+            if not subscriber.ready:
+                continue
+            try:
+                subscriber.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Drop the backlog; the latest snapshot brings a slow client back in sync
+                while not subscriber.queue.empty():
+                    subscriber.queue.get_nowait()
+                subscriber.queue.put_nowait(topic.snapshot_event)
+                self.resyncs += 1
+
+    @property
+    def full(self) -> bool:
+        """Whether max_subscribers streams are open"""
+        return self.subscribers >= self.max_subscribers
+
+    async def subscribe(self, key: Hashable) -> Tuple[Topic, Subscriber]:
+        """Register a subscriber, scoring the topic first if nobody was watching it
+
+        Raises OverflowError when max_subscribers streams are already open.
+        """
+        if self.full:
+            raise OverflowError(f"Too many live update subscribers (at most {self.max_subscribers})")
+        topic = self.topics.get(key)
+        if topic is None:
+            topic = self.topics[key] = Topic(key)
+        subscriber = Subscriber(self.queue_size)
+        topic.subscribers.append(subscriber)
+        self.subscribers += 1
+        try:
+            await self._refresh(topic)
+        except BaseException:
+            self.unsubscribe(topic, subscriber)
+            raise
+        subscriber.queue.put_nowait(topic.snapshot_event)
+        subscriber.ready = True
+        return topic, subscriber
+
+    def unsubscribe(self, topic: Topic, subscriber: Subscriber):
+        """Remove a subscriber, and its topic once nobody watches it"""
+        if subscriber in topic.subscribers:
+            topic.subscribers.remove(subscriber)
+            self.subscribers -= 1
+        if not topic.subscribers and self.topics.get(topic.key) is topic:
+            del self.topics[topic.key]
+
+    async def stream(self, key: Hashable):
+        """Encoded events for a new subscriber to a topic, until the client disconnects"""
+        # Subscribing here rather than before the response starts means a stream that is never read holds no slot
+        topic, subscriber = await self.subscribe(key)
+        try:
+            # Reconnecting EventSource clients wait this long (milliseconds) before retrying
+            yield b"retry: 3000\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscriber.queue.get(), self.keepalive_seconds)
+                except asyncio.TimeoutError:
+                    yield f": keepalive {time.time():.0f}\n\n".encode("utf-8")
+                    continue
+                self.events_sent += 1
+                yield event
+        finally:
+            self.unsubscribe(topic, subscriber)
+
+    def stats(self) -> Dict:
+        """Open subscribers and topics, and event counters"""
+        return {
+            "subscribers": self.subscribers,
+            "topics": len(self.topics),
+            "snapshots": self.snapshots,
+            "diffs": self.diffs,
+            "events_sent": self.events_sent,
+            "resyncs": self.resyncs
+        }
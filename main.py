@@ -1,52 +1,195 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-import pandas as pd
-import pickle
 import os
 import json
-from typing import List, Dict, Optional
+import time
+import asyncio
+import hashlib
+import functools
+import secrets
+import contextlib
+import threading
+from typing import List, Dict, Optional, Tuple, Union
 import numpy as np
+from admission import AdmissionClass, AdmissionMiddleware
+from category_encoding import UNKNOWN
+from inference_queue import MicroBatcher
+from live_updates import Broadcaster
+from metrics import (REGISTRY, SIZE_BUCKETS, TABLE_LOOKUPS, Gauge, Histogram, RequestMetricsMiddleware,
+                     monitor_event_loop, observe_request_stage, stage, timed_dispatch)
+from model_registry import ModelBundle, ModelRegistry
+from online_learning import EventCounts, OnlineBlender, MIN_BLEND_CHANGE
+from probability_table import DAYS_OF_WEEK, HOURS_OF_DAY
+from profiling import ProfilingMiddleware, is_profiling, profiled
+from request_log import RequestLog, log_requests
+from route_graph import RouteNetwork, RoutePlanner
+from spatial_index import SpatialIndex
+from static_assets import IMMUTABLE, StaticAsset, etag_matches
+from station_registry import STATIONS_PATH, StationRegistry
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Load the model in the background so the server starts answering /health immediately;
+    /ready turns healthy once the model is loaded and warmed up"""
+    loader = asyncio.get_running_loop().run_in_executor(None, load_initial_model)
+    # Render and compress the web UI now rather than on the first page view
+    await asyncio.get_running_loop().run_in_executor(None, index_asset)
+    loop_monitor = asyncio.create_task(monitor_event_loop())
+    live_updates = asyncio.create_task(broadcaster.run())
+    if request_log is not None:
+        request_log.start()
+    yield
+    loop_monitor.cancel()
+    live_updates.cancel()
+    registry.stop()
+    await loader
+    if online_blender is not None:
+        online_blender.stop()
+    registry.close()
+    if request_log is not None:
+        request_log.close()
 
 # Initialize FastAPI app
-app = FastAPI(title="TTC Delay Prediction API", description="Predict TTC subway delays with map visualization and route optimization")
+app = FastAPI(title="TTC Delay Prediction API", description="Predict TTC subway delays with map visualization and route optimization",
+              lifespan=lifespan)
 
-# Load trained model + encoders with error handling
-model = None
-encoders = None
+# Set TTC_PROBABILITY_TABLE=0 to always run live model inference
+USE_PROBABILITY_TABLE = os.environ.get("TTC_PROBABILITY_TABLE", "1") != "0"
 
-try:
-    if os.path.exists("random_forest_model_new_task.pkl"):
-        with open("random_forest_model_new_task.pkl", "rb") as f:
-            model = pickle.load(f)
-    else:
-        print("Warning: Model file not found. Please train the model first.")
-        
-    if os.path.exists("label_encoders_new_task.pkl"):
-        with open("label_encoders_new_task.pkl", "rb") as f:
-            encoders = pickle.load(f)
-    else:
-        print("Warning: Encoders file not found. Please train the model first.")
-except Exception as e:
-    print(f"Error loading model files: {e}")
-
-# TTC Station coordinates (sample data - in production, use complete dataset)
-TTC_STATIONS = {
-    "UNION STATION": {"lat": 43.6452, "lng": -79.3806, "line": "YU"},
-    "BLOOR-YONGE": {"lat": 43.6706, "lng": -79.3856, "line": "YU"},
-    "ST GEORGE": {"lat": 43.6684, "lng": -79.3997, "line": "YU"},
-    "SPADINA": {"lat": 43.6674, "lng": -79.4047, "line": "YU"},
-    "BAY": {"lat": 43.6706, "lng": -79.3856, "line": "YU"},
-    "SHEPPARD-YONGE": {"lat": 43.7615, "lng": -79.4110, "line": "YU"},
-    "FINCH": {"lat": 43.7805, "lng": -79.4147, "line": "YU"},
-    "DOWNSVIEW": {"lat": 43.7225, "lng": -79.4778, "line": "YU"},
-    "KIPLING": {"lat": 43.6372, "lng": -79.5356, "line": "BD"},
-    "KENNEDY": {"lat": 43.7322, "lng": -79.2628, "line": "BD"},
-    "DON MILLS": {"lat": 43.7615, "lng": -79.3328, "line": "BD"},
-    "SCARBOROUGH CENTRE": {"lat": 43.7731, "lng": -79.2578, "line": "SRT"}
+# Model versions whose table (every hour of the week for an hourly model) would take more than
+# TTC_TABLE_MAX_ROWS model rows to score are served with live inference instead
+TABLE_MAX_ROWS = int(os.environ.get("TTC_TABLE_MAX_ROWS", "20000000"))
+
+# Distinct (day, code, model version) /stations/predictions payloads kept in memory
+STATION_PREDICTIONS_CACHE_SIZE = 256
+
+# Upper bound on alternative routes returned by /route/optimize
+MAX_ROUTE_ALTERNATIVES = 10
+
+# Upper bound on stations returned by /stations/nearest
+MAX_NEAREST_STATIONS = 50
+
+# Routes requested from coordinates start or end at the nearest station within this distance
+MAX_SNAP_KM = float(os.environ.get("TTC_MAX_SNAP_KM", "5"))
+
+# Upper bound on scenarios accepted by a single /predict/batch call
+MAX_BATCH_ROWS = int(os.environ.get("TTC_MAX_BATCH_ROWS", "100000"))
+
+# Concurrent /predict calls the lookup table cannot answer are collected for up to
+# TTC_MICRO_BATCH_WINDOW_MS (or TTC_MICRO_BATCH_MAX_ROWS rows) and scored together;
+# set TTC_MICRO_BATCH=0 to score each request on its own
+USE_MICRO_BATCHING = os.environ.get("TTC_MICRO_BATCH", "1") != "0"
+MICRO_BATCH_WINDOW_MS = float(os.environ.get("TTC_MICRO_BATCH_WINDOW_MS", "2"))
+MICRO_BATCH_MAX_ROWS = int(os.environ.get("TTC_MICRO_BATCH_MAX_ROWS", "256"))
+
+# Trained artifacts written by train_model.py
+MODEL_PATH = "random_forest_model_new_task.pkl"
+ENCODERS_PATH = "label_encoders_new_task.pkl"
+
+# Set TTC_FLAT_FOREST=0 to score small batches with sklearn instead of the flattened NumPy forest
+USE_FLAT_FOREST = os.environ.get("TTC_FLAT_FOREST", "1") != "0"
+
+# "inline" scores in the API process; "process" spreads large batches over
+# TTC_INFERENCE_WORKERS worker processes (defaults to one per core)
+INFERENCE_BACKEND = os.environ.get("TTC_INFERENCE_BACKEND", "inline")
+INFERENCE_WORKERS = int(os.environ.get("TTC_INFERENCE_WORKERS", "0")) or None
+
+# Versioned artifacts are published as TTC_MODEL_DIR/<version>/ (see train_model.py --publish);
+# the newest is polled for every TTC_MODEL_WATCH_SECONDS (0 disables) and swapped in without downtime
+MODEL_DIR = os.environ.get("TTC_MODEL_DIR", "models")
+MODEL_WATCH_SECONDS = float(os.environ.get("TTC_MODEL_WATCH_SECONDS", "30"))
+
+# POST /admin/reload requires this value in an X-Admin-Token header; unset disables the endpoint
+ADMIN_TOKEN = os.environ.get("TTC_ADMIN_TOKEN")
+
+# Set TTC_ONLINE_LEARNING=1 to accept observed delay events on /events and blend them into
+# the probability table every TTC_ONLINE_BLEND_SECONDS; the model's probability counts as
+# TTC_ONLINE_PRIOR_WEIGHT events and event counts halve every TTC_ONLINE_HALF_LIFE_HOURS.
+# A blend is only published once it moves some probability by TTC_ONLINE_MIN_CHANGE.
+# TTC_EVENTS_FILE names a JSONL file of events to replay at startup.
+USE_ONLINE_LEARNING = os.environ.get("TTC_ONLINE_LEARNING", "0") == "1"
+ONLINE_BLEND_SECONDS = float(os.environ.get("TTC_ONLINE_BLEND_SECONDS", "60"))
+ONLINE_PRIOR_WEIGHT = float(os.environ.get("TTC_ONLINE_PRIOR_WEIGHT", "20"))
+ONLINE_HALF_LIFE_HOURS = float(os.environ.get("TTC_ONLINE_HALF_LIFE_HOURS", "24"))
+ONLINE_MIN_CHANGE = float(os.environ.get("TTC_ONLINE_MIN_CHANGE", str(MIN_BLEND_CHANGE)))
+EVENTS_FILE = os.environ.get("TTC_EVENTS_FILE")
+
+# Set TTC_PROFILING=1 to let a request ask to be profiled with an X-Profile header or profile query
+# parameter (plus X-Admin-Token when TTC_ADMIN_TOKEN is set). TTC_PROFILE_SAMPLE_RATE profiles that
+# fraction of /predict and /route/optimize calls into TTC_PROFILE_DIR, keeping the newest TTC_PROFILE_MAX_FILES.
+USE_PROFILING = os.environ.get("TTC_PROFILING", "0") == "1"
+PROFILE_SAMPLE_RATE = float(os.environ.get("TTC_PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.environ.get("TTC_PROFILE_DIR", "profiles")
+PROFILE_MAX_FILES = int(os.environ.get("TTC_PROFILE_MAX_FILES", "200"))
+
+# Set TTC_REQUEST_LOG to a JSONL path to log every prediction and route request with its result and
+# latency. Entries are written in the background from a buffer of TTC_REQUEST_LOG_BUFFER entries and
+# TTC_REQUEST_LOG_BUFFER_MB estimated megabytes (new ones are dropped while it is full); the file is rotated
+# at TTC_REQUEST_LOG_MAX_MB megabytes or every TTC_REQUEST_LOG_ROTATE_HOURS hours, keeping
+# TTC_REQUEST_LOG_MAX_FILES rotated files.
+REQUEST_LOG_PATH = os.environ.get("TTC_REQUEST_LOG")
+REQUEST_LOG_BUFFER = int(os.environ.get("TTC_REQUEST_LOG_BUFFER", "10000"))
+REQUEST_LOG_BUFFER_MB = float(os.environ.get("TTC_REQUEST_LOG_BUFFER_MB", "64"))
+REQUEST_LOG_MAX_MB = float(os.environ.get("TTC_REQUEST_LOG_MAX_MB", "100"))
+REQUEST_LOG_ROTATE_HOURS = float(os.environ.get("TTC_REQUEST_LOG_ROTATE_HOURS", "24"))
+REQUEST_LOG_MAX_FILES = int(os.environ.get("TTC_REQUEST_LOG_MAX_FILES", "10"))
+
+request_log = RequestLog(
+    REQUEST_LOG_PATH, buffer_size=REQUEST_LOG_BUFFER, max_bytes=int(REQUEST_LOG_MAX_MB * 1024 * 1024),
+    rotate_seconds=REQUEST_LOG_ROTATE_HOURS * 3600.0, max_files=REQUEST_LOG_MAX_FILES,
+    buffer_bytes=int(REQUEST_LOG_BUFFER_MB * 1024 * 1024)
+) if REQUEST_LOG_PATH else None
+
+# /stations/predictions/stream accepts at most TTC_STREAM_MAX_SUBSCRIBERS open streams and checks for a
+# new model version every TTC_STREAM_TICK_SECONDS, besides being told about every swap
+STREAM_MAX_SUBSCRIBERS = int(os.environ.get("TTC_STREAM_MAX_SUBSCRIBERS", "1000"))
+STREAM_TICK_SECONDS = float(os.environ.get("TTC_STREAM_TICK_SECONDS", "5"))
+
+# Model-backed endpoints and route searches each run at most TTC_ADMISSION_MODEL_CONCURRENCY and
+# TTC_ADMISSION_ROUTE_CONCURRENCY requests at a time, with up to TTC_ADMISSION_QUEUE more waiting per class.
+# A request that has not started within TTC_ADMISSION_QUEUE_MS gets a 503 with a Retry-After of
+# TTC_ADMISSION_RETRY_AFTER seconds. The defaults leave some of the 40 threads sync endpoints share to
+# the cheap reads, which are never queued. Set TTC_ADMISSION=0 to turn admission control off.
+USE_ADMISSION_CONTROL = os.environ.get("TTC_ADMISSION", "1") != "0"
+ADMISSION_MODEL_CONCURRENCY = int(os.environ.get("TTC_ADMISSION_MODEL_CONCURRENCY", "24"))
+ADMISSION_ROUTE_CONCURRENCY = int(os.environ.get("TTC_ADMISSION_ROUTE_CONCURRENCY", "8"))
+ADMISSION_QUEUE = int(os.environ.get("TTC_ADMISSION_QUEUE", "64"))
+ADMISSION_QUEUE_MS = float(os.environ.get("TTC_ADMISSION_QUEUE_MS", "500"))
+ADMISSION_RETRY_AFTER = int(os.environ.get("TTC_ADMISSION_RETRY_AFTER", "1"))
+
+model_admission = AdmissionClass("model", ADMISSION_MODEL_CONCURRENCY, ADMISSION_QUEUE, ADMISSION_QUEUE_MS / 1000.0)
+route_admission = AdmissionClass("route", ADMISSION_ROUTE_CONCURRENCY, ADMISSION_QUEUE, ADMISSION_QUEUE_MS / 1000.0)
+ADMISSION_ROUTES = {
+    "/predict": model_admission,
+    "/predict/batch": model_admission,
+    "/stations/predictions": model_admission,
+    "/stations/{station}/heatmap": model_admission,
+    "/route/optimize": route_admission,
+    "/route/best-departure": route_admission
 }
 
+# Added first so it runs innermost, and shed requests still show up in request metrics and profiles
+app.add_middleware(AdmissionMiddleware, routes=ADMISSION_ROUTES, retry_after=ADMISSION_RETRY_AFTER,
+                   enabled=USE_ADMISSION_CONTROL)
+app.add_middleware(RequestMetricsMiddleware)
+app.add_middleware(ProfilingMiddleware, on_demand=USE_PROFILING, sample_rate=PROFILE_SAMPLE_RATE,
+                   directory=PROFILE_DIR, max_files=PROFILE_MAX_FILES,
+                   authorize=lambda token: not ADMIN_TOKEN or check_admin_token(token))
+
+# Every subway and RT station with its lines, travel order and coordinates (see stations.csv);
+# loaded and validated once, so a bad TTC_STATIONS_FILE stops the server from starting
+station_registry = StationRegistry.load(os.environ.get("TTC_STATIONS_FILE", STATIONS_PATH))
+
+# Response rows and line codes, built once from the registry
+station_summaries = station_registry.summaries()
+station_lines = station_registry.line_codes.tolist()
+
+# Probability used for stations the model has not seen
+DEFAULT_DELAY_PROBABILITY = 0.15
+
 # Input format
 class DelayRequest(BaseModel):
     Line: str
@@ -54,11 +197,40 @@ class DelayRequest(BaseModel):
     Code: str
     DayOfWeek: int  # 0=Monday … 6=Sunday
 
+class DelayEvent(DelayRequest):
+    MajorDelay: int  # observed outcome: 0 = no major delay, 1 = major delay
+
+class BatchDelayColumns(BaseModel):
+    Line: List[str]
+    Station: List[str]
+    Code: List[str]
+    DayOfWeek: List[int]
+
+class Location(BaseModel):
+    lat: float
+    lng: float
+
 class RouteRequest(BaseModel):
-    start_station: str
-    end_station: str
+    # Each end is a station name or a location snapped to the nearest station
+    start_station: Optional[str] = None
+    end_station: Optional[str] = None
+    start_location: Optional[Location] = None
+    end_location: Optional[Location] = None
     day_of_week: int
     time_preference: str = "any"  # "rush_hour", "off_peak", "any"
+    mode: str = "k_shortest"  # "k_shortest" (best routes by blended cost), "pareto" (time vs. risk trade-offs)
+    max_routes: int = 3
+
+class DepartureRequest(BaseModel):
+    # Ends are given as in RouteRequest
+    start_station: Optional[str] = None
+    end_station: Optional[str] = None
+    start_location: Optional[Location] = None
+    end_location: Optional[Location] = None
+    day_of_week: int
+    code: str = "MUIS"  # delay cause the stops are scored for
+    earliest_hour: int = 0
+    latest_hour: int = 23
 
 class StationInfo(BaseModel):
     name: str
@@ -67,10 +239,8 @@ class StationInfo(BaseModel):
     lng: float
     delay_probability: float
 
-@app.get("/", response_class=HTMLResponse)
-async def read_root():
-    """Serve the main web interface"""
-    return """
+# Web interface; {{STATIONS_URL}} is filled in with the versioned /stations URL
+INDEX_HTML = """
     <!DOCTYPE html>
     <html lang="en">
     <head>
@@ -122,9 +292,6 @@ async def read_root():
                         <label>Line:</label>
                         <select id="line" required>
                             <option value="">Select Line</option>
-                            <option value="YU">Yonge-University</option>
-                            <option value="BD">Bloor-Danforth</option>
-                            <option value="SRT">Scarborough RT</option>
                         </select>
                     </div>
                     <div class="form-group">
@@ -212,6 +379,13 @@ async def read_root():
             let map;
             let stationMarkers = {};
             
+            // Station lines and coordinates, loaded from /stations
+            let TTC_STATIONS = {};
+            
+            // Stations by line that the model can score, loaded from /predict/options
+            let PREDICT_OPTIONS = {};
+            const LINE_NAMES = { YU: 'Yonge-University', BD: 'Bloor-Danforth', SHP: 'Sheppard', SRT: 'Scarborough RT' };
+            
             // Initialize map
             function initMap() {
                 map = L.map('map').setView([43.6532, -79.3832], 11);
@@ -219,31 +393,57 @@ async def read_root():
                 loadStationPredictions();
             }
             
-            // Load station predictions and display on map
+            // Add a station to the map, or update its marker with changed fields
+            let stationData = {};
+            function showStation(update) {
+                const station = stationData[update.name] = Object.assign(stationData[update.name] || {}, update);
+                const color = station.delay_probability > 0.3 ? 'red' : 
+                            station.delay_probability > 0.1 ? 'orange' : 'green';
+                
+                let marker = stationMarkers[station.name];
+                if (!marker) {
+                    marker = L.circleMarker([station.lat, station.lng], {
+                        fillOpacity: 0.7,
+                        radius: 8
+                    }).addTo(map);
+                    stationMarkers[station.name] = marker;
+                }
+                marker.setStyle({ color: color, fillColor: color });
+                marker.bindPopup(`
+                    <b>${station.name}</b><br>
+                    Line: ${station.line}<br>
+                    Delay Probability: ${(station.delay_probability * 100).toFixed(1)}%
+                `);
+            }
+            
+            function removeStation(name) {
+                if (stationMarkers[name]) {
+                    map.removeLayer(stationMarkers[name]);
+                }
+                delete stationMarkers[name];
+                delete stationData[name];
+            }
+            
+            // Load station predictions and keep them live: a full snapshot, then only changed stations
             async function loadStationPredictions() {
+                if (window.EventSource) {
+                    const source = new EventSource('/stations/predictions/stream');
+                    source.addEventListener('snapshot', event => {
+                        const stations = JSON.parse(event.data).stations;
+                        const names = new Set(stations.map(station => station.name));
+                        Object.keys(stationMarkers).filter(name => !names.has(name)).forEach(removeStation);
+                        stations.forEach(showStation);
+                    });
+                    source.addEventListener('diff', event => {
+                        const diff = JSON.parse(event.data);
+                        diff.changed.forEach(showStation);
+                        (diff.removed || []).forEach(removeStation);
+                    });
+                    return;
+                }
                 try {
                     const response = await fetch('/stations/predictions');
-                    const stations = await response.json();
-                    
-                    stations.forEach(station => {
-                        const color = station.delay_probability > 0.3 ? 'red' : 
-                                    station.delay_probability > 0.1 ? 'orange' : 'green';
-                        
-                        const marker = L.circleMarker([station.lat, station.lng], {
-                            color: color,
-                            fillColor: color,
-                            fillOpacity: 0.7,
-                            radius: 8
-                        }).addTo(map);
-                        
-                        marker.bindPopup(`
-                            <b>${station.name}</b><br>
-                            Line: ${station.line}<br>
-                            Delay Probability: ${(station.delay_probability * 100).toFixed(1)}%
-                        `);
-                        
-                        stationMarkers[station.name] = marker;
-                    });
+                    (await response.json()).forEach(showStation);
                 } catch (error) {
                     console.error('Error loading station predictions:', error);
                 }
@@ -262,10 +462,34 @@ async def read_root():
                 }
             }
             
-            // Populate station dropdowns
+            // Fill a station dropdown
+            function fillStations(select, stations) {
+                select.innerHTML = '<option value="">Select Station</option>';
+                stations.forEach(station => {
+                    const option = document.createElement('option');
+                    option.value = station;
+                    option.textContent = station;
+                    select.appendChild(option);
+                });
+            }
+            
+            // Offer only the lines and stations the model can score
+            function populatePredictOptions() {
+                const lineSelect = document.getElementById('line');
+                Object.keys(PREDICT_OPTIONS).forEach(line => {
+                    const option = document.createElement('option');
+                    option.value = line;
+                    option.textContent = LINE_NAMES[line] || line;
+                    lineSelect.appendChild(option);
+                });
+                fillStations(document.getElementById('station'),
+                             [...new Set(Object.values(PREDICT_OPTIONS).flat())]);
+            }
+            
+            // Populate route station dropdowns; routing covers every station
             function populateStations() {
                 const stations = Object.keys(TTC_STATIONS);
-                const stationSelects = ['station', 'startStation', 'endStation'];
+                const stationSelects = ['startStation', 'endStation'];
                 
                 stationSelects.forEach(selectId => {
                     const select = document.getElementById(selectId);
@@ -282,19 +506,19 @@ async def read_root():
             // Update station dropdown based on line selection
             document.getElementById('line').addEventListener('change', function() {
                 const line = this.value;
-                const stationSelect = document.getElementById('station');
-                stationSelect.innerHTML = '<option value="">Select Station</option>';
-                
-                Object.entries(TTC_STATIONS).forEach(([name, info]) => {
-                    if (line === '' || info.line === line) {
-                        const option = document.createElement('option');
-                        option.value = name;
-                        option.textContent = name;
-                        stationSelect.appendChild(option);
-                    }
-                });
+                fillStations(document.getElementById('station'), line === '' ?
+                             [...new Set(Object.values(PREDICT_OPTIONS).flat())] : (PREDICT_OPTIONS[line] || []));
             });
             
+            // Show an error response's detail in place of a result
+            function displayError(resultId, response, result) {
+                const resultDiv = document.getElementById(resultId);
+                const detail = typeof result.detail === 'string' ? result.detail : JSON.stringify(result.detail);
+                resultDiv.innerHTML = '<h4>Request failed</h4><p></p>';
+                resultDiv.querySelector('p').textContent = `${response.status}: ${detail || response.statusText}`;
+                resultDiv.style.display = 'block';
+            }
+            
             // Handle prediction form
             document.getElementById('predictForm').addEventListener('submit', async function(e) {
                 e.preventDefault();
@@ -314,6 +538,10 @@ async def read_root():
                     });
                     
                     const result = await response.json();
+                    if (!response.ok) {
+                        displayError('predictResult', response, result);
+                        return;
+                    }
                     displayPredictionResult(result);
                 } catch (error) {
                     console.error('Error:', error);
@@ -339,6 +567,10 @@ async def read_root():
                     });
                     
                     const result = await response.json();
+                    if (!response.ok) {
+                        displayError('routeResult', response, result);
+                        return;
+                    }
                     displayRouteResult(result);
                 } catch (error) {
                     console.error('Error:', error);
@@ -395,223 +627,683 @@ async def read_root():
             }
             
             // Initialize page
-            document.addEventListener('DOMContentLoaded', function() {
+            document.addEventListener('DOMContentLoaded', async function() {
+                try {
+                    const response = await fetch('{{STATIONS_URL}}');
+                    TTC_STATIONS = (await response.json()).details;
+                } catch (error) {
+                    console.error('Error loading stations:', error);
+                }
                 populateStations();
+                try {
+                    const response = await fetch('/predict/options');
+                    if (response.ok) {
+                        PREDICT_OPTIONS = (await response.json()).lines;
+                    }
+                } catch (error) {
+                    console.error('Error loading prediction options:', error);
+                }
+                populatePredictOptions();
             });
-            
-            // TTC Stations data (same as backend)
-            const TTC_STATIONS = {
-                "UNION STATION": {"lat": 43.6452, "lng": -79.3806, "line": "YU"},
-                "BLOOR-YONGE": {"lat": 43.6706, "lng": -79.3856, "line": "YU"},
-                "ST GEORGE": {"lat": 43.6684, "lng": -79.3997, "line": "YU"},
-                "SPADINA": {"lat": 43.6674, "lng": -79.4047, "line": "YU"},
-                "BAY": {"lat": 43.6706, "lng": -79.3856, "line": "YU"},
-                "SHEPPARD-YONGE": {"lat": 43.7615, "lng": -79.4110, "line": "YU"},
-                "FINCH": {"lat": 43.7805, "lng": -79.4147, "line": "YU"},
-                "DOWNSVIEW": {"lat": 43.7225, "lng": -79.4778, "line": "YU"},
-                "KIPLING": {"lat": 43.6372, "lng": -79.5356, "line": "BD"},
-                "KENNEDY": {"lat": 43.7322, "lng": -79.2628, "line": "BD"},
-                "DON MILLS": {"lat": 43.7615, "lng": -79.3328, "line": "BD"},
-                "SCARBOROUGH CENTRE": {"lat": 43.7731, "lng": -79.2578, "line": "SRT"}
-            };
         </script>
     </body>
     </html>
     """
 
+@functools.lru_cache(maxsize=None)
+def stations_asset() -> StaticAsset:
+    """Serialized and compressed /stations payload"""
+    details = {
+        summary["name"]: {"lat": summary["lat"], "lng": summary["lng"], "line": summary["line"], "lines": lines}
+        for summary, lines in zip(station_summaries, station_registry.serving_lines())
+    }
+    body = json.dumps({"stations": list(details), "details": details}).encode("utf-8")
+    return StaticAsset(body, "application/json")
+
+@functools.lru_cache(maxsize=None)
+def index_asset() -> StaticAsset:
+    """Rendered and compressed web interface, pointing at the current station data"""
+    html = INDEX_HTML.replace("{{STATIONS_URL}}", f"/stations?v={stations_asset().digest}")
+    return StaticAsset(html.encode("utf-8"), "text/html; charset=utf-8")
+
+@app.get("/", response_class=HTMLResponse)
+async def read_root(request: Request):
+    """Serve the main web interface"""
+    return index_asset().response(request.headers)
+
+def current_bundle() -> ModelBundle:
+    """Model version serving this request; held for the whole request so a reload cannot change it midway"""
+    bundle = registry.current
+    if bundle is None:
+        raise HTTPException(status_code=503, detail="Model not loaded. Please train the model first.")
+    return bundle
+
+def json_response(content) -> JSONResponse:
+    """Serialize a response body, timed as the serialize stage"""
+    with stage("serialize"):
+        return JSONResponse(content)
+
 @app.post("/predict")
-def predict_delay(request: DelayRequest):
+@log_requests(request_log, "/predict")
+@profiled
+async def predict_delay(request: DelayRequest):
     """Predict delay probability for a given station and conditions"""
-    if model is None or encoders is None:
-        raise HTTPException(status_code=503, detail="Model not loaded. Please train the model first.")
+    observe_request_stage("request_parsing")
+    bundle = current_bundle()
+    check_day_and_hours(request.DayOfWeek)
     
     data = request.dict()
+    row = (data['Line'], data['Station'], data['Code'], data['DayOfWeek'])
+    with stage("encode"):
+        encoded = bundle.category_encoder.encode_row(*row[:3])
+    if UNKNOWN in encoded:
+        raise HTTPException(status_code=400, detail=f"Prediction error: {bundle.category_encoder.unknown_error(*row[:3])}")
 
     try:
-        # Encode categories
-        line_encoded = encoders['Line'].transform([data['Line']])[0]
-        station_encoded = encoders['Station'].transform([data['Station']])[0]
-        code_encoded = encoders['Code'].transform([data['Code']])[0]
-
-        # Build dataframe
-        X = pd.DataFrame([{
-            "Line": line_encoded,
-            "Station": station_encoded,
-            "Code": code_encoded,
-            "DayOfWeek": data['DayOfWeek']
-        }])
-
-        prediction = model.predict(X)[0]
-        probability = model.predict_proba(X)[0][1]  # Probability of major delay
-
-        return {
-            "prediction": int(prediction),  # 0 = no major delay, 1 = major delay
-            "probability": float(probability),
-            "input": data
-        }
+        # Table hits are answered inline; only misses need the model
+        table = bundle.probability_table
+        result = None
+        if table is not None:
+            with stage("table_lookup"):
+                result = table.lookup_encoded(*encoded, row[3])
+            TABLE_LOOKUPS.inc("miss" if result is None else "hit")
+        if result is None:
+            if is_profiling():
+                # Score inline so the model call shows up in this request's profile
+                result = bundle.score_scenario(*row)
+            elif inference_batcher is not None:
+                result = await inference_batcher.submit((bundle,) + row)
+            else:
+                result = await run_in_threadpool(bundle.score_scenario, *row)
+        prediction, probability = result
+
+        return json_response({
+            "prediction": prediction,  # 0 = no major delay, 1 = major delay
+            "probability": probability,
+            "input": data,
+            "model_version": bundle.version
+        })
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Prediction error: {str(e)}")
 
-@app.get("/stations/predictions")
-def get_station_predictions():
-    """Get delay predictions for all stations"""
-    if model is None or encoders is None:
-        raise HTTPException(status_code=503, detail="Model not loaded. Please train the model first.")
-    
-    stations = []
-    
-    for station_name, station_info in TTC_STATIONS.items():
-        try:
-            # Use a default delay code for general prediction
-            line_encoded = encoders['Line'].transform([station_info['line']])[0]
-            station_encoded = encoders['Station'].transform([station_name])[0]
-            code_encoded = encoders['Code'].transform(['MUIS'])[0]  # Default to mechanical issue
-            
-            # Predict for Monday (typical weekday)
-            X = pd.DataFrame([{
-                "Line": line_encoded,
-                "Station": station_encoded,
-                "Code": code_encoded,
-                "DayOfWeek": 0
-            }])
-            
-            probability = model.predict_proba(X)[0][1]
-            
-            stations.append(StationInfo(
-                name=station_name,
-                line=station_info['line'],
-                lat=station_info['lat'],
-                lng=station_info['lng'],
-                delay_probability=float(probability)
-            ))
-        except Exception as e:
-            # If station not in training data, use average probability
-            stations.append(StationInfo(
-                name=station_name,
-                line=station_info['line'],
-                lat=station_info['lat'],
-                lng=station_info['lng'],
-                delay_probability=0.15  # Default probability
-            ))
+# Rows per micro-batch and per /predict/batch request
+MICRO_BATCH_ROWS = REGISTRY.register(Histogram("ttc_micro_batch_rows", "Rows per micro-batched /predict scoring call", SIZE_BUCKETS))
+BATCH_REQUEST_ROWS = REGISTRY.register(Histogram("ttc_batch_request_rows", "Rows per /predict/batch request", SIZE_BUCKETS))
+
+def score_rows(rows: List[Tuple[ModelBundle, str, str, str, int]]) -> List:
+    """Score micro-batched /predict rows, returning (prediction, probability) or an error per row
+
+    Each row carries the bundle its request started with; rows queued across a
+    reload are scored by their own version, one model call per version.
+    """
+    MICRO_BATCH_ROWS.observe(len(rows))
+    results = [None] * len(rows)
+    by_bundle: Dict[ModelBundle, List[int]] = {}
+    for i, row in enumerate(rows):
+        by_bundle.setdefault(row[0], []).append(i)
+
+    for bundle, indices in by_bundle.items():
+        lines, stations, codes, days = (list(column) for column in zip(*(rows[i][1:] for i in indices)))
+        predictions, probabilities, errors = bundle.score_batch(lines, stations, codes, days)
+        for i, prediction, probability, error in zip(indices, predictions.tolist(), probabilities.tolist(), errors):
+            results[i] = ValueError(error) if error else (int(prediction), float(probability))
+    return results
+
+inference_batcher = MicroBatcher(score_rows, MICRO_BATCH_WINDOW_MS, MICRO_BATCH_MAX_ROWS) if USE_MICRO_BATCHING else None
+
+@app.post("/predict/batch")
+@timed_dispatch
+@log_requests(request_log, "/predict/batch")
+@profiled
+def predict_delay_batch(request: Union[BatchDelayColumns, List[DelayRequest]]):
+    """Predict delay probabilities for many scenarios in one call
+
+    Accepts either a list of /predict bodies or columnar arrays, and always
+    returns columnar results with a per-row error slot.
+    """
+    bundle = current_bundle()
+
+    if isinstance(request, BatchDelayColumns):
+        lines, stations, codes, days = request.Line, request.Station, request.Code, request.DayOfWeek
+        if not len(lines) == len(stations) == len(codes) == len(days):
+            raise HTTPException(status_code=400, detail="Line, Station, Code and DayOfWeek must have the same length")
+    else:
+        lines = [row.Line for row in request]
+        stations = [row.Station for row in request]
+        codes = [row.Code for row in request]
+        days = [row.DayOfWeek for row in request]
+
+    if len(days) > MAX_BATCH_ROWS:
+        raise HTTPException(status_code=413, detail=f"Batch too large: at most {MAX_BATCH_ROWS} rows")
+    BATCH_REQUEST_ROWS.observe(len(days))
+
+    try:
+        predictions, probabilities, errors = bundle.score_batch(lines, stations, codes, days)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Prediction error: {str(e)}")
+
+    return json_response({
+        "count": len(days),
+        "prediction": [None if error else int(p) for p, error in zip(predictions.tolist(), errors)],
+        "probability": [None if error else p for p, error in zip(probabilities.tolist(), errors)],
+        "error": errors,
+        "model_version": bundle.version
+    })
+
+def station_probabilities(bundle: ModelBundle, code: str, day_of_week: int, ids: Optional[np.ndarray] = None) -> np.ndarray:
+    """Delay probability at registry stations (all of them by default), scored in one batch
+
+    Uses the stations' categories pre-encoded for this model version. Stations
+    the model has not seen get DEFAULT_DELAY_PROBABILITY.
+    """
+    codes = bundle.station_codes
+    ids = station_registry.ids if ids is None else ids
+    code_id = bundle.category_encoder.encode('Code', code)
+    valid = codes.known[ids] & (code_id != UNKNOWN)
+    _, probabilities = bundle.score_encoded_batch(codes.lines[ids], codes.stations[ids], np.full(len(ids), code_id),
+                                                  np.full(len(ids), day_of_week, dtype=np.int64), valid)
+    return np.where(valid, probabilities, DEFAULT_DELAY_PROBABILITY)
+
+def station_predictions(bundle: ModelBundle, day_of_week: int, code: str) -> List[Dict]:
+    """Every station with its coordinates and delay probability, scored in one batch"""
+    probabilities = station_probabilities(bundle, code, day_of_week)
+    return [dict(summary, delay_probability=probability)
+            for summary, probability in zip(station_summaries, probabilities.tolist())]
+
+@functools.lru_cache(maxsize=STATION_PREDICTIONS_CACHE_SIZE)
+def station_predictions_payload(bundle: ModelBundle, day_of_week: int, code: str) -> Tuple[bytes, str]:
+    """Serialized station predictions and their ETag for one model version"""
+    body = json.dumps(station_predictions(bundle, day_of_week, code)).encode("utf-8")
+    return body, f'"{bundle.version}-{hashlib.sha1(body).hexdigest()[:16]}"'
+
+@app.get("/stations/predictions", response_model=List[StationInfo])
+@profiled
+def get_station_predictions(request: Request, day_of_week: int = 0, code: str = "MUIS"):
+    """Get delay predictions for all stations (defaults: Monday, mechanical issue)"""
+    bundle = current_bundle()
+    check_day_and_hours(day_of_week)
+    if bundle.category_encoder.encode('Code', code) == UNKNOWN:
+        raise HTTPException(status_code=400, detail=f"Unknown Code: {code!r}")
     
-    return stations
+    body, etag = station_predictions_payload(bundle, day_of_week, code)
+    # Browsers revalidate on every map load and get a bodiless 304 while nothing changed
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "X-Model-Version": bundle.version}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def live_station_predictions(key: Tuple[int, str]) -> Tuple[str, List[Dict]]:
+    """(model version, station predictions) for a live stream's (day_of_week, code)"""
+    bundle = current_bundle()
+    return bundle.version, station_predictions(bundle, *key)
+
+# One scoring per (day, code) and model version, shared by every open stream
+broadcaster = Broadcaster(
+    live_station_predictions, lambda: registry.current.version if registry.current is not None else None,
+    max_subscribers=STREAM_MAX_SUBSCRIBERS, tick_seconds=STREAM_TICK_SECONDS
+)
+
+@app.get("/stations/predictions/stream")
+async def stream_station_predictions(day_of_week: int = 0, code: str = "MUIS"):
+    """Live station predictions as server-sent events: a snapshot, then a diff of changed stations per model update"""
+    bundle = current_bundle()
+    check_day_and_hours(day_of_week)
+    if bundle.category_encoder.encode('Code', code) == UNKNOWN:
+        raise HTTPException(status_code=400, detail=f"Unknown Code: {code!r}")
+    if broadcaster.full:
+        raise HTTPException(status_code=503, detail=f"Too many live update subscribers (at most {STREAM_MAX_SUBSCRIBERS})")
+    # X-Accel-Buffering stops nginx from holding events back
+    return StreamingResponse(broadcaster.stream((day_of_week, code)), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.post("/route/optimize")
+@timed_dispatch
+@log_requests(request_log, "/route/optimize")
+@profiled
 def optimize_route(request: RouteRequest):
     """Find the best route between two stations considering delay probabilities"""
-    if model is None or encoders is None:
-        raise HTTPException(status_code=503, detail="Model not loaded. Please train the model first.")
-    
-    start_station = request.start_station
-    end_station = request.end_station
-    day_of_week = request.day_of_week
-    time_preference = request.time_preference
+    bundle = current_bundle()
+    check_day_and_hours(request.day_of_week)
     
-    # Simple route optimization algorithm
-    routes = []
+    snapped = {}
+    start_station = route_endpoint(request.start_station, request.start_location, "start", snapped)
+    end_station = route_endpoint(request.end_station, request.end_location, "end", snapped)
     
-    # Get station coordinates
-    if start_station not in TTC_STATIONS or end_station not in TTC_STATIONS:
+    if start_station not in route_network.station_id or end_station not in route_network.station_id:
         raise HTTPException(status_code=400, detail="Invalid station names")
+    if request.mode not in ("k_shortest", "pareto"):
+        raise HTTPException(status_code=400, detail="mode must be 'k_shortest' or 'pareto'")
+    if not 1 <= request.max_routes <= MAX_ROUTE_ALTERNATIVES:
+        raise HTTPException(status_code=400, detail=f"max_routes must be between 1 and {MAX_ROUTE_ALTERNATIVES}")
     
-    start_info = TTC_STATIONS[start_station]
-    end_info = TTC_STATIONS[end_station]
-    
-    # Calculate direct route
-    direct_route = calculate_route_risk([start_station, end_station], day_of_week, time_preference)
-    routes.append(direct_route)
-    
-    # Calculate alternative routes with transfers
-    if start_info['line'] != end_info['line']:
-        # Find transfer stations
-        transfer_stations = find_transfer_stations(start_info['line'], end_info['line'])
-        
-        for transfer in transfer_stations:
-            route_stations = [start_station, transfer, end_station]
-            route_risk = calculate_route_risk(route_stations, day_of_week, time_preference)
-            routes.append(route_risk)
-    
-    # Sort routes by total delay risk (ascending)
-    routes.sort(key=lambda x: x['total_delay_risk'])
+    with stage("route_scoring"):
+        routes = bundle.route_planner.alternatives(start_station, end_station, request.day_of_week,
+                                            request.time_preference, request.mode, request.max_routes)
+    if not routes:
+        raise HTTPException(status_code=404, detail="No route found between these stations")
     
-    return {"routes": routes}
+    response = {"routes": list(routes), "model_version": bundle.version}
+    if snapped:
+        response["snapped"] = snapped
+    return json_response(response)
+
+def route_endpoint(station: Optional[str], location: Optional[Location], end: str, snapped: Dict) -> Optional[str]:
+    """Station a route starts or ends at: the named one, or the one nearest the given location"""
+    if location is None or station is not None:
+        return station
+    check_location(location.lat, location.lng)
+    nearest = station_index.nearest(location.lat, location.lng, k=1, max_km=MAX_SNAP_KM)
+    if not nearest:
+        raise HTTPException(status_code=400, detail=f"No station within {MAX_SNAP_KM:g} km of the {end} location")
+    index, distance = nearest[0]
+    snapped[end] = {"station": station_index.names[index], "distance_km": round(distance, 3)}
+    return station_index.names[index]
+
+def check_day_and_hours(day_of_week: int, earliest_hour: int = 0, latest_hour: int = HOURS_OF_DAY - 1):
+    if not 0 <= day_of_week < DAYS_OF_WEEK:
+        raise HTTPException(status_code=400, detail=f"day_of_week must be between 0 and {DAYS_OF_WEEK - 1}")
+    if not 0 <= earliest_hour <= latest_hour < HOURS_OF_DAY:
+        raise HTTPException(status_code=400, detail=f"Hours must satisfy 0 <= earliest_hour <= latest_hour <= {HOURS_OF_DAY - 1}")
+
+def station_hourly_risk(bundle: ModelBundle, ids: np.ndarray, code: str, days: List[int]) -> np.ndarray:
+    """Delay probability at every hour of the day per (registry station, day), shaped (stations, 24)
+
+    Read from the bundle's risk surface in one vectorized slice. Stations the
+    model has not seen get DEFAULT_DELAY_PROBABILITY, as in route scoring.
+    """
+    codes = bundle.station_codes
+    code_id = bundle.category_encoder.encode('Code', code)
+    known = codes.known[ids] & (code_id != UNKNOWN)
+    risk = np.full((len(ids), HOURS_OF_DAY), DEFAULT_DELAY_PROBABILITY)
+    if known.any():
+        ids = ids[known]
+        risk[known] = bundle.hourly_probabilities(codes.lines[ids], codes.stations[ids], np.full(len(ids), code_id),
+                                                  np.asarray(days, dtype=np.int64)[known])
+    # Hourly surfaces are float32; six decimals keep the JSON free of float noise
+    return risk.round(6)
+
+def hour_summary(day_of_week: int, hour: int, probability: float) -> Dict:
+    return {"day_of_week": day_of_week, "hour": hour, "delay_probability": probability}
+
+@app.get("/stations/{station}/heatmap")
+@profiled
+def get_station_heatmap(station: str, code: str = "MUIS"):
+    """Weekly delay-risk heatmap for a station: probability per day of week (rows) and hour of day (columns)"""
+    bundle = current_bundle()
+    station_id = station_registry.id(station)
+    if station_id is None:
+        raise HTTPException(status_code=404, detail=f"Unknown station: {station!r}")
+    line = str(bundle.station_codes.line_names[station_id])
+    if not bundle.station_codes.known[station_id] or bundle.category_encoder.encode('Code', code) == UNKNOWN:
+        raise HTTPException(status_code=400, detail=f"Prediction error: {bundle.category_encoder.unknown_error(line, station, code)}")
+
+    heatmap = station_hourly_risk(bundle, np.full(DAYS_OF_WEEK, station_id), code, list(range(DAYS_OF_WEEK)))
+    peak = np.unravel_index(int(heatmap.argmax()), heatmap.shape)
+    lowest = np.unravel_index(int(heatmap.argmin()), heatmap.shape)
+    return json_response({
+        "station": station,
+        "line": line,
+        "code": code,
+        "probabilities": heatmap.tolist(),
+        "peak": hour_summary(int(peak[0]), int(peak[1]), float(heatmap[peak])),
+        "lowest": hour_summary(int(lowest[0]), int(lowest[1]), float(heatmap[lowest])),
+        # False when the model has no Hour feature: every hour of a day then has the same probability
+        "hourly_model": bundle.hourly,
+        "model_version": bundle.version
+    })
+
+@app.post("/route/best-departure")
+@timed_dispatch
+@log_requests(request_log, "/route/best-departure")
+@profiled
+def best_departure(request: DepartureRequest):
+    """Departure hour with the lowest delay risk along the best route between two stations"""
+    bundle = current_bundle()
+
+    snapped = {}
+    start_station = route_endpoint(request.start_station, request.start_location, "start", snapped)
+    end_station = route_endpoint(request.end_station, request.end_location, "end", snapped)
+    if start_station not in route_network.station_id or end_station not in route_network.station_id:
+        raise HTTPException(status_code=400, detail="Invalid station names")
+    check_day_and_hours(request.day_of_week, request.earliest_hour, request.latest_hour)
+    if bundle.category_encoder.encode('Code', request.code) == UNKNOWN:
+        raise HTTPException(status_code=400, detail=f"Unknown Code: {request.code!r}")
+
+    route = bundle.route_planner.route(start_station, end_station, request.day_of_week, "any")
+    if route is None:
+        raise HTTPException(status_code=404, detail="No route found between these stations")
+
+    with stage("route_scoring"):
+        stops = route["stations"]
+        risk = station_hourly_risk(bundle, station_registry.ids_of(stops), request.code, [request.day_of_week] * len(stops))
+        # A route's risk at each hour is the mean over its stops, as in total_delay_risk
+        hours = np.arange(request.earliest_hour, request.latest_hour + 1)
+        by_hour = risk[:, hours].mean(axis=0).round(6)
+    best = int(by_hour.argmin())
+
+    response = {
+        "route": route,
+        "day_of_week": request.day_of_week,
+        "code": request.code,
+        "best_hour": int(hours[best]),
+        "delay_risk": float(by_hour[best]),
+        "hours": [{"hour": int(hour), "delay_risk": value} for hour, value in zip(hours.tolist(), by_hour.tolist())],
+        "hourly_model": bundle.hourly,
+        "model_version": bundle.version
+    }
+    if snapped:
+        response["snapped"] = snapped
+    return json_response(response)
+
+route_network = RouteNetwork(station_registry.line_stops(), station_registry.coordinates())
+
+# Registry id of each route network station
+route_station_ids = station_registry.ids_of(route_network.stations)
+
+def station_delay_risk(bundle: ModelBundle, day_of_week: int) -> np.ndarray:
+    """Delay probability at every route network station for route scoring (mechanical issue as the reference code)"""
+    return station_probabilities(bundle, 'MUIS', day_of_week, route_station_ids)
+
+# Grid index over station coordinates for nearest-station, viewport and snapping queries;
+# its point indices are registry ids
+station_index = SpatialIndex(station_registry.names.tolist(), station_registry.latlng)
+
+def prepare_bundle(bundle: ModelBundle):
+    """Encode the stations, precompute routes for a new version and warm it up before it takes traffic"""
+    # Derived (online-blended) versions share their base's categories, routes and warmed-up model
+    if bundle.base is not bundle:
+        return
+    bundle.station_codes = station_registry.encode(bundle.category_encoder)
+    unknown = station_registry.names[bundle.station_codes.unknown].tolist()
+    if unknown:
+        print(f"Warning: Model version {bundle.version} has not seen {len(unknown)} of {len(station_registry)} "
+              f"stations (or their line), which get the default delay probability: {', '.join(unknown[:10])}"
+              f"{', ...' if len(unknown) > 10 else ''}")
+    if bundle.station_codes.unlisted:
+        print(f"Warning: Model version {bundle.version} knows {bundle.station_codes.unlisted} stations "
+              "that are not in the station registry")
+    # Risk-aware shortest routes for every day and time preference
+    bundle.route_planner = RoutePlanner(route_network, functools.partial(station_delay_risk, bundle))
+    bundle.warm_up()
+
+def publish_bundle(bundle: ModelBundle):
+    """Drop responses cached for the previous version and push the new predictions to live streams;
+    the first version published also starts online learning"""
+    station_predictions_payload.cache_clear()
+    broadcaster.notify()
+    if USE_ONLINE_LEARNING and online_blender is None:
+        # Outside the swap: the first blend publishes, which waits for the registry this hook runs under
+        threading.Thread(target=start_online_learning, args=(bundle,), name="online-learning-start",
+                         daemon=True).start()
+
+registry = ModelRegistry(
+    MODEL_DIR, MODEL_PATH, ENCODERS_PATH, prepare=prepare_bundle, on_swap=publish_bundle,
+    use_probability_table=USE_PROBABILITY_TABLE, use_flat_forest=USE_FLAT_FOREST,
+    inference_backend=INFERENCE_BACKEND, inference_workers=INFERENCE_WORKERS, max_table_rows=TABLE_MAX_ROWS
+)
+
+# Seconds from the start of loading until the first model version was warm and published
+startup_seconds = None
+
+def load_initial_model():
+    """Load, warm up and publish the newest model version with error handling, then watch for newer ones"""
+    global startup_seconds
+    start = time.perf_counter()
+    try:
+        registry.load()
+        startup_seconds = time.perf_counter() - start
+    except FileNotFoundError:
+        registry.last_error = "Model file not found"
+        print("Warning: Model file not found. Please train the model first.")
+    except Exception as e:
+        registry.last_error = str(e)
+        print(f"Error loading model files: {e}")
+
+    if MODEL_WATCH_SECONDS > 0:
+        registry.watch(MODEL_WATCH_SECONDS)
+
+def check_admin_token(x_admin_token: Optional[str]) -> bool:
+    """Whether a request's X-Admin-Token matches TTC_ADMIN_TOKEN"""
+    return bool(ADMIN_TOKEN) and x_admin_token is not None and secrets.compare_digest(x_admin_token, ADMIN_TOKEN)
+
+@app.post("/admin/reload")
+def reload_model(version: Optional[str] = None, x_admin_token: Optional[str] = Header(None)):
+    """Load and publish a model version (the newest by default) without dropping requests
+
+    Loading an older version pins it against the watcher; loading the newest unpins.
+    """
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Model reload is disabled; set TTC_ADMIN_TOKEN to enable it")
+    if not check_admin_token(x_admin_token):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+    previous = registry.current
+    try:
+        bundle = registry.load(version)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Model reload failed, still serving the previous version: {e}")
 
-def calculate_route_risk(stations: List[str], day_of_week: int, time_preference: str) -> Dict:
-    """Calculate total delay risk for a route"""
-    total_risk = 0
-    estimated_time = 0
-    
-    for i, station in enumerate(stations):
-        try:
-            station_info = TTC_STATIONS[station]
-            line_encoded = encoders['Line'].transform([station_info['line']])[0]
-            station_encoded = encoders['Station'].transform([station])[0]
-            code_encoded = encoders['Code'].transform(['MUIS'])[0]
-            
-            X = pd.DataFrame([{
-                "Line": line_encoded,
-                "Station": station_encoded,
-                "Code": code_encoded,
-                "DayOfWeek": day_of_week
-            }])
-            
-            probability = model.predict_proba(X)[0][1]
-            total_risk += probability
-            
-            # Add time multiplier for transfers
-            if i > 0 and i < len(stations) - 1:
-                estimated_time += 5  # Transfer time
-            else:
-                estimated_time += 3  # Station time
-                
-        except Exception:
-            # Default values if station not in training data
-            total_risk += 0.15
-            estimated_time += 3
-    
-    # Apply time preference multiplier
-    if time_preference == "rush_hour":
-        total_risk *= 1.5
-        estimated_time *= 1.3
-    elif time_preference == "off_peak":
-        total_risk *= 0.8
-        estimated_time *= 0.9
-    
     return {
-        "stations": stations,
-        "total_delay_risk": total_risk / len(stations),  # Average risk
-        "estimated_time": int(estimated_time)
+        "model_version": bundle.version,
+        "previous_version": previous.version if previous is not None else None,
+        "reloaded": bundle is not previous,
+        "pinned_version": registry.pinned_version
     }
 
-def find_transfer_stations(line1: str, line2: str) -> List[str]:
-    """Find transfer stations between two lines"""
-    transfer_map = {
-        ("YU", "BD"): ["BLOOR-YONGE", "ST GEORGE"],
-        ("BD", "YU"): ["BLOOR-YONGE", "ST GEORGE"],
-        ("YU", "SRT"): ["KENNEDY"],
-        ("SRT", "YU"): ["KENNEDY"],
-        ("BD", "SRT"): ["KENNEDY"],
-        ("SRT", "BD"): ["KENNEDY"]
+@app.get("/admin/models")
+def list_models():
+    """Available model versions and the one currently served"""
+    return registry.status()
+
+online_blender: Optional[OnlineBlender] = None
+online_learning_lock = threading.Lock()
+
+def start_online_learning(bundle: ModelBundle):
+    """Create the event counts for a published model, replay TTC_EVENTS_FILE and start blending; once only,
+    whether the first model version is loaded at startup or later by a reload or the watcher"""
+    global online_blender
+    with online_learning_lock:
+        if online_blender is not None:
+            return
+        if bundle.probability_table is None:
+            print("Warning: Online learning needs the probability table; set TTC_PROBABILITY_TABLE=1 to use it")
+            return
+        counts = EventCounts(bundle.category_encoder, ONLINE_HALF_LIFE_HOURS)
+        if EVENTS_FILE and os.path.exists(EVENTS_FILE):
+            with open(EVENTS_FILE) as f:
+                accepted, rejected = counts.load_jsonl(f)
+            print(f"Replayed {accepted} delay events from {EVENTS_FILE} ({rejected} rejected)")
+        online_blender = OnlineBlender(registry, counts, ONLINE_BLEND_SECONDS, ONLINE_PRIOR_WEIGHT, ONLINE_MIN_CHANGE)
+        online_blender.blend()
+        online_blender.start()
+
+def event_counts(x_admin_token: Optional[str]) -> EventCounts:
+    """Event counts to ingest into, after checking that online learning is on and the caller may use it"""
+    if not USE_ONLINE_LEARNING:
+        raise HTTPException(status_code=403, detail="Online learning is disabled; set TTC_ONLINE_LEARNING=1 to enable it")
+    if ADMIN_TOKEN and not check_admin_token(x_admin_token):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+    if online_blender is None:
+        raise HTTPException(status_code=503, detail="Model not loaded. Please train the model first.")
+    return online_blender.counts
+
+def ingestion_result(accepted: int, rejected: int, errors: List[Optional[str]]) -> Dict:
+    """Response body for the ingestion endpoints, listing at most 100 row errors"""
+    return {
+        "accepted": accepted,
+        "rejected": rejected,
+        "errors": [{"row": i, "error": error} for i, error in enumerate(errors) if error][:100]
     }
-    
-    return transfer_map.get((line1, line2), [])
+
+@app.post("/events")
+def ingest_events(events: List[DelayEvent], x_admin_token: Optional[str] = Header(None)):
+    """Record observed delay events; they reach predictions at the next blend"""
+    counts = event_counts(x_admin_token)
+    errors = counts.add_records(event.dict() for event in events)
+    rejected = sum(error is not None for error in errors)
+    return ingestion_result(len(events) - rejected, rejected, errors)
+
+@app.post("/events/jsonl")
+async def ingest_events_jsonl(request: Request, x_admin_token: Optional[str] = Header(None)):
+    """Record observed delay events sent as JSONL, one event per line, like TTC_EVENTS_FILE"""
+    counts = event_counts(x_admin_token)
+    body = (await request.body()).decode("utf-8")
+    accepted, rejected = await run_in_threadpool(counts.load_jsonl, body.splitlines())
+    return ingestion_result(accepted, rejected, [])
+
+def model_info_metric():
+    bundle = registry.current
+    if bundle is not None:
+        yield (bundle.version, bundle.base.version), 1
+
+def cache_metric():
+    caches = [("station_predictions", station_predictions_payload.cache_info())]
+    bundle = registry.current
+    if bundle is not None and bundle.route_planner is not None:
+        caches.append(("route_alternatives", bundle.route_planner.alternatives.cache_info()))
+    for name, info in caches:
+        yield (name, "hit"), info.hits
+        yield (name, "miss"), info.misses
+
+def micro_batch_metric():
+    if inference_batcher is not None:
+        stats = inference_batcher.stats()
+        for key in ("queued", "in_flight", "submitted", "batches"):
+            yield (key,), stats[key]
+
+REGISTRY.register(Gauge("ttc_model_info", "Model version currently serving requests", model_info_metric,
+                        ("version", "base_version")))
+REGISTRY.register(Gauge("ttc_cache_requests", "Response cache lookups by result since the cache was last cleared",
+                        cache_metric, ("cache", "result")))
+def request_log_metric():
+    if request_log is not None:
+        stats = request_log.stats()
+        for key in ("logged", "written", "dropped", "buffered", "buffered_bytes", "rotations", "write_errors"):
+            yield (key,), stats[key]
+
+REGISTRY.register(Gauge("ttc_request_log", "Request log entries by state", request_log_metric, ("stat",)))
+def live_updates_metric():
+    stats = broadcaster.stats()
+    for key in ("subscribers", "topics", "snapshots", "diffs", "events_sent", "resyncs"):
+        yield (key,), stats[key]
+
+REGISTRY.register(Gauge("ttc_live_updates", "Live prediction stream subscribers, topics and event counters",
+                        live_updates_metric, ("stat",)))
+def admission_metric():
+    if not USE_ADMISSION_CONTROL:
+        return
+    for admission in (model_admission, route_admission):
+        stats = admission.stats()
+        for key in ("active", "queue_depth", "admitted", "queued", "shed_queue_full", "shed_timeout"):
+            yield (admission.name, key), stats[key]
+
+REGISTRY.register(Gauge("ttc_admission", "Admission control occupancy, queue depth and shed counts by endpoint class",
+                        admission_metric, ("class", "stat")))
+REGISTRY.register(Gauge("ttc_micro_batch_queue", "Micro-batching queue depth and counters", micro_batch_metric, ("stat",)))
+
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus text-format metrics: per-stage timings, request latencies, batch sizes, cache hits and model version"""
+    return Response(content=REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 @app.get("/health")
 def health_check():
     """Health check endpoint"""
+    bundle = registry.current
     return {
         "status": "healthy",
-        "model_loaded": model is not None,
-        "encoders_loaded": encoders is not None
+        "model_loaded": bundle is not None,
+        "encoders_loaded": bundle is not None,
+        "model_version": bundle.version if bundle is not None else None,
+        "model_reloads": registry.reloads,
+        "probability_table_entries": bundle.probability_table.size if bundle is not None and bundle.probability_table is not None else 0,
+        "inference_queue": inference_batcher.stats() if inference_batcher is not None else None,
+        "online_learning": online_blender.stats() if online_blender is not None else None,
+        "request_log": request_log.stats() if request_log is not None else None,
+        "live_updates": broadcaster.stats(),
+        "admission": {admission.name: admission.stats() for admission in (model_admission, route_admission)}
+                     if USE_ADMISSION_CONTROL else None,
+        "inference_backend": bundle.inference_backend if bundle is not None else "inline",
+        "hourly_model": bundle.hourly if bundle is not None else None,
+        "flat_forest_nodes": bundle.flat_forest.node_count if bundle is not None and bundle.flat_forest is not None else 0
+    }
+
+@app.get("/ready")
+def readiness_check():
+    """Readiness probe: succeeds once a model version is loaded and warmed up"""
+    bundle = registry.current
+    if bundle is None:
+        raise HTTPException(status_code=503, detail=f"Model not ready: {registry.last_error or 'loading'}")
+    return {
+        "status": "ready",
+        "model_version": bundle.version,
+        "startup_seconds": startup_seconds,
+        "load_seconds": bundle.load_seconds,
+        "warm_up_seconds": bundle.warm_up_seconds
     }
 
 @app.get("/stations")
-def get_stations():
-    """Get all available stations"""
-    return {"stations": list(TTC_STATIONS.keys())}
+async def get_stations(request: Request, v: Optional[str] = None):
+    """Get all available stations, with their line and coordinates under "details"
+
+    Requested with the current version as v, as the web interface does, the
+    response may be cached indefinitely; a new version changes the URL.
+    """
+    asset = stations_asset()
+    return asset.response(request.headers, IMMUTABLE if v == asset.digest else None)
+
+def check_location(lat: float, lng: float):
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lng <= 180.0):
+        raise HTTPException(status_code=400, detail="lat must be between -90 and 90 and lng between -180 and 180")
+
+def station_summary(index: int) -> Dict:
+    return station_summaries[index]
+
+@app.get("/stations/nearest")
+async def get_nearest_stations(lat: float, lng: float, k: int = 5, max_km: Optional[float] = None):
+    """Get the k stations closest to a point, nearest first, optionally within max_km"""
+    check_location(lat, lng)
+    if not 1 <= k <= MAX_NEAREST_STATIONS:
+        raise HTTPException(status_code=400, detail=f"k must be between 1 and {MAX_NEAREST_STATIONS}")
+    nearest = station_index.nearest(lat, lng, k=k, max_km=max_km)
+    return {"stations": [dict(station_summary(index), distance_km=round(distance, 3)) for index, distance in nearest]}
+
+@app.get("/stations/within")
+async def get_stations_within(south: float, west: float, north: float, east: float):
+    """Get the stations inside a map viewport given as a latitude/longitude bounding box"""
+    check_location(south, west)
+    check_location(north, east)
+    if south > north or west > east:
+        raise HTTPException(status_code=400, detail="Bounding box needs south <= north and west <= east")
+    return {"stations": [station_summary(index) for index in station_index.within(south, west, north, east)]}
 
 @app.get("/lines")
 def get_lines():
     """Get all available lines"""
-    lines = list(set(station['line'] for station in TTC_STATIONS.values()))
-    return {"lines": lines}
+    return {"lines": station_lines}
+
+# Lines each station can be asked about: the lines the model may know it by, then the lines serving it
+station_candidate_lines = [list(dict.fromkeys(model_lines + tuple(serving)))
+                           for model_lines, serving in zip(station_registry.model_lines, station_registry.serving_lines())]
+
+@functools.lru_cache(maxsize=4)
+def predict_options(bundle: ModelBundle) -> Dict[str, List[str]]:
+    """Stations by line, for the (Line, Station) pairs this model version can score"""
+    encoder = bundle.category_encoder
+    options: Dict[str, List[str]] = {}
+    for name, station, lines in zip(station_registry.names.tolist(), bundle.station_codes.stations.tolist(),
+                                    station_candidate_lines):
+        if station == UNKNOWN:
+            continue
+        for line in lines:
+            if encoder.encode('Line', line) != UNKNOWN:
+                options.setdefault(line, []).append(name)
+    return options
+
+@app.get("/predict/options")
+def get_predict_options():
+    """Lines and their stations that /predict can score with the current model version"""
+    bundle = current_bundle()
+    return {"lines": predict_options(bundle), "model_version": bundle.version}
@@ -0,0 +1,261 @@
+"""
+Low-overhead metrics for the TTC Delay Prediction API
+Thread-safe counters, callback gauges and fixed-bucket histograms rendered in the
+Prometheus text exposition format, plus per-stage timers for the hot paths
+"""
+
+import asyncio
+import bisect
+import contextvars
+import functools
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from starlette.concurrency import run_in_threadpool
+
+# Set TTC_METRICS=0 to turn stage timers and request metrics into no-ops
+ENABLED = os.environ.get("TTC_METRICS", "1") != "0"
+
+# Seconds; spans a table lookup (~1us) to a large batch or slow route (~seconds)
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Rows per model call or batch request
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 16384, 65536)
+
+# Start of the current request, set by RequestMetricsMiddleware
+request_started: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("request_started", default=None)
+
+# End of the current request's last stage recorded by observe_request_stage(), in a list so that
+# the worker thread running a sync endpoint moves it for the request as a whole
+request_stage_mark: contextvars.ContextVar[Optional[List[float]]] = contextvars.ContextVar("request_stage_mark",
+                                                                                            default=None)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    """Monotonically increasing count per label set"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues: str, amount: float = 1.0):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = list(self._values.items())
+        lines += [f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}" for labels, value in values]
+        return lines
+
+
+class Gauge:
+    """Value per label set, read from a callback at scrape time"""
+
+    def __init__(self, name: str, documentation: str, collect: Callable[[], Iterable[Tuple[Sequence[str], float]]],
+                 labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        lines += [f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}" for labels, value in self.collect()]
+        return lines
+
+
+class Histogram:
+    """Fixed-bucket histogram per label set"""
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS,
+                 labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        # label values -> [per-bucket counts (last is +Inf), sum]
+        self._series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labelvalues: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def snapshot(self) -> Dict[Tuple[str, ...], Tuple[List[int], float]]:
+        """Per label set (per-bucket counts, sum)"""
+        with self._lock:
+            return {labels: (list(counts), total) for labels, (counts, total) in self._series.items()}
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in self.snapshot().items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total!r}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Collection of metrics rendered together"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines += metric.render()
+            except Exception as e:
+                lines.append(f"# {metric.name} unavailable: {_escape(e)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "ttc_stage_seconds", "Time spent in each hot-path stage", LATENCY_BUCKETS, ("stage",)))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "ttc_request_seconds", "End-to-end request time by route, method and status", LATENCY_BUCKETS,
+    ("route", "method", "status")))
+MODEL_BATCH_ROWS = REGISTRY.register(Histogram(
+    "ttc_model_batch_rows", "Rows per predict_proba call by evaluator", SIZE_BUCKETS, ("evaluator",)))
+EVENT_LOOP_LAG = REGISTRY.register(Histogram(
+    "ttc_event_loop_lag_seconds", "Delay of a periodic event-loop callback beyond its schedule", LATENCY_BUCKETS))
+TABLE_LOOKUPS = REGISTRY.register(Counter(
+    "ttc_probability_table_lookups_total", "Probability table lookups by result (hit or miss)", ("result",)))
+
+
+class _Stage:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        STAGE_SECONDS.observe(time.perf_counter() - self.start, self.name)
+        return False
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name: str):
+    """Context manager timing a block into ttc_stage_seconds{stage=name}"""
+    return _Stage(name) if ENABLED else _NULL_STAGE
+
+
+def observe_request_stage(name: str):
+    """Record the time since the start of the request, or since the stage last recorded this way, as a stage
+
+    Admission control records its queue wait as admission_wait, so a handler
+    calling this first thing records only the request parsing time: reading
+    the body, decoding JSON, routing and pydantic validation.
+    """
+    mark = request_stage_mark.get()
+    if ENABLED and mark is not None:
+        now = time.perf_counter()
+        STAGE_SECONDS.observe(now - mark[0], name)
+        mark[0] = now
+
+
+def timed_dispatch(endpoint: Callable) -> Callable:
+    """Run a sync endpoint in the threadpool from the event loop, recording request_parsing when the
+    request has been validated and threadpool_wait when a worker thread picks it up"""
+    def dispatched(*args, **kwargs):
+        observe_request_stage("threadpool_wait")
+        return endpoint(*args, **kwargs)
+
+    @functools.wraps(endpoint)
+    async def wrapper(*args, **kwargs):
+        observe_request_stage("request_parsing")
+        return await run_in_threadpool(dispatched, *args, **kwargs)
+    return wrapper
+
+
+class RequestMetricsMiddleware:
+    """Pure ASGI middleware timing every HTTP request by route template, method and status"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        token = request_started.set(start)
+        mark_token = request_stage_mark.set([start])
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            request_started.reset(token)
+            request_stage_mark.reset(mark_token)
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            REQUEST_SECONDS.observe(time.perf_counter() - start, route, scope["method"], str(status[0]))
+
+
+async def monitor_event_loop(interval: float = 0.25):
+    """Record how late the event loop runs a callback scheduled every `interval` seconds"""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - expected))
@@ -0,0 +1,450 @@
+"""
+Versioned model loading and hot-swapping for the TTC Delay Prediction API
+A ModelBundle holds one model version and everything derived from it; the
+ModelRegistry builds and warms new bundles in the background and publishes
+them with a single reference swap, so in-flight requests are never dropped
+"""
+
+import copy
+import hashlib
+import os
+import pickle
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+from category_encoding import CategoryEncoder, UNKNOWN
+from metrics import MODEL_BATCH_ROWS, TABLE_LOOKUPS, stage
+from probability_table import (ProbabilityTable, RiskSurface, FEATURES, DAYS_OF_WEEK, HOURS_OF_DAY, MAX_TABLE_ROWS,
+                               model_features, with_hours)
+from process_pool import ProcessInference, as_frame
+from tree_ensemble import FlatForest, MAX_FLAT_ROWS, PARITY_ROWS, check_parity
+
+
+class ModelBundle:
+    """One loaded model version plus its encoder, lookup table and evaluators
+
+    Bundles are fully built before they are published and never mutated
+    afterwards, so a request keeps a consistent view even if a newer version
+    is swapped in while it runs. Derived bundles (see derive()) share their
+    base bundle's model and worker pool.
+    """
+
+    def __init__(self, model, encoders, version: str, model_path: str, use_probability_table: bool = True,
+                 use_flat_forest: bool = True, inference_backend: str = "inline",
+                 inference_workers: Optional[int] = None, max_table_rows: int = MAX_TABLE_ROWS):
+        self.model = model
+        self.encoders = encoders
+        self.version = version
+        self.model_path = model_path
+        self.loaded_at = time.time()
+        self.load_seconds = 0.0
+        self.warm_up_seconds = 0.0
+        self.route_planner = None  # attached by the API before the bundle is published
+        self.station_codes = None  # likewise; derived bundles keep their base's
+        self.base = self  # bundle that owns the model and worker pool
+
+        # Plain dict mappings so requests never call LabelEncoder.transform
+        self.category_encoder = CategoryEncoder(encoders)
+
+        # Models trained with an Hour feature score day-level rows as the average over the day's hours
+        self.features = model_features(model)
+        self.hourly = len(self.features) > len(FEATURES)
+
+        # Score every known input combination once so requests become array lookups; an hourly
+        # model is scored for every hour of the week and its day-level table derived from that
+        self.probability_table = None
+        self.risk_surface = None
+        if use_probability_table and self.grid_rows() > max_table_rows:
+            print(f"Warning: Probability table would score {self.grid_rows()} rows (limit {max_table_rows}), "
+                  "using live inference")
+        elif use_probability_table:
+            try:
+                if self.hourly:
+                    self.risk_surface = RiskSurface.from_model(model, self.category_encoder)
+                self.probability_table = ProbabilityTable(model, self.category_encoder, surface=self.risk_surface)
+                if self.risk_surface is None:
+                    self.risk_surface = RiskSurface.from_table(self.probability_table)
+            except Exception as e:
+                print(f"Warning: Could not build probability table, using live inference: {e}")
+                self.risk_surface = None
+
+        # Compile the forest to flat arrays for low-latency scoring of small batches
+        self.flat_forest = None
+        if use_flat_forest:
+            try:
+                self.flat_forest = FlatForest(model)
+                difference = check_parity(model, self.flat_forest, self.sample_rows(PARITY_ROWS))
+                if difference > 1e-9:
+                    print(f"Warning: Flat forest disagrees with the model (max difference {difference:.2e}), using sklearn")
+                    self.flat_forest = None
+            except Exception as e:
+                print(f"Warning: Could not compile flat forest, using sklearn: {e}")
+                self.flat_forest = None
+
+        self.process_inference = None
+        if inference_backend == "process":
+            try:
+                # Workers need the compiled forest even when small batches are scored with sklearn
+                forest = self.flat_forest
+                if forest is None:
+                    forest = FlatForest(model)
+                    difference = check_parity(model, forest, self.sample_rows(PARITY_ROWS))
+                    if difference > 1e-9:
+                        raise ValueError(f"flat forest disagrees with the model (max difference {difference:.2e})")
+                self.process_inference = ProcessInference(model, forest, self.features, inference_workers)
+            except Exception as e:
+                print(f"Warning: Could not start inference worker pool, scoring in-process: {e}")
+
+    @classmethod
+    def load(cls, model_path: str, encoders_path: str, version: str, **options) -> "ModelBundle":
+        """Unpickle an artifact pair and build a bundle from it"""
+        start = time.perf_counter()
+        with open(model_path, "rb") as f:
+            model = pickle.load(f)
+        with open(encoders_path, "rb") as f:
+            encoders = pickle.load(f)
+        bundle = cls(model, encoders, version, model_path, **options)
+        bundle.load_seconds = time.perf_counter() - start
+        return bundle
+
+    def derive(self, probability_table: ProbabilityTable, version: str) -> "ModelBundle":
+        """Copy of this bundle serving another probability table, sharing the model, worker pool and route planner"""
+        bundle = copy.copy(self)
+        bundle.probability_table = probability_table
+        # A day-level model's surface follows its table; an hourly model's stays as the model scored it
+        if not self.hourly and self.risk_surface is not None:
+            bundle.risk_surface = RiskSurface.from_table(probability_table)
+        bundle.version = version
+        bundle.loaded_at = time.time()
+        return bundle
+
+    def encoded_grid(self, days: int = DAYS_OF_WEEK) -> np.ndarray:
+        """Every encoded (Line, Station, Code, DayOfWeek) row for the first `days` days"""
+        encoder = self.category_encoder
+        sizes = [encoder.size('Line'), encoder.size('Station'), encoder.size('Code'), days]
+        return np.indices(sizes).reshape(len(sizes), -1).T
+
+    def grid_shape(self, days: int = DAYS_OF_WEEK) -> Tuple[int, ...]:
+        """Shape of every encoded input combination in the model's layout, with an Hour axis for an hourly model"""
+        encoder = self.category_encoder
+        shape = (encoder.size('Line'), encoder.size('Station'), encoder.size('Code'), days)
+        return shape + (HOURS_OF_DAY,) if self.hourly else shape
+
+    def grid_rows(self) -> int:
+        """Number of model rows scored to precompute the probability table (or risk surface)"""
+        return int(np.prod(self.grid_shape()))
+
+    def sample_rows(self, count: int) -> np.ndarray:
+        """Up to count evenly strided rows of the full grid in the model's layout, without building the grid"""
+        shape = self.grid_shape()
+        total = int(np.prod(shape))
+        flat = np.unique(np.linspace(0, total - 1, min(count, total)).astype(np.int64))
+        return np.column_stack(np.unravel_index(flat, shape))
+
+    def model_rows(self, X: np.ndarray) -> np.ndarray:
+        """Encoded day-level rows in the model's layout: expanded to one row per hour for an hourly model"""
+        return with_hours(X) if self.hourly and X.shape[1] == len(FEATURES) else X
+
+    @property
+    def inference_backend(self) -> str:
+        """Backend currently serving large model calls"""
+        return "process" if self.process_inference is not None and not self.process_inference.broken else "inline"
+
+    def predict_proba(self, X: np.ndarray) -> np.ndarray:
+        """Run predict_proba on encoded rows using the fastest available evaluator
+
+        An hourly model also accepts day-level rows, which are scored at every
+        hour of the day and averaged.
+        """
+        expanded = self.model_rows(X)
+        if expanded is not X:
+            proba = self.predict_proba(expanded)
+            return proba.reshape(len(X), HOURS_OF_DAY, proba.shape[1]).mean(axis=1)
+
+        if self.flat_forest is not None and len(X) <= MAX_FLAT_ROWS:
+            evaluator, predict = "flat_forest", self.flat_forest.predict_proba
+        elif self.process_inference is not None:
+            evaluator, predict = self.inference_backend, self.process_inference.predict_proba
+        else:
+            evaluator, predict = "sklearn", lambda rows: self.model.predict_proba(as_frame(rows, self.features))
+        MODEL_BATCH_ROWS.observe(len(X), evaluator)
+        with stage("predict_proba"):
+            return predict(X)
+
+    def score_encoded(self, line: int, station: int, code: int, day_of_week: int) -> Tuple[int, float]:
+        """Return (prediction, probability) for encoded categories, using the lookup table when it covers them"""
+        if self.probability_table is not None:
+            result = self.probability_table.lookup_encoded(line, station, code, day_of_week)
+            if result is not None:
+                return result
+
+        # Fall back to live inference; predict() is just the argmax of predict_proba()
+        proba = self.predict_proba(np.array([[line, station, code, day_of_week]]))[0]
+        return int(self.model.classes_[np.argmax(proba)]), float(proba[1])
+
+    def score_scenario(self, line: str, station: str, code: str, day_of_week: int) -> Tuple[int, float]:
+        """Return (prediction, probability); raises ValueError for categories the model has not seen"""
+        encoded = self.category_encoder.encode_row(line, station, code)
+        if UNKNOWN in encoded:
+            raise ValueError(self.category_encoder.unknown_error(line, station, code))
+        return self.score_encoded(*encoded, day_of_week)
+
+    def hourly_probabilities(self, lines: np.ndarray, stations: np.ndarray, codes: np.ndarray,
+                             days: np.ndarray) -> np.ndarray:
+        """Delay probability at every hour of the day for already-encoded rows, shaped (rows, 24)
+
+        Read from the risk surface when there is one; otherwise the rows are
+        scored live in a single model call.
+        """
+        if self.risk_surface is not None and ((days >= 0) & (days < self.risk_surface.days)).all():
+            with stage("table_lookup"):
+                return self.risk_surface.hours(lines, stations, codes, days)
+        X = np.column_stack([lines, stations, codes, days])
+        if not self.hourly:
+            return np.repeat(self.predict_proba(X)[:, 1:2], HOURS_OF_DAY, axis=1)
+        return self.predict_proba(with_hours(X))[:, 1].reshape(len(X), HOURS_OF_DAY)
+
+    def score_batch(self, lines: List[str], stations: List[str], codes: List[str],
+                    days: List[int]) -> Tuple[np.ndarray, np.ndarray, List[Optional[str]]]:
+        """Score many scenarios at once, returning (predictions, probabilities, errors)
+
+        Rows with an error have no meaningful prediction or probability.
+        """
+        n = len(days)
+        days = np.asarray(days, dtype=np.int64)
+        errors = [None] * n
+
+        # Encode each column in one pass, recording the first unknown value per row
+        valid = np.ones(n, dtype=bool)
+        encoded = {}
+        with stage("encode"):
+            for column, values in (("Line", lines), ("Station", stations), ("Code", codes)):
+                encoded[column] = self.category_encoder.encode_many(column, values)
+                known = encoded[column] != UNKNOWN
+                for i in np.flatnonzero(valid & ~known):
+                    errors[i] = f"Unknown {column}: {values[i]!r}"
+                valid &= known
+            in_range = (days >= 0) & (days < DAYS_OF_WEEK)
+            for i in np.flatnonzero(valid & ~in_range):
+                errors[i] = f"DayOfWeek must be between 0 and {DAYS_OF_WEEK - 1}: {days[i]}"
+            valid &= in_range
+
+        predictions, probabilities = self.score_encoded_batch(encoded['Line'], encoded['Station'], encoded['Code'], days, valid)
+        return predictions, probabilities, errors
+
+    def score_encoded_batch(self, lines: np.ndarray, stations: np.ndarray, codes: np.ndarray, days: np.ndarray,
+                            valid: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """score_batch() for already-encoded columns, returning (predictions, probabilities)
+
+        Only rows where valid is True are scored; the others are left at zero.
+        """
+        n = len(days)
+        predictions = np.zeros(n, dtype=np.int64)
+        probabilities = np.zeros(n, dtype=np.float64)
+        encoded = {'Line': lines, 'Station': stations, 'Code': codes}
+
+        pending = valid
+        if self.probability_table is not None and valid.any():
+            with stage("table_lookup"):
+                rows = np.flatnonzero(valid)
+                covered, table_predictions, table_probabilities = self.probability_table.lookup_batch(
+                    encoded['Line'][rows], encoded['Station'][rows], encoded['Code'][rows], days[rows])
+                predictions[rows[covered]] = table_predictions
+                probabilities[rows[covered]] = table_probabilities
+                pending = valid.copy()
+                pending[rows[covered]] = False
+            hits = int(covered.sum())
+            TABLE_LOOKUPS.inc("hit", amount=hits)
+            TABLE_LOOKUPS.inc("miss", amount=len(rows) - hits)
+
+        # Everything the table does not cover goes through the forest in a single call
+        if pending.any():
+            X = np.column_stack([encoded['Line'][pending], encoded['Station'][pending], encoded['Code'][pending], days[pending]])
+            proba = self.predict_proba(X)
+            predictions[pending] = self.model.classes_[proba.argmax(axis=1)]
+            probabilities[pending] = proba[:, 1]
+
+        return predictions, probabilities
+
+    def warm_up(self) -> float:
+        """Push a batch through every scoring path so the first request pays no lazy initialization
+
+        Returns the seconds taken, which are also kept as warm_up_seconds.
+        """
+        start = time.perf_counter()
+        grid = self.encoded_grid()
+        sample = grid[:: max(1, len(grid) // 8)]
+        self.model.predict_proba(as_frame(self.model_rows(sample), self.features))
+        self.predict_proba(sample)
+        self.score_encoded(*sample[0])
+        self.hourly_probabilities(*sample.T)
+        self.score_batch(self.category_encoder.decode('Line', sample[:, 0]).tolist(),
+                         self.category_encoder.decode('Station', sample[:, 1]).tolist(),
+                         self.category_encoder.decode('Code', sample[:, 2]).tolist(), sample[:, 3].tolist())
+        if self.process_inference is not None:
+            rows = self.sample_rows(self.process_inference.min_rows)
+            self.process_inference.predict_proba(np.resize(rows, (self.process_inference.min_rows, rows.shape[1])))
+        self.warm_up_seconds = time.perf_counter() - start
+        return self.warm_up_seconds
+
+    def close(self):
+        """Release resources held by a bundle that is no longer published"""
+        if self.base is self and self.process_inference is not None:
+            self.process_inference.close(wait=True)
+
+
+class ModelRegistry:
+    """Finds versioned artifact pairs, loads them and atomically publishes the newest
+
+    Versions live in model_dir/<version>/ as a pair of files named like the
+    default artifacts. Without any versioned directory the default artifact pair
+    is served, versioned by a hash of its contents.
+    """
+
+    def __init__(self, model_dir: str, model_path: str, encoders_path: str,
+                 prepare: Optional[Callable[[ModelBundle], None]] = None,
+                 on_swap: Optional[Callable[[ModelBundle], None]] = None, **bundle_options):
+        self.model_dir = model_dir
+        self.model_path = model_path
+        self.encoders_path = encoders_path
+        self.prepare = prepare
+        self.on_swap = on_swap
+        self.bundle_options = bundle_options
+        self.current: Optional[ModelBundle] = None
+        self.last_error: Optional[str] = None
+        self.reloads = 0
+        # Newest artifact version seen when a version was last loaded; the watcher only acts on newer ones
+        self.newest_seen: Optional[str] = None
+        # Version an operator explicitly loaded while a newer one existed (a rollback); the watcher leaves it be
+        self.pinned_version: Optional[str] = None
+        self._load_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._watcher: Optional[threading.Thread] = None
+        self._default_signature = None
+        self._default_version = None
+
+    def available(self) -> List[Tuple[str, str, str]]:
+        """(version, model path, encoders path) for every complete artifact pair, oldest first"""
+        versions = []
+        if os.path.isdir(self.model_dir):
+            for name in sorted(os.listdir(self.model_dir)):
+                model_path = os.path.join(self.model_dir, name, os.path.basename(self.model_path))
+                encoders_path = os.path.join(self.model_dir, name, os.path.basename(self.encoders_path))
+                if os.path.isfile(model_path) and os.path.isfile(encoders_path):
+                    versions.append((name, model_path, encoders_path))
+        if not versions and os.path.isfile(self.model_path) and os.path.isfile(self.encoders_path):
+            versions.append((self._default_artifact_version(), self.model_path, self.encoders_path))
+        return versions
+
+    def _default_artifact_version(self) -> str:
+        """Content hash of the default artifact pair, recomputed only when the files change"""
+        signature = tuple((os.path.getmtime(path), os.path.getsize(path)) for path in (self.model_path, self.encoders_path))
+        if signature != self._default_signature:
+            digest = hashlib.sha256()
+            for path in (self.model_path, self.encoders_path):
+                with open(path, "rb") as f:
+                    digest.update(f.read())
+            self._default_signature = signature
+            self._default_version = digest.hexdigest()[:12]
+        return self._default_version
+
+    def load(self, version: Optional[str] = None) -> ModelBundle:
+        """Build, warm and publish a version (the newest by default)
+
+        Loading a version older than the newest available pins it: the watcher
+        will not replace it until the newest version is loaded again. Raises
+        FileNotFoundError if no matching artifact pair exists.
+        """
+        with self._load_lock:
+            available = self.available()
+            versions = available
+            if version is not None:
+                versions = [entry for entry in versions if entry[0] == version]
+            if not versions:
+                raise FileNotFoundError(f"Model version not found: {version}" if version else "No model artifacts found")
+            name, model_path, encoders_path = versions[-1]
+            pinned = name if name != available[-1][0] else None
+            if self.current is not None and self.current.base.version == name:
+                self.newest_seen, self.pinned_version = available[-1][0], pinned
+                return self.current
+
+            bundle = ModelBundle.load(model_path, encoders_path, name, **self.bundle_options)
+            if self.prepare is not None:
+                self.prepare(bundle)
+
+            previous, self.current = self.current, bundle
+            self.newest_seen, self.pinned_version = available[-1][0], pinned
+            self.reloads += previous is not None
+            self.last_error = None
+            if self.on_swap is not None:
+                self.on_swap(bundle)
+
+        # Requests still holding the old bundle keep working; it only loses its worker pool
+        if previous is not None:
+            previous.base.close()
+        return bundle
+
+    def publish(self, bundle: ModelBundle) -> bool:
+        """Prepare and publish a bundle derived from the current model version
+
+        Returns False without publishing if another version was loaded meanwhile.
+        """
+        with self._load_lock:
+            if self.current is None or self.current.base is not bundle.base:
+                return False
+            if self.prepare is not None:
+                self.prepare(bundle)
+            self.current = bundle
+            if self.on_swap is not None:
+                self.on_swap(bundle)
+        return True
+
+    def watch(self, interval: float):
+        """Poll for newly published artifacts every `interval` seconds in a daemon thread
+
+        Only a version newer than any seen at the last load is picked up, and
+        nothing is while a rolled-back version is pinned.
+        """
+        if self._stop.is_set():
+            return
+
+        def poll():
+            while not self._stop.wait(interval):
+                try:
+                    versions = self.available()
+                    if versions and self.pinned_version is None and (
+                            self.current is None or versions[-1][0] != self.newest_seen):
+                        bundle = self.load()
+                        print(f"Loaded model version {bundle.version}")
+                except Exception as e:
+                    self.last_error = str(e)
+                    print(f"Warning: Model reload failed, still serving the previous version: {e}")
+
+        self._watcher = threading.Thread(target=poll, name="model-registry-watch", daemon=True)
+        self._watcher.start()
+
+    def stop(self):
+        """Stop watching for new artifacts"""
+        self._stop.set()
+
+    def close(self):
+        """Stop watching and release the published bundle"""
+        self.stop()
+        with self._load_lock:
+            bundle, self.current = self.current, None
+        if bundle is not None:
+            bundle.base.close()
+
+    def status(self) -> Dict:
+        """Current version and reload bookkeeping"""
+        return {
+            "current_version": self.current.version if self.current is not None else None,
+            "base_version": self.current.base.version if self.current is not None else None,
+            "loaded_at": self.current.loaded_at if self.current is not None else None,
+            "available_versions": [version for version, _, _ in self.available()],
+            "pinned_version": self.pinned_version,
+            "reloads": self.reloads,
+            "watching": self._watcher is not None and self._watcher.is_alive(),
+            "last_error": self.last_error
+        }
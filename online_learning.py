@@ -0,0 +1,242 @@
+"""
+Online learning from observed delay events for the TTC Delay Prediction API
+Ingested events are kept as decaying per-cell counts in dense arrays shaped like
+the probability table, and a background thread periodically publishes a copy of
+the current model whose table blends the forest's probabilities with them
+"""
+
+import json
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from category_encoding import CategoryEncoder, CATEGORICAL_COLUMNS, UNKNOWN
+from probability_table import DAYS_OF_WEEK
+
+EVENT_FIELDS = ['Line', 'Station', 'Code', 'DayOfWeek', 'MajorDelay']
+
+# Rows parsed per step when loading a JSONL file
+JSONL_CHUNK_ROWS = 10000
+
+# Largest probability change in any cell that makes a blend worth publishing
+MIN_BLEND_CHANGE = 0.001
+
+
+class EventCounts:
+    """Exponentially decaying event and major-delay counts per (Line, Station, Code, DayOfWeek) cell"""
+
+    def __init__(self, encoder: CategoryEncoder, half_life_hours: float = 24.0, days: int = DAYS_OF_WEEK):
+        self.encoder = encoder
+        self.days = days
+        self.half_life = half_life_hours * 3600.0
+        shape = (encoder.size('Line'), encoder.size('Station'), encoder.size('Code'), days)
+        self.events = np.zeros(shape, dtype=np.float64)
+        self.delays = np.zeros(shape, dtype=np.float64)
+        self.accepted = 0
+        self.rejected = 0
+        self.changes = 0
+        self._decayed_at = time.time()
+        self._lock = threading.Lock()
+
+    def _decay(self, now: float):
+        if self.half_life > 0:
+            factor = 0.5 ** ((now - self._decayed_at) / self.half_life)
+            self.events *= factor
+            self.delays *= factor
+        self._decayed_at = now
+
+    def add(self, lines: List[str], stations: List[str], codes: List[str], days: List[int],
+            major_delays: List[int]) -> List[Optional[str]]:
+        """Count a batch of events; returns an error per row, None for rows that were counted"""
+        n = len(days)
+        days = np.asarray(days, dtype=np.int64)
+        major_delays = np.asarray(major_delays, dtype=np.int64)
+        errors = [None] * n
+
+        valid = np.ones(n, dtype=bool)
+        encoded = {}
+        for column, values in zip(CATEGORICAL_COLUMNS, (lines, stations, codes)):
+            encoded[column] = self.encoder.encode_many(column, values)
+            known = encoded[column] != UNKNOWN
+            for i in np.flatnonzero(valid & ~known):
+                errors[i] = f"Unknown {column}: {values[i]!r}"
+            valid &= known
+        for i in np.flatnonzero(valid & ((days < 0) | (days >= self.days))):
+            errors[i] = f"DayOfWeek must be between 0 and {self.days - 1}"
+        valid &= (days >= 0) & (days < self.days)
+        for i in np.flatnonzero(valid & ((major_delays < 0) | (major_delays > 1))):
+            errors[i] = "MajorDelay must be 0 or 1"
+        valid &= (major_delays >= 0) & (major_delays <= 1)
+
+        index = (encoded['Line'][valid], encoded['Station'][valid], encoded['Code'][valid], days[valid])
+        with self._lock:
+            self._decay(time.time())
+            np.add.at(self.events, index, 1.0)
+            np.add.at(self.delays, index, major_delays[valid].astype(np.float64))
+            accepted = int(valid.sum())
+            self.accepted += accepted
+            self.rejected += n - accepted
+            self.changes += accepted > 0
+        return errors
+
+    def add_records(self, records: Iterable[Dict]) -> List[Optional[str]]:
+        """add() for an iterable of event dicts"""
+        records = list(records)
+        columns = [[record.get(field) for record in records] for field in EVENT_FIELDS]
+        return self.add(*columns)
+
+    def load_jsonl(self, lines: Iterable[str]) -> Tuple[int, int]:
+        """Count events from JSONL text, one event object per line; returns (accepted, rejected)
+
+        Blank lines are skipped and lines that are not valid events are rejected.
+        """
+        accepted = rejected = malformed = 0
+        chunk = []
+
+        def flush():
+            nonlocal accepted, rejected
+            failed = sum(error is not None for error in self.add_records(chunk))
+            rejected += failed
+            accepted += len(chunk) - failed
+            chunk.clear()
+
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict) or any(field not in record for field in EVENT_FIELDS):
+                    raise ValueError(line)
+                record['DayOfWeek'] = int(record['DayOfWeek'])
+                record['MajorDelay'] = int(record['MajorDelay'])
+            except (ValueError, TypeError):
+                malformed += 1
+                continue
+            chunk.append(record)
+            if len(chunk) >= JSONL_CHUNK_ROWS:
+                flush()
+        if chunk:
+            flush()
+        with self._lock:
+            self.rejected += malformed
+        return accepted, rejected + malformed
+
+    def snapshot(self) -> Tuple[np.ndarray, np.ndarray, int]:
+        """Decayed (events, delays) copies and the change counter they reflect"""
+        with self._lock:
+            self._decay(time.time())
+            return self.events.copy(), self.delays.copy(), self.changes
+
+    def remap(self, encoder: CategoryEncoder):
+        """Re-index the counts for another model's encoder; cells it does not know are dropped"""
+        with self._lock:
+            shape = (encoder.size('Line'), encoder.size('Station'), encoder.size('Code'), self.days)
+            events = np.zeros(shape, dtype=np.float64)
+            delays = np.zeros(shape, dtype=np.float64)
+            source, target = [], []
+            for column in CATEGORICAL_COLUMNS:
+                new = encoder.encode_many(column, self.encoder.classes[column])
+                keep = new != UNKNOWN
+                source.append(np.flatnonzero(keep))
+                target.append(new[keep])
+            events[np.ix_(*target, np.arange(self.days))] = self.events[np.ix_(*source, np.arange(self.days))]
+            delays[np.ix_(*target, np.arange(self.days))] = self.delays[np.ix_(*source, np.arange(self.days))]
+            self.encoder, self.events, self.delays = encoder, events, delays
+            self.changes += 1
+
+    def stats(self) -> Dict:
+        """Ingestion counters and the decayed number of events currently held"""
+        with self._lock:
+            return {
+                "accepted": self.accepted,
+                "rejected": self.rejected,
+                "weighted_events": float(self.events.sum()),
+                "half_life_hours": self.half_life / 3600.0
+            }
+
+
+class OnlineBlender:
+    """Periodically publishes the current model with its probability table blended with event counts
+
+    A blend is only published when it moves some cell's probability by at
+    least min_change from the table being served, since every publish clears
+    the response caches and pushes updates to live streams. Counts keep
+    decaying after events stop arriving, so blends are re-evaluated every
+    interval while decay can still move the served table that far.
+    """
+
+    def __init__(self, registry, counts: EventCounts, interval: float = 60.0, prior_weight: float = 20.0,
+                 min_change: float = MIN_BLEND_CHANGE):
+        self.registry = registry
+        self.counts = counts
+        self.interval = interval
+        self.prior_weight = prior_weight
+        self.min_change = min_change
+        self.blends = 0
+        self.last_blend_at: Optional[float] = None
+        # The current model already reflects zero events
+        self._blended_changes = 0
+        # Largest difference between the served table and its base's; decay moves every cell towards the base
+        self._served_gap = 0.0
+        self._blended_base = registry.current.base if registry.current is not None else None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def blend(self):
+        """Publish a blended copy of the current model if the counts or the model changed since the last blend,
+        or decay may have moved it, and the blend differs from the served table by at least min_change"""
+        bundle = self.registry.current
+        if bundle is None or bundle.base.probability_table is None:
+            return None
+        base = bundle.base
+        if self.counts.encoder is not base.category_encoder:
+            self.counts.remap(base.category_encoder)
+
+        events, delays, changes = self.counts.snapshot()
+        decaying = self.counts.half_life > 0 and self._served_gap > self.min_change
+        if changes == self._blended_changes and base is self._blended_base and not decaying:
+            return None
+
+        table = base.probability_table.blend(events, delays, self.prior_weight)
+        if base is self._blended_base and bundle.probability_table is not None:
+            moved = float(np.abs(table.probabilities - bundle.probability_table.probabilities).max(initial=0.0))
+            if moved < self.min_change:
+                self._blended_changes = changes
+                return None
+        blended = base.derive(table, f"{base.version}+online.{self.blends + 1}")
+        if self.registry.publish(blended):
+            self.blends += 1
+            self._blended_changes, self._blended_base = changes, base
+            self._served_gap = float(np.abs(table.probabilities - base.probability_table.probabilities).max(initial=0.0))
+            self.last_blend_at = time.time()
+            return blended
+        return None
+
+    def start(self):
+        """Blend every interval seconds in a daemon thread"""
+        def run():
+            while not self._stop.wait(self.interval):
+                try:
+                    self.blend()
+                except Exception as e:
+                    print(f"Warning: Online blending failed, still serving the previous table: {e}")
+
+        self._thread = threading.Thread(target=run, name="online-blender", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop blending"""
+        self._stop.set()
+
+    def stats(self) -> Dict:
+        """Counts, blend bookkeeping and settings"""
+        stats = self.counts.stats()
+        stats.update({
+            "blends": self.blends,
+            "last_blend_at": self.last_blend_at,
+            "blend_interval_seconds": self.interval,
+            "prior_weight": self.prior_weight,
+            "min_change": self.min_change
+        })
+        return stats
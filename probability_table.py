@@ -0,0 +1,171 @@
+"""
+Precomputed delay-probability lookup tables for the TTC Delay Prediction API
+Every (Line, Station, Code, DayOfWeek) combination the encoders know about is
+scored once with a single batched predict_proba call at model load, and every
+hour of every day too for models trained with an Hour feature
+"""
+
+import copy
+import os
+from typing import List, Optional, Tuple
+import numpy as np
+from category_encoding import CategoryEncoder, UNKNOWN
+
+FEATURES = ['Line', 'Station', 'Code', 'DayOfWeek']
+HOURLY_FEATURES = FEATURES + ['Hour']
+DAYS_OF_WEEK = 7
+HOURS_OF_DAY = 24
+
+# Rows scored per predict_proba call when building a risk surface; bounds its working memory
+SURFACE_CHUNK_ROWS = 1_000_000
+
+# Most model rows scored at load to precompute a table or surface; larger grids use live inference
+MAX_TABLE_ROWS = 20_000_000
+
+# ProbabilityTable arrays written by save() and memory-mapped by load()
+TABLE_ARRAYS = ["classes", "probabilities", "predictions"]
+
+
+def model_features(model) -> List[str]:
+    """Feature columns a fitted model expects: FEATURES, or HOURLY_FEATURES if it was trained with Hour"""
+    names = getattr(model, "feature_names_in_", None)
+    if names is not None:
+        return HOURLY_FEATURES if "Hour" in list(names) else FEATURES
+    return HOURLY_FEATURES if getattr(model, "n_features_in_", len(FEATURES)) == len(HOURLY_FEATURES) else FEATURES
+
+
+def with_hours(rows: np.ndarray) -> np.ndarray:
+    """Encoded day-level rows repeated once per hour of the day, with the hour appended as a column"""
+    rows = np.asarray(rows)
+    hours = np.tile(np.arange(HOURS_OF_DAY, dtype=rows.dtype), len(rows))
+    return np.column_stack([np.repeat(rows, HOURS_OF_DAY, axis=0), hours])
+
+
+class ProbabilityTable:
+    """Dense Line x Station x Code x DayOfWeek table of model outputs
+
+    For an hourly model, pass its RiskSurface: each day's probability is then
+    the average over the hours of the day rather than a model call of its own.
+    """
+
+    def __init__(self, model, encoder: CategoryEncoder, days: int = DAYS_OF_WEEK,
+                 surface: Optional["RiskSurface"] = None):
+        self.encoder = encoder
+        self.days = days
+        self.classes = model.classes_
+
+        if surface is not None:
+            self.probabilities = surface.daily()
+            # Same tie-breaking as argmax over [P(no delay), P(delay)]
+            self.predictions = self.classes[(self.probabilities > 0.5).astype(np.intp)].astype(np.int64)
+            return
+
+        shape = (encoder.size('Line'), encoder.size('Station'), encoder.size('Code'), days)
+        grid = np.indices(shape).reshape(len(shape), -1).T
+        import pandas as pd
+        X = pd.DataFrame(grid, columns=FEATURES)
+
+        proba = model.predict_proba(X)
+        self.probabilities = proba[:, 1].reshape(shape)
+        self.predictions = model.classes_[proba.argmax(axis=1)].astype(np.int64).reshape(shape)
+
+    def blend(self, events: np.ndarray, delays: np.ndarray, prior_weight: float) -> "ProbabilityTable":
+        """New table mixing these probabilities with observed event counts of the same shape
+
+        The model's probability acts as prior_weight pseudo-events, so a cell
+        moves towards its observed delay rate as real events accumulate.
+        """
+        blended = copy.copy(self)
+        blended.probabilities = (self.probabilities * prior_weight + delays) / (prior_weight + events)
+        # Same tie-breaking as argmax over [P(no delay), P(delay)]
+        blended.predictions = self.classes[(blended.probabilities > 0.5).astype(np.intp)].astype(np.int64)
+        return blended
+
+    def save(self, directory: str):
+        """Write the table's arrays to directory as .npy files, for load() to memory-map"""
+        os.makedirs(directory, exist_ok=True)
+        for name in TABLE_ARRAYS:
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, directory: str, encoder: CategoryEncoder, mmap_mode: Optional[str] = "r") -> "ProbabilityTable":
+        """Table whose arrays are read from a save()d directory; memory-mapped read-only by default,
+        so every process loading the same directory shares one copy in the page cache"""
+        table = cls.__new__(cls)
+        table.encoder = encoder
+        for name in TABLE_ARRAYS:
+            setattr(table, name, np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode))
+        table.days = table.probabilities.shape[-1]
+        return table
+
+    @property
+    def size(self) -> int:
+        """Number of precomputed entries"""
+        return int(self.probabilities.size)
+
+    def lookup(self, line: str, station: str, code: str, day_of_week: int) -> Optional[Tuple[int, float]]:
+        """Return (prediction, probability), or None if the inputs are not covered"""
+        return self.lookup_encoded(*self.encoder.encode_row(line, station, code), day_of_week)
+
+    def lookup_encoded(self, line: int, station: int, code: int, day_of_week: int) -> Optional[Tuple[int, float]]:
+        """lookup() for already-encoded categories"""
+        if UNKNOWN in (line, station, code) or not 0 <= day_of_week < self.days:
+            return None
+        return int(self.predictions[line, station, code, day_of_week]), float(self.probabilities[line, station, code, day_of_week])
+
+    def lookup_batch(self, lines: np.ndarray, stations: np.ndarray, codes: np.ndarray,
+                     days: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Vectorized lookup of already-encoded rows
+
+        Returns (covered, predictions, probabilities); the last two only hold
+        values for rows where covered is True
+        """
+        covered = (days >= 0) & (days < self.days)
+        index = (lines[covered], stations[covered], codes[covered], days[covered])
+        return covered, self.predictions[index], self.probabilities[index]
+
+
+
+class RiskSurface:
+    """Dense Line x Station x Code x DayOfWeek x Hour array of delay probabilities
+
+    Built by scoring every hour of the week for a model trained with an Hour
+    feature; for a day-level model it is the probability table repeated across
+    the hours of each day, so it is flat within a day.
+    """
+
+    def __init__(self, probabilities: np.ndarray, hourly: bool):
+        self.probabilities = probabilities
+        self.hourly = hourly
+
+    @classmethod
+    def from_model(cls, model, encoder: CategoryEncoder, days: int = DAYS_OF_WEEK,
+                   chunk_rows: int = SURFACE_CHUNK_ROWS) -> "RiskSurface":
+        """Score every encoded (Line, Station, Code, DayOfWeek, Hour) combination with an hourly model"""
+        import pandas as pd
+        shape = (encoder.size('Line'), encoder.size('Station'), encoder.size('Code'), days, HOURS_OF_DAY)
+        # float32 halves the footprint; probabilities are averages of a few hundred tree votes at most
+        probabilities = np.empty(int(np.prod(shape)), dtype=np.float32)
+        for start in range(0, probabilities.size, chunk_rows):
+            flat = np.arange(start, min(start + chunk_rows, probabilities.size))
+            grid = np.column_stack(np.unravel_index(flat, shape))
+            probabilities[start:start + len(flat)] = model.predict_proba(pd.DataFrame(grid, columns=HOURLY_FEATURES))[:, 1]
+        return cls(probabilities.reshape(shape), hourly=True)
+
+    @classmethod
+    def from_table(cls, table: ProbabilityTable) -> "RiskSurface":
+        """Surface of a day-level model: a read-only view repeating each day's probability for every hour"""
+        probabilities = table.probabilities[..., None]
+        return cls(np.broadcast_to(probabilities, probabilities.shape[:-1] + (HOURS_OF_DAY,)), hourly=False)
+
+    @property
+    def days(self) -> int:
+        return self.probabilities.shape[3]
+
+    def daily(self) -> np.ndarray:
+        """Line x Station x Code x DayOfWeek probabilities averaged over the hours of each day"""
+        return self.probabilities.mean(axis=4, dtype=np.float64)
+
+    def hours(self, lines: np.ndarray, stations: np.ndarray, codes: np.ndarray, days: np.ndarray) -> np.ndarray:
+        """Probability for every hour of the day, one row per already-encoded (line, station, code, day)"""
+        return self.probabilities[lines, stations, codes, days].astype(np.float64)
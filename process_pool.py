@@ -0,0 +1,115 @@
+"""
+Process-pool inference backend for the TTC Delay Prediction API
+Large predict_proba calls are split across worker processes so one API instance
+can use every core instead of contending for the GIL in a single process. The
+workers score with the flattened forest, whose arrays the parent writes once
+and every worker memory-maps, so the model is held in memory a single time
+"""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional
+import numpy as np
+from metrics import stage
+from tree_ensemble import FlatForest
+
+# Batches smaller than this are cheaper to score in-process than to ship to a worker
+MIN_PROCESS_ROWS = 2048
+
+# Imported once in the forkserver, so workers forked from it start with NumPy and the evaluator loaded
+WORKER_PRELOAD = ["process_pool"]
+
+# Forest used inside a worker process, memory-mapped from the parent's arrays by _init_worker
+_worker_forest: Optional[FlatForest] = None
+
+
+def _init_worker(forest_dir: str):
+    global _worker_forest
+    _worker_forest = FlatForest.load(forest_dir, mmap_mode="r")
+
+
+def as_frame(values: np.ndarray, columns: List[str]):
+    """Encoded rows as the DataFrame the model was fitted on"""
+    # pandas is imported on first use so importing this module stays cheap
+    import pandas as pd
+    with stage("dataframe"):
+        return pd.DataFrame(values, columns=columns)
+
+
+def _predict_chunk(values: np.ndarray) -> np.ndarray:
+    return _worker_forest.predict_proba(values)
+
+
+def _ping(_=None) -> int:
+    return os.getpid()
+
+
+class ProcessInference:
+    """predict_proba executed across a pool of worker processes
+
+    forest is the model compiled to a FlatForest and checked against it; its
+    arrays are saved to a temporary directory that lives as long as the pool.
+    """
+
+    def __init__(self, model, forest: FlatForest, columns: List[str], workers: Optional[int] = None,
+                 min_rows: int = MIN_PROCESS_ROWS):
+        self.model = model
+        self.columns = columns
+        self.workers = workers or os.cpu_count() or 1
+        self.min_rows = min_rows
+        self.broken = False
+
+        # Pools are built after the server's threads exist (in the loader, reload or watcher thread),
+        # and forking a multithreaded process can deadlock a child on a lock another thread held.
+        # Workers are therefore forked from a single-threaded forkserver, or spawned where there is
+        # none; rather than each unpickling the model, they all map the same read-only arrays.
+        self.forest_dir = tempfile.mkdtemp(prefix="ttc-forest-")
+        try:
+            forest.save(self.forest_dir)
+            methods = multiprocessing.get_all_start_methods()
+            self.start_method = "forkserver" if "forkserver" in methods else "spawn"
+            context = multiprocessing.get_context(self.start_method)
+            if self.start_method == "forkserver":
+                context.set_forkserver_preload(WORKER_PRELOAD)
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=context,
+                initializer=_init_worker,
+                initargs=(self.forest_dir,)
+            )
+
+            # Start and map every worker now rather than on the first large request
+            list(self.pool.map(_ping, range(self.workers)))
+        except Exception:
+            shutil.rmtree(self.forest_dir, ignore_errors=True)
+            raise
+
+    def predict_proba(self, X: np.ndarray) -> np.ndarray:
+        """Score encoded rows across the pool, or in-process for small batches or a failed pool"""
+        if self.broken or len(X) < self.min_rows:
+            return self.model.predict_proba(as_frame(X, self.columns))
+
+        chunks = np.array_split(X, min(self.workers, -(-len(X) // self.min_rows)))
+        try:
+            futures = [self.pool.submit(_predict_chunk, chunk) for chunk in chunks]
+            return np.vstack([future.result() for future in futures])
+        except BrokenProcessPool as e:
+            print(f"Warning: Inference worker pool failed, falling back to in-process scoring: {e}")
+            self.broken = True
+            return self.model.predict_proba(as_frame(X, self.columns))
+        except RuntimeError:
+            # Pool was shut down after a model reload while this request was still running
+            self.broken = True
+            return self.model.predict_proba(as_frame(X, self.columns))
+
+    def close(self, wait: bool = False):
+        """Shut the worker pool down and remove the forest arrays; with wait, in-flight chunks finish first
+
+        Workers still running keep their mappings after the files are removed.
+        """
+        self.pool.shutdown(wait=wait, cancel_futures=not wait)
+        shutil.rmtree(self.forest_dir, ignore_errors=True)
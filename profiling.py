@@ -0,0 +1,293 @@
+"""
+Opt-in request profiling for the TTC Delay Prediction API
+When enabled, a request can ask to run under a deterministic (cProfile) or
+sampling profiler with a header or query flag, and a fraction of /predict and
+/route/optimize traffic can be profiled continuously into a profiles directory
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import cProfile
+import functools
+import json
+import marshal
+import os
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+from typing import Callable, Dict, Optional, Tuple
+from metrics import REGISTRY, Counter
+
+PROFILERS = ("cprofile", "sample")
+PROFILE_EXTENSIONS = {"cprofile": "prof", "sample": "collapsed"}
+
+# Paths whose requests are eligible for continuous sampling
+SAMPLED_PATHS = ("/predict", "/route/optimize")
+
+# Seconds between stack samples; best effort, since the sampler needs the GIL to run
+SAMPLE_INTERVAL = 0.001
+
+PROFILED_REQUESTS = REGISTRY.register(Counter(
+    "ttc_profiled_requests_total", "Requests run under a profiler by trigger and profiler", ("trigger", "profiler")))
+
+# cProfile hooks are interpreter-wide on newer Pythons, so only one runs at a time
+_cprofile_lock = threading.Lock()
+
+current_profile: contextvars.ContextVar[Optional["RequestProfile"]] = contextvars.ContextVar("current_profile", default=None)
+
+
+def is_profiling() -> bool:
+    """Whether the current request runs under a profiler"""
+    return current_profile.get() is not None
+
+
+class StackSampler:
+    """Counts collapsed stacks of one thread at a fixed interval from a background thread"""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.thread_id: Optional[int] = None
+        self.counts: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            thread_id = self.thread_id
+            frame = sys._current_frames().get(thread_id) if thread_id is not None else None
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class RequestProfile:
+    """Profiler for one request, shared by the middleware that starts it and the endpoint it profiles"""
+
+    def __init__(self, profiler: str):
+        self.profiler = profiler
+        self.profile = cProfile.Profile() if profiler == "cprofile" else None
+        self.sampler = StackSampler() if profiler == "sample" else None
+
+    @contextlib.contextmanager
+    def active(self):
+        """Profile the current thread for the duration of the block"""
+        if self.profile is not None:
+            self.profile.enable()
+            try:
+                yield
+            finally:
+                self.profile.disable()
+        else:
+            self.sampler.thread_id = threading.get_ident()
+            try:
+                yield
+            finally:
+                self.sampler.thread_id = None
+
+    async def run_coroutine(self, coroutine):
+        """Await a coroutine, profiling only while it runs and not while it waits on the event loop"""
+        value, error = None, None
+        while True:
+            with self.active():
+                try:
+                    awaited = coroutine.throw(error) if error is not None else coroutine.send(value)
+                except StopIteration as e:
+                    return e.value
+            try:
+                value, error = await _Suspend(awaited), None
+            except BaseException as e:
+                value, error = None, e
+
+    def finish(self) -> Tuple[bytes, str]:
+        """Stop profiling; returns (payload, media type)
+
+        cProfile output is a marshalled pstats dump readable by pstats, snakeviz
+        and similar tools; sampled output is collapsed stacks for flame graphs.
+        """
+        if self.profile is not None:
+            self.profile.create_stats()
+            return marshal.dumps(self.profile.stats), "application/octet-stream"
+        self.sampler.stop()
+        text = "".join(f"{stack} {count}\n" for stack, count in sorted(self.sampler.counts.items()))
+        return text.encode("utf-8"), "text/plain; charset=utf-8"
+
+
+class _Suspend:
+    """Hands a value yielded by a wrapped coroutine to the task driving run_coroutine()"""
+
+    def __init__(self, awaited):
+        self.awaited = awaited
+
+    def __await__(self):
+        return (yield self.awaited)
+
+
+def profiled(endpoint: Callable) -> Callable:
+    """Run an endpoint under the current request's profiler, if it has one
+
+    Sync endpoints are profiled in the worker thread they run in; async ones
+    only while their own code is running on the event loop.
+    """
+    if asyncio.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            profile = current_profile.get()
+            if profile is None:
+                return await endpoint(*args, **kwargs)
+            return await profile.run_coroutine(endpoint(*args, **kwargs))
+    else:
+        @functools.wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            profile = current_profile.get()
+            if profile is None:
+                return endpoint(*args, **kwargs)
+            with profile.active():
+                return endpoint(*args, **kwargs)
+    return wrapper
+
+
+def write_profile(directory: str, name: str, payload: bytes, max_files: int) -> str:
+    """Write a profile into directory and remove the oldest profiles beyond max_files; returns the path"""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name)
+    with open(path + ".tmp", "wb") as f:
+        f.write(payload)
+    os.replace(path + ".tmp", path)
+
+    if max_files > 0:
+        entries = [entry for entry in os.scandir(directory) if entry.is_file() and not entry.name.endswith(".tmp")]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:-max_files]:
+            with contextlib.suppress(OSError):
+                os.remove(entry.path)
+    return path
+
+
+class ProfilingMiddleware:
+    """ASGI middleware starting request profiles on demand or by sampling
+
+    On demand, an X-Profile header or profile query parameter names the
+    profiler ('cprofile' or 'sample'). With X-Profile-Output (or
+    profile_output) set to 'response', the default, the profile replaces the
+    response body and the original status is sent as X-Profiled-Status; with
+    'file' the response is untouched and the profile is written to the
+    profiles directory, named in an X-Profile-File header. Sampled requests
+    are always profiled with cProfile and written to the directory.
+    """
+
+    def __init__(self, app, on_demand: bool = False, sample_rate: float = 0.0, directory: str = "profiles",
+                 max_files: int = 200, authorize: Callable[[Optional[str]], bool] = lambda token: True):
+        self.app = app
+        self.on_demand = on_demand
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.max_files = max_files
+        self.authorize = authorize
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not (self.on_demand or self.sample_rate > 0):
+            await self.app(scope, receive, send)
+            return
+
+        headers = {key.decode("latin-1"): value.decode("latin-1") for key, value in scope["headers"]}
+        query = dict(urllib.parse.parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+        profiler = headers.get("x-profile") or query.get("profile")
+        output = headers.get("x-profile-output") or query.get("profile_output") or "response"
+
+        if profiler and self.on_demand:
+            if not self.authorize(headers.get("x-admin-token")):
+                await _send_text(send, 403, "Invalid admin token")
+                return
+            if profiler not in PROFILERS or output not in ("response", "file"):
+                await _send_text(send, 400, f"profile must be one of {', '.join(PROFILERS)} and profile_output "
+                                            "'response' or 'file'")
+                return
+            trigger = "on_demand"
+        elif scope["path"] in SAMPLED_PATHS and random.random() < self.sample_rate:
+            profiler, output, trigger = "cprofile", "file", "sampled"
+        else:
+            await self.app(scope, receive, send)
+            return
+
+        if profiler == "cprofile" and not _cprofile_lock.acquire(blocking=False):
+            if trigger == "sampled":
+                await self.app(scope, receive, send)
+            else:
+                await _send_text(send, 409, "Another request is being profiled with cprofile")
+            return
+
+        try:
+            await self._profile(scope, receive, send, profiler, output, trigger)
+        finally:
+            if profiler == "cprofile":
+                _cprofile_lock.release()
+
+    async def _profile(self, scope, receive, send, profiler: str, output: str, trigger: str):
+        profile = RequestProfile(profiler)
+        token = current_profile.set(profile)
+        start = time.perf_counter()
+        status = [500]
+        filename = [None]
+
+        async def send_profiled(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                if output == "file" and trigger == "on_demand":
+                    filename[0] = f"{profile_name(scope['path'], profiler)}.{PROFILE_EXTENSIONS[profiler]}"
+                    message = dict(message, headers=list(message.get("headers", [])) + [
+                        (b"x-profile-file", filename[0].encode("latin-1"))])
+            if output == "file":
+                await send(message)
+
+        try:
+            await self.app(scope, receive, send_profiled)
+        finally:
+            current_profile.reset(token)
+            payload, media_type = profile.finish()
+        PROFILED_REQUESTS.inc(trigger, profiler)
+
+        if output == "response":
+            await _send_bytes(send, 200, payload, media_type, [(b"x-profiled-status", str(status[0]).encode())])
+            return
+        # Sampled profiles carry their request time in the name so slow requests are easy to pick out
+        elapsed_ms = (time.perf_counter() - start) * 1000.0
+        name = filename[0] or f"{profile_name(scope['path'], profiler)}-{elapsed_ms:.0f}ms.{PROFILE_EXTENSIONS[profiler]}"
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, write_profile, self.directory, name, payload, self.max_files)
+        except OSError as e:
+            print(f"Warning: Could not write profile {name}: {e}")
+
+
+def profile_name(path: str, profiler: str) -> str:
+    """Sortable, unique-enough base name for a profile file"""
+    slug = re.sub(r"[^A-Za-z0-9]+", "_", path).strip("_") or "root"
+    stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime())
+    return f"{stamp}-{slug}-{profiler}-{os.getpid()}-{random.randrange(16 ** 6):06x}"
+
+
+async def _send_bytes(send, status: int, body: bytes, media_type: str, headers=()):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", media_type.encode("latin-1")),
+                    (b"content-length", str(len(body)).encode())] + list(headers)
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _send_text(send, status: int, detail: str):
+    await _send_bytes(send, status, json.dumps({"detail": detail}).encode("utf-8"), "application/json")
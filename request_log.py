@@ -0,0 +1,258 @@
+"""
+Buffered request logging for the TTC Delay Prediction API
+Handlers append entries to an in-memory buffer bounded by entries and by
+estimated bytes without blocking; a background thread serializes them and
+appends them to a JSONL file in batches, rotating it by size or age. Entries
+that arrive while the buffer is full are dropped and counted rather than making
+requests wait for the disk.
+"""
+
+import asyncio
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+from fastapi import HTTPException
+from metrics import request_started
+
+
+def estimate_size(value) -> int:
+    """Rough serialized size of an entry value in bytes
+
+    Sequences are sized from their first element, so the estimate costs the
+    same for a batch of a million rows as for one.
+    """
+    if value is None or isinstance(value, (bool, int, float)):
+        return 8
+    if isinstance(value, (bytes, str)):
+        return len(value) + 2
+    if isinstance(value, (list, tuple)):
+        return 2 + len(value) * (estimate_size(value[0]) + 2) if value else 2
+    if isinstance(value, dict):
+        return 2 + sum(len(str(key)) + 4 + estimate_size(item) for key, item in value.items())
+    if hasattr(value, "__dict__"):
+        # Pydantic models keep their fields in __dict__
+        return estimate_size(vars(value))
+    return len(str(value))
+
+
+def _json_default(value):
+    # Pydantic request models are converted here, off the request path
+    if hasattr(value, "dict"):
+        return value.dict()
+    return str(value)
+
+
+class RequestLog:
+    """Bounded buffer of request entries flushed to a rotating JSONL file by a daemon thread
+
+    The buffer holds at most buffer_size entries and buffer_bytes estimated
+    bytes (see estimate_size), so a burst of large batch requests cannot grow
+    it without bound.
+    """
+
+    def __init__(self, path: str, buffer_size: int = 10000, flush_seconds: float = 1.0,
+                 max_bytes: int = 100 * 1024 * 1024, rotate_seconds: float = 86400.0, max_files: int = 10,
+                 buffer_bytes: int = 64 * 1024 * 1024):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.buffer_bytes = buffer_bytes
+        self.flush_seconds = flush_seconds
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.max_files = max_files
+        self.logged = 0
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+        self.write_errors = 0
+        self._buffer: List[Dict] = []
+        self._buffered_bytes = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+        self._file = None
+        self._opened_at = 0.0
+
+    def log(self, entry: Dict) -> bool:
+        """Queue an entry for writing; returns False if it was dropped because the buffer is full"""
+        size = estimate_size(entry)
+        with self._lock:
+            if len(self._buffer) >= self.buffer_size or self._buffered_bytes + size > self.buffer_bytes:
+                self.dropped += 1
+                return False
+            self._buffer.append(entry)
+            self._buffered_bytes += size
+            self.logged += 1
+            # Flush early rather than waiting out the interval once the buffer is half full
+            if len(self._buffer) == self.buffer_size // 2 or self._buffered_bytes * 2 > self.buffer_bytes:
+                self._wake.set()
+        return True
+
+    def start(self):
+        """Flush every flush_seconds in a daemon thread"""
+        def run():
+            while not self._stopping:
+                self._wake.wait(self.flush_seconds)
+                self._wake.clear()
+                self.flush()
+
+        self._thread = threading.Thread(target=run, name="request-log", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stop the writer thread, flushing what is still buffered"""
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def flush(self):
+        """Serialize and append everything buffered so far"""
+        with self._lock:
+            entries, self._buffer = self._buffer, []
+            self._buffered_bytes = 0
+        if not entries:
+            return
+
+        lines = []
+        for entry in entries:
+            # The response body is already JSON, so it is spliced in rather than decoded and encoded again
+            body = entry.pop("response_body", None)
+            line = json.dumps(entry, default=_json_default)
+            if body is not None:
+                line = f'{line[:-1]}, "response": {body.decode("utf-8")}}}'
+            lines.append(line + "\n")
+        data = "".join(lines).encode("utf-8")
+
+        try:
+            self._rotate_if_needed(len(data))
+            self._file.write(data)
+            self._file.flush()
+            self.written += len(entries)
+        except OSError as e:
+            self.write_errors += 1
+            self.dropped += len(entries)
+            print(f"Warning: Could not write request log {self.path}: {e}")
+            # Reopen on the next flush
+            with contextlib.suppress(OSError):
+                if self._file is not None:
+                    self._file.close()
+            self._file = None
+
+    def _rotate_if_needed(self, incoming: int):
+        if self._file is not None:
+            too_big = self.max_bytes > 0 and self._file.tell() > 0 and self._file.tell() + incoming > self.max_bytes
+            too_old = self.rotate_seconds > 0 and time.time() - self._opened_at >= self.rotate_seconds
+            if too_big or too_old:
+                self._file.close()
+                self._file = None
+                self._rotate()
+
+        if self._file is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(self.path, "ab")
+            self._opened_at = time.time()
+
+    def _rotate(self):
+        base, extension = os.path.splitext(self.path)
+        stamp = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        target = f"{base}.{stamp}{extension}"
+        suffix = 1
+        while os.path.exists(target):
+            target = f"{base}.{stamp}-{suffix}{extension}"
+            suffix += 1
+        os.replace(self.path, target)
+        self.rotations += 1
+
+        if self.max_files > 0:
+            directory = os.path.dirname(self.path) or "."
+            prefix = os.path.basename(base) + "."
+            rotated = sorted(
+                entry.path for entry in os.scandir(directory)
+                if entry.name.startswith(prefix) and entry.name.endswith(extension) and entry.path != self.path
+            )
+            for path in rotated[:-self.max_files]:
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+
+    def stats(self) -> Dict:
+        """Counters and the number of entries waiting to be written"""
+        with self._lock:
+            buffered, buffered_bytes = len(self._buffer), self._buffered_bytes
+        return {
+            "path": self.path,
+            "logged": self.logged,
+            "written": self.written,
+            "dropped": self.dropped,
+            "buffered": buffered,
+            "buffered_bytes": buffered_bytes,
+            "rotations": self.rotations,
+            "write_errors": self.write_errors
+        }
+
+
+def log_requests(request_log: Optional[RequestLog], endpoint_name: str) -> Callable:
+    """Decorator logging an endpoint's request, response (or error), status and latency
+
+    Expects the endpoint's body parameter to be called request and its result to
+    be a rendered JSON response. With no log configured, the endpoint is returned
+    unchanged.
+    """
+    def decorate(endpoint: Callable) -> Callable:
+        if request_log is None:
+            return endpoint
+
+        def record(kwargs, start: float, response=None, error: Optional[Exception] = None):
+            started = request_started.get() or start
+            entry = {
+                "time": time.time(),
+                "endpoint": endpoint_name,
+                "latency_ms": (time.perf_counter() - started) * 1000.0,
+                "request": kwargs.get("request")
+            }
+            if error is None:
+                entry["status"] = response.status_code
+                entry["response_body"] = response.body
+            elif isinstance(error, HTTPException):
+                entry["status"] = error.status_code
+                entry["error"] = error.detail
+            else:
+                entry["status"] = 500
+                entry["error"] = str(error)
+            request_log.log(entry)
+
+        if asyncio.iscoroutinefunction(endpoint):
+            @functools.wraps(endpoint)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    response = await endpoint(*args, **kwargs)
+                except Exception as e:
+                    record(kwargs, start, error=e)
+                    raise
+                record(kwargs, start, response)
+                return response
+        else:
+            @functools.wraps(endpoint)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    response = endpoint(*args, **kwargs)
+                except Exception as e:
+                    record(kwargs, start, error=e)
+                    raise
+                record(kwargs, start, response)
+                return response
+        return wrapper
+    return decorate
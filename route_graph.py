@@ -0,0 +1,441 @@
+"""
+Station network and risk-aware route planning for the TTC Delay Prediction API
+Stations are linked along each line and by in-station transfers; shortest paths
+for every (day, time preference) are precomputed when the planner is built
+"""
+
+import functools
+import heapq
+import math
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+import numpy as np
+
+DAYS_OF_WEEK = 7
+
+# Minutes to change lines within a station
+TRANSFER_MINUTES = 5
+
+# Minutes a route is penalised per unit of delay probability at each stop
+DELAY_PENALTY_MINUTES = 10
+
+# Bound on memoized alternative-route queries kept per planner
+ROUTE_CACHE_SIZE = 4096
+
+# Candidate paths examined per requested alternative before giving up on finding more
+MAX_PATHS_PER_ROUTE = 10
+
+# (travel time multiplier, delay risk multiplier) for each time preference
+TIME_PREFERENCES = {
+    "any": (1.0, 1.0),
+    "rush_hour": (1.3, 1.5),
+    "off_peak": (0.9, 0.8)
+}
+
+
+class RouteNetwork:
+    """Graph of (station, line) nodes joined by line segments and transfer edges"""
+
+    def __init__(self, line_stops: Dict[str, List[Tuple[str, float]]],
+                 coordinates: Dict[str, Tuple[float, float]],
+                 transfer_minutes: float = TRANSFER_MINUTES):
+        self.stations: List[str] = []
+        self.station_id: Dict[str, int] = {}
+        self.station_nodes: List[List[int]] = []
+        self.node_station: List[int] = []
+        self.node_line: List[str] = []
+        self.adjacency: List[List[Tuple[int, float, bool]]] = []
+        self.edge_minutes: Dict[Tuple[int, int], float] = {}
+
+        for line, stops in line_stops.items():
+            previous = None
+            for station, minutes in stops:
+                node = self._add_node(station, line)
+                if previous is not None:
+                    self._add_edge(previous, node, minutes, transfer=False)
+                previous = node
+
+        # Every pair of lines serving the same station is joined by a transfer
+        for nodes in self.station_nodes:
+            for i, a in enumerate(nodes):
+                for b in nodes[i + 1:]:
+                    self._add_edge(a, b, transfer_minutes, transfer=True)
+
+        self.coordinates = np.array([coordinates[name] for name in self.stations], dtype=np.float64)
+        self.minutes_per_km = self._fastest_pace()
+
+    @property
+    def node_count(self) -> int:
+        """Number of (station, line) nodes"""
+        return len(self.node_station)
+
+    def _add_node(self, station: str, line: str) -> int:
+        if station not in self.station_id:
+            self.station_id[station] = len(self.stations)
+            self.stations.append(station)
+            self.station_nodes.append([])
+        node = len(self.node_station)
+        self.node_station.append(self.station_id[station])
+        self.node_line.append(line)
+        self.station_nodes[self.station_id[station]].append(node)
+        self.adjacency.append([])
+        return node
+
+    def _add_edge(self, a: int, b: int, minutes: float, transfer: bool):
+        self.adjacency[a].append((b, minutes, transfer))
+        self.adjacency[b].append((a, minutes, transfer))
+        self.edge_minutes[(a, b)] = self.edge_minutes[(b, a)] = minutes
+
+    def _fastest_pace(self) -> float:
+        """Lowest minutes-per-km over all line segments, used as an admissible A* bound"""
+        pace = math.inf
+        for (a, b), minutes in self.edge_minutes.items():
+            distance = self._distance_km(self.node_station[a], self.node_station[b])
+            if distance > 0:
+                pace = min(pace, minutes / distance)
+        return pace if math.isfinite(pace) else 0.0
+
+    def _distance_km(self, a: int, b: int) -> float:
+        """Great-circle distance between two stations"""
+        lat1, lng1 = np.radians(self.coordinates[a])
+        lat2, lng2 = np.radians(self.coordinates[b])
+        h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+        return 12742.0 * math.asin(math.sqrt(h))
+
+    def _step_cost(self, v: int, minutes: float, transfer: bool, penalty: List[float], time_multiplier: float) -> float:
+        # Delay risk is charged on arrival at a stop, not when changing lines inside it
+        return minutes * time_multiplier + (0.0 if transfer else penalty[self.node_station[v]])
+
+    def shortest_paths(self, source: int, penalty: np.ndarray, time_multiplier: float) -> Tuple[np.ndarray, np.ndarray]:
+        """Dijkstra from every node of a source station, returning (cost, predecessor) per node"""
+        penalty = np.asarray(penalty).tolist()
+        cost = [math.inf] * self.node_count
+        predecessor = [-1] * self.node_count
+        heap = []
+        for node in self.station_nodes[source]:
+            cost[node] = 0.0
+            heap.append((0.0, node))
+        heapq.heapify(heap)
+
+        while heap:
+            c, u = heapq.heappop(heap)
+            if c > cost[u]:
+                continue
+            for v, minutes, transfer in self.adjacency[u]:
+                candidate = c + self._step_cost(v, minutes, transfer, penalty, time_multiplier)
+                if candidate < cost[v]:
+                    cost[v] = candidate
+                    predecessor[v] = u
+                    heapq.heappush(heap, (candidate, v))
+
+        return np.array(cost), np.array(predecessor, dtype=np.int32)
+
+    def find_path(self, source: int, target: int, penalty: np.ndarray, time_multiplier: float) -> Optional[List[int]]:
+        """A* search between two stations, guided by straight-line distance"""
+        penalty = np.asarray(penalty).tolist()
+        bound = self.minutes_per_km * time_multiplier
+        targets = set(self.station_nodes[target])
+        cost = {}
+        predecessor = {}
+        heap = []
+        for node in self.station_nodes[source]:
+            cost[node] = 0.0
+            predecessor[node] = -1
+            heapq.heappush(heap, (self._distance_km(source, target) * bound, 0.0, node))
+
+        while heap:
+            _, c, u = heapq.heappop(heap)
+            if u in targets:
+                return self.path_nodes(predecessor, u)
+            if c > cost[u]:
+                continue
+            for v, minutes, transfer in self.adjacency[u]:
+                candidate = c + self._step_cost(v, minutes, transfer, penalty, time_multiplier)
+                if candidate < cost.get(v, math.inf):
+                    cost[v] = candidate
+                    predecessor[v] = u
+                    estimate = candidate + self._distance_km(self.node_station[v], target) * bound
+                    heapq.heappush(heap, (estimate, candidate, v))
+
+        return None
+
+    def path_cost(self, nodes: List[int], penalty: List[float], time_multiplier: float) -> float:
+        """Blended cost of a node path under the given penalty and time multiplier"""
+        cost = 0.0
+        for u, v in zip(nodes, nodes[1:]):
+            transfer = self.node_station[u] == self.node_station[v]
+            cost += self._step_cost(v, self.edge_minutes[(u, v)], transfer, penalty, time_multiplier)
+        return cost
+
+    def _search(self, sources: List[int], target: int, penalty: List[float], time_multiplier: float,
+                banned_nodes=frozenset(), banned_edges=frozenset(),
+                at_origin: bool = True) -> Optional[Tuple[float, List[int]]]:
+        """Dijkstra from a set of nodes to any node of the target station, avoiding banned nodes and edges
+
+        Searches that start at the route's origin never transfer before leaving
+        it, and every search stops on arrival, so paths start and end on the
+        line they actually ride.
+        """
+        cost = {}
+        predecessor = {}
+        heap = []
+        for node in sources:
+            cost[node] = 0.0
+            predecessor[node] = -1
+            heap.append((0.0, node))
+        heapq.heapify(heap)
+
+        while heap:
+            c, u = heapq.heappop(heap)
+            if c > cost[u]:
+                continue
+            if self.node_station[u] == target:
+                return c, self.path_nodes(predecessor, u)
+            for v, minutes, transfer in self.adjacency[u]:
+                if v in banned_nodes or (u, v) in banned_edges:
+                    continue
+                if transfer and at_origin and predecessor[u] == -1:
+                    continue
+                candidate = c + self._step_cost(v, minutes, transfer, penalty, time_multiplier)
+                if candidate < cost.get(v, math.inf):
+                    cost[v] = candidate
+                    predecessor[v] = u
+                    heapq.heappush(heap, (candidate, v))
+
+        return None
+
+    def shortest_simple_paths(self, source: int, target: int, penalty: np.ndarray,
+                              time_multiplier: float) -> Iterator[List[int]]:
+        """Yen's algorithm: loopless node paths between two stations in increasing cost order"""
+        penalty = np.asarray(penalty).tolist()
+        start_nodes = self.station_nodes[source]
+        first = self._search(start_nodes, target, penalty, time_multiplier)
+        if first is None:
+            return
+
+        accepted = [first[1]]
+        candidates = []
+        seen = {tuple(first[1])}
+        yield first[1]
+
+        while True:
+            previous = accepted[-1]
+
+            # Deviate from the first node of the route itself (a different starting line)
+            used_starts = {path[0] for path in accepted}
+            spurs = [([], [node for node in start_nodes if node not in used_starts])]
+            # ... and from every later node along the previous route
+            spurs += [(previous[:i + 1], [previous[i]]) for i in range(len(previous) - 1)]
+
+            for root, sources in spurs:
+                if not sources:
+                    continue
+                banned_edges = {
+                    (path[len(root) - 1], path[len(root)])
+                    for path in accepted
+                    if root and len(path) > len(root) and path[:len(root)] == root
+                }
+                # Stay loopless: the spur may not revisit any station on the root path
+                spur_station = self.node_station[sources[0]]
+                banned_nodes = {
+                    node
+                    for station in {self.node_station[n] for n in root}
+                    if station != spur_station
+                    for node in self.station_nodes[station]
+                }
+                banned_nodes.update(root[:-1])
+
+                spur = self._search(sources, target, penalty, time_multiplier, banned_nodes, banned_edges,
+                                    at_origin=len(root) <= 1)
+                if spur is None:
+                    continue
+                path = root[:-1] + spur[1]
+                if tuple(path) in seen:
+                    continue
+                seen.add(tuple(path))
+                heapq.heappush(candidates, (self.path_cost(path, penalty, time_multiplier), path))
+
+            if not candidates:
+                return
+            accepted.append(heapq.heappop(candidates)[1])
+            yield accepted[-1]
+
+    def pareto_paths(self, source: int, target: int, risk: np.ndarray, time_multiplier: float,
+                     risk_multiplier: float) -> List[List[int]]:
+        """Loopless paths on the travel time vs. delay risk Pareto frontier
+
+        Risk is accumulated as the sum of stop delay probabilities. Partial paths
+        dominated at the same node, or by a route already found, are pruned.
+        """
+        risk = (np.asarray(risk) * risk_multiplier).tolist()
+        settled: Dict[int, List[Tuple[float, float]]] = {}
+        frontier: List[Tuple[float, float, Tuple[int, ...]]] = []
+        heap = [(0.0, risk[source], node, (node,)) for node in self.station_nodes[source]]
+        heapq.heapify(heap)
+
+        while heap:
+            minutes, exposure, u, path = heapq.heappop(heap)
+            if any(t <= minutes and r <= exposure for t, r, _ in frontier):
+                continue
+            labels = settled.setdefault(u, [])
+            if any(t <= minutes and r <= exposure for t, r in labels):
+                continue
+            labels.append((minutes, exposure))
+
+            if self.node_station[u] == target:
+                frontier.append((minutes, exposure, path))
+                continue
+
+            visited = {self.node_station[n] for n in path}
+            for v, edge_minutes, transfer in self.adjacency[u]:
+                if transfer and len(path) == 1:
+                    continue
+                if not transfer and self.node_station[v] in visited:
+                    continue
+                heapq.heappush(heap, (
+                    minutes + edge_minutes * time_multiplier,
+                    exposure + (0.0 if transfer else risk[self.node_station[v]]),
+                    v,
+                    path + (v,)
+                ))
+
+        return [list(path) for _, _, path in frontier]
+
+    def revisits_station(self, nodes: List[int]) -> bool:
+        """True if a path leaves a station and later comes back to it"""
+        stations = [self.node_station[n] for n in nodes]
+        visits = [s for i, s in enumerate(stations) if i == 0 or s != stations[i - 1]]
+        return len(visits) != len(set(visits))
+
+    @staticmethod
+    def path_nodes(predecessor, node: int) -> List[int]:
+        """Walk a predecessor tree back from node to its source"""
+        path = []
+        while node != -1:
+            path.append(node)
+            node = int(predecessor[node])
+        return path[::-1]
+
+    def describe(self, nodes: List[int], risk: np.ndarray, time_multiplier: float, risk_multiplier: float) -> Dict:
+        """Summarise a node path as the route payload returned by the API"""
+        station_ids = []
+        lines = []
+        transfers = 0
+        minutes = 0.0
+
+        for i, node in enumerate(nodes):
+            if i > 0:
+                minutes += self.edge_minutes[(nodes[i - 1], node)]
+            station = self.node_station[node]
+            if station_ids and station_ids[-1] == station:
+                transfers += 1
+            else:
+                station_ids.append(station)
+            if not lines or lines[-1] != self.node_line[node]:
+                lines.append(self.node_line[node])
+
+        return {
+            "stations": [self.stations[s] for s in station_ids],
+            "lines": lines,
+            "transfers": transfers,
+            "total_delay_risk": float(risk[station_ids].mean() * risk_multiplier),
+            "estimated_time": int(minutes * time_multiplier)
+        }
+
+
+class RoutePlanner:
+    """Risk-aware shortest routes between every pair of stations
+
+    station_risk(day_of_week) gives the delay risk of every station, in
+    network.stations order. Routes are only planned for days in range(days);
+    other days raise ValueError.
+    """
+
+    def __init__(self, network: RouteNetwork, station_risk: Callable[[int], np.ndarray], days: int = DAYS_OF_WEEK,
+                 cache_size: int = ROUTE_CACHE_SIZE):
+        self.network = network
+        self.station_risk = station_risk
+        self.days = days
+        self.alternatives = functools.lru_cache(maxsize=cache_size)(self._alternatives)
+        self._risk = {day: self._risk_for_day(day) for day in range(days)}
+
+        # Shortest-path trees per (day, time preference), one row per source station
+        self._trees = {}
+        for day in range(days):
+            for preference, (time_multiplier, risk_multiplier) in TIME_PREFERENCES.items():
+                penalty = self._risk[day] * risk_multiplier * DELAY_PENALTY_MINUTES
+                trees = [network.shortest_paths(source, penalty, time_multiplier) for source in range(len(network.stations))]
+                self._trees[(day, preference)] = (
+                    np.stack([cost for cost, _ in trees]),
+                    np.stack([predecessor for _, predecessor in trees])
+                )
+
+    def _risk_for_day(self, day_of_week: int) -> np.ndarray:
+        # One vectorized call per day, aligned with network.stations
+        return np.asarray(self.station_risk(day_of_week), dtype=np.float64)
+
+    def _check_day(self, day_of_week: int):
+        if not 0 <= day_of_week < self.days:
+            raise ValueError(f"day_of_week must be between 0 and {self.days - 1}")
+
+    def route(self, start: str, end: str, day_of_week: int, time_preference: str) -> Optional[Dict]:
+        """Best route between two stations, or None if they are not connected"""
+        self._check_day(day_of_week)
+        if time_preference not in TIME_PREFERENCES:
+            time_preference = "any"
+        time_multiplier, risk_multiplier = TIME_PREFERENCES[time_preference]
+        source = self.network.station_id[start]
+        target = self.network.station_id[end]
+
+        risk = self._risk[day_of_week]
+        costs, predecessors = self._trees[(day_of_week, time_preference)]
+        cost, predecessor = costs[source], predecessors[source]
+        end_node = min(self.network.station_nodes[target], key=lambda node: cost[node])
+        if not np.isfinite(cost[end_node]):
+            return None
+        nodes = self.network.path_nodes(predecessor, end_node)
+        return self.network.describe(nodes, risk, time_multiplier, risk_multiplier)
+
+    def _alternatives(self, start: str, end: str, day_of_week: int, time_preference: str,
+                      mode: str = "k_shortest", max_routes: int = 3) -> Tuple[Dict, ...]:
+        """Distinct routes between two stations, best first
+
+        mode "k_shortest" returns the max_routes lowest-cost routes; mode
+        "pareto" returns up to max_routes routes from the travel time vs.
+        delay risk frontier. Results are memoized, so callers must not mutate them.
+        """
+        self._check_day(day_of_week)
+        if mode != "pareto" and max_routes == 1:
+            best = self.route(start, end, day_of_week, time_preference)
+            return (best,) if best is not None else ()
+
+        if time_preference not in TIME_PREFERENCES:
+            time_preference = "any"
+        time_multiplier, risk_multiplier = TIME_PREFERENCES[time_preference]
+        source = self.network.station_id[start]
+        target = self.network.station_id[end]
+        risk = self._risk[day_of_week]
+        penalty = risk * risk_multiplier * DELAY_PENALTY_MINUTES
+
+        if source == target:
+            paths = [[self.network.station_nodes[source][0]]]
+        elif mode == "pareto":
+            paths = self.network.pareto_paths(source, target, risk, time_multiplier, risk_multiplier)
+            penalty_list = penalty.tolist()
+            paths.sort(key=lambda path: self.network.path_cost(path, penalty_list, time_multiplier))
+        else:
+            paths = self.network.shortest_simple_paths(source, target, penalty, time_multiplier)
+
+        # Paths that only differ in where a rider changes lines look identical, so keep the cheapest
+        routes = []
+        seen = set()
+        for examined, path in enumerate(paths):
+            if len(routes) == max_routes or examined >= max_routes * MAX_PATHS_PER_ROUTE:
+                break
+            if self.network.revisits_station(path):
+                continue
+            route = self.network.describe(path, risk, time_multiplier, risk_multiplier)
+            key = (tuple(route["stations"]), tuple(route["lines"]))
+            if key not in seen:
+                seen.add(key)
+                routes.append(route)
+        return tuple(routes)
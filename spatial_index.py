@@ -0,0 +1,113 @@
+"""
+Spatial index over station coordinates for the TTC Delay Prediction API
+Stations are projected onto a local plane and bucketed into a uniform grid, so
+nearest-station and viewport queries only look at the cells around the query
+"""
+
+import heapq
+import math
+from typing import List, Optional, Sequence, Tuple
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+class SpatialIndex:
+    """Uniform grid over equirectangular-projected coordinates
+
+    The projection is centred on the indexed points' mean latitude, which keeps
+    distances accurate to well under 1% across a city-sized area.
+    """
+
+    def __init__(self, names: Sequence[str], coordinates: Sequence[Tuple[float, float]], points_per_cell: float = 2.0):
+        self.names = list(names)
+        self.latlng = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+        self._cos_lat = math.cos(math.radians(float(self.latlng[:, 0].mean()))) if len(self.latlng) else 1.0
+        self.xy = self.project(self.latlng[:, 0], self.latlng[:, 1])
+
+        # Square cells sized so each holds about points_per_cell points on average
+        lower = self.xy.min(axis=0) if len(self.xy) else np.zeros(2)
+        upper = self.xy.max(axis=0) if len(self.xy) else np.zeros(2)
+        extent = np.maximum(upper - lower, 1e-6)
+        self.cell_km = max(math.sqrt(extent[0] * extent[1] * points_per_cell / max(len(self.xy), 1)), 1e-3)
+        self.origin = lower.tolist()
+        self.shape = tuple(int(n) for n in np.floor(extent / self.cell_km).astype(np.int64) + 1)
+
+        # Point indices per cell; queries touch only a handful of cells, where plain lists beat NumPy calls
+        cx, cy = self._cells(self.xy)
+        self.cells: List[List[List[int]]] = [[[] for _ in range(self.shape[1])] for _ in range(self.shape[0])]
+        for i, (x, y) in enumerate(zip(cx.tolist(), cy.tolist())):
+            self.cells[x][y].append(i)
+        self._xy = self.xy.tolist()
+        self._latlng = self.latlng.tolist()
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def project(self, lat, lng) -> np.ndarray:
+        """Kilometre (x, y) coordinates on the index's local plane"""
+        scale = math.radians(1.0) * EARTH_RADIUS_KM
+        return np.column_stack([np.asarray(lng, dtype=np.float64) * scale * self._cos_lat,
+                                np.asarray(lat, dtype=np.float64) * scale])
+
+    def _cells(self, xy: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        cells = np.floor((xy - self.origin) / self.cell_km).astype(np.int64)
+        return np.clip(cells[:, 0], 0, self.shape[0] - 1), np.clip(cells[:, 1], 0, self.shape[1] - 1)
+
+    def _cell(self, lat: float, lng: float) -> Tuple[float, float, int, int]:
+        """Projected (x, y) of a point and its grid cell, clamped to the grid"""
+        scale = math.radians(1.0) * EARTH_RADIUS_KM
+        x, y = lng * scale * self._cos_lat, lat * scale
+        cx = min(max(int(math.floor((x - self.origin[0]) / self.cell_km)), 0), self.shape[0] - 1)
+        cy = min(max(int(math.floor((y - self.origin[1]) / self.cell_km)), 0), self.shape[1] - 1)
+        return x, y, cx, cy
+
+    def _points_in(self, x0: int, x1: int, y0: int, y1: int) -> List[int]:
+        """Indices of points in the inclusive block of cells [x0, x1] x [y0, y1]"""
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, self.shape[0] - 1), min(y1, self.shape[1] - 1)
+        found = []
+        if x0 > x1 or y0 > y1:
+            return found
+        for column in self.cells[x0:x1 + 1]:
+            for cell in column[y0:y1 + 1]:
+                found.extend(cell)
+        return found
+
+    def nearest(self, lat: float, lng: float, k: int = 1, max_km: Optional[float] = None) -> List[Tuple[int, float]]:
+        """Up to k (index, distance_km) pairs closest to a point, nearest first
+
+        Searches rings of cells outward from the point's cell until no unvisited
+        cell can hold anything closer than the k-th point found.
+        """
+        if not len(self) or k <= 0:
+            return []
+        x, y, cx, cy = self._cell(lat, lng)
+        # Every cell r + 1 rings out is at least r cells' width from the point
+        limit = max(self.shape) if max_km is None else min(max(self.shape), int(max_km / self.cell_km) + 1)
+
+        found: List[Tuple[float, int]] = []
+        for ring in range(limit + 1):
+            if ring == 0:
+                points = self._points_in(cx, cx, cy, cy)
+            else:
+                points = (self._points_in(cx - ring, cx + ring, cy - ring, cy - ring)
+                          + self._points_in(cx - ring, cx + ring, cy + ring, cy + ring)
+                          + self._points_in(cx - ring, cx - ring, cy - ring + 1, cy + ring - 1)
+                          + self._points_in(cx + ring, cx + ring, cy - ring + 1, cy + ring - 1))
+            found.extend((math.hypot(self._xy[i][0] - x, self._xy[i][1] - y), i) for i in points)
+            if len(found) >= k and heapq.nsmallest(k, found)[-1][0] <= ring * self.cell_km:
+                break
+
+        best = heapq.nsmallest(k, (item for item in found if max_km is None or item[0] <= max_km))
+        return [(i, distance) for distance, i in best]
+
+    def within(self, south: float, west: float, north: float, east: float) -> List[int]:
+        """Indices of points inside a latitude/longitude bounding box, in index order"""
+        if not len(self) or south > north or west > east:
+            return []
+        _, _, x0, y0 = self._cell(south, west)
+        _, _, x1, y1 = self._cell(north, east)
+        inside = [i for i in self._points_in(x0, x1, y0, y1)
+                  if south <= self._latlng[i][0] <= north and west <= self._latlng[i][1] <= east]
+        return sorted(inside)
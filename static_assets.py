@@ -0,0 +1,100 @@
+"""
+Precompressed static responses for the TTC Delay Prediction API
+An asset is rendered and compressed once, then served with a strong ETag per
+encoding so browsers revalidate with a bodiless 304 or skip the request entirely
+"""
+
+import gzip
+import hashlib
+from typing import Dict, Optional
+from fastapi.responses import Response
+
+# brotli is optional; without it assets are offered gzip-compressed only
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Encodings in order of preference when a client accepts several equally
+PREFERRED_ENCODINGS = ("br", "gzip", "identity")
+
+# For assets whose URL changes whenever their content does
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+# For assets fetched by a fixed URL: cache, but revalidate before every use
+REVALIDATE = "no-cache"
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header covers the given ETag"""
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in (tag[2:] if tag.startswith("W/") else tag for tag in candidates)
+
+
+def accepted_encodings(accept_encoding: Optional[str]) -> Dict[str, float]:
+    """Quality value per content coding in an Accept-Encoding header"""
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        if not coding:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    return accepted
+
+
+class StaticAsset:
+    """A response body kept in every supported encoding, with one strong ETag per encoding"""
+
+    def __init__(self, body: bytes, media_type: str, cache_control: str = REVALIDATE):
+        self.media_type = media_type
+        self.cache_control = cache_control
+        self.digest = hashlib.sha256(body).hexdigest()[:16]
+        self.bodies = {"identity": body, "gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            self.bodies["br"] = brotli.compress(body, quality=11)
+        self.etags = {encoding: f'"{self.digest}-{encoding}"' if encoding != "identity" else f'"{self.digest}"'
+                      for encoding in self.bodies}
+
+    def select(self, accept_encoding: Optional[str]) -> str:
+        """Best available encoding the client accepts; identity unless it is explicitly refused"""
+        accepted = accepted_encodings(accept_encoding)
+
+        def quality(encoding: str) -> float:
+            if encoding in accepted:
+                return accepted[encoding]
+            if "*" in accepted:
+                return accepted["*"]
+            # identity stays acceptable when unlisted, but any listed coding is preferred to it
+            return 0.001 if encoding == "identity" else 0.0
+
+        candidates = [encoding for encoding in PREFERRED_ENCODINGS if encoding in self.bodies and quality(encoding) > 0]
+        # max() keeps the first of equally acceptable encodings, so ties follow PREFERRED_ENCODINGS
+        return max(candidates, key=quality) if candidates else "identity"
+
+    def response(self, headers, cache_control: Optional[str] = None) -> Response:
+        """Response for a request's headers: a 304 if the client has a current copy, else the best encoding"""
+        encoding = self.select(headers.get("accept-encoding"))
+        response_headers = {
+            "ETag": self.etags[encoding],
+            "Cache-Control": cache_control or self.cache_control,
+            "Vary": "Accept-Encoding"
+        }
+        if_none_match = headers.get("if-none-match")
+        if any(etag_matches(if_none_match, etag) for etag in self.etags.values()):
+            return Response(status_code=304, headers=response_headers)
+        if encoding != "identity":
+            response_headers["Content-Encoding"] = encoding
+        return Response(content=self.bodies[encoding], media_type=self.media_type, headers=response_headers)
+
+    def sizes(self) -> Dict[str, int]:
+        """Body size in bytes per encoding"""
+        return {encoding: len(body) for encoding, body in self.bodies.items()}
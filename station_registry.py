@@ -0,0 +1,201 @@
+"""
+Station registry for the TTC Delay Prediction API
+Every subway and RT stop is loaded once from stations.csv into NumPy columns
+with indexes by name, by line and by model category id, so requests look
+stations up by position instead of scanning dicts and re-encoding names
+"""
+
+import csv
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from category_encoding import UNKNOWN, CategoryEncoder
+
+# One row per stop, lines listed one after another with their stops in travel order;
+# shipped with the code rather than trained, so it is found next to this module
+STATIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stations.csv")
+
+STATION_COLUMNS = ["line", "station", "lat", "lng", "minutes"]
+
+# Optional column: "|"-separated Line codes the model may know a station by, most preferred first;
+# blank means the row's own line. Every row of a station must resolve to the same value.
+MODEL_LINES_COLUMN = "model_lines"
+
+
+class StationCodes:
+    """A registry's stations encoded with one model version's categories
+
+    lines and stations hold each registry station's encoded Line and Station
+    (UNKNOWN where the model has not seen them), and rows maps an encoded
+    Station back to its registry id (-1 for stations only the model knows).
+    A station's Line is the first of its model_lines the encoder knows, named
+    in line_names.
+    """
+
+    def __init__(self, registry: "StationRegistry", encoder: CategoryEncoder):
+        chosen = [next((line for line in candidates if encoder.encode('Line', line) != UNKNOWN), candidates[0])
+                  for candidates in registry.model_lines]
+        self.line_names = np.array(chosen, dtype=str)
+        self.lines = encoder.encode_many('Line', chosen)
+        self.stations = encoder.encode_many('Station', registry.names)
+        self.known = (self.lines != UNKNOWN) & (self.stations != UNKNOWN)
+        self.rows = np.full(encoder.size('Station'), -1, dtype=np.intp)
+        self.rows[self.stations[self.stations != UNKNOWN]] = np.flatnonzero(self.stations != UNKNOWN)
+
+    @property
+    def unknown(self) -> np.ndarray:
+        """Registry ids of stations the model cannot score"""
+        return np.flatnonzero(~self.known)
+
+    @property
+    def unlisted(self) -> int:
+        """Number of stations the model knows that are not in the registry"""
+        return int((self.rows == -1).sum())
+
+
+class StationRegistry:
+    """Stations as parallel NumPy columns indexed by registry id
+
+    Ids follow the order in which stations first appear in the file.
+    model_lines holds the Line codes the model may know each station by, most
+    preferred first, and lines the first of them, which is the line the
+    station is reported on. stops_by_line gives every line's stops in travel
+    order, with interchanges appearing on each of their lines.
+    """
+
+    def __init__(self, rows: Sequence[Tuple[str, str, float, float, float, Tuple[str, ...]]]):
+        self.index: Dict[str, int] = {}
+        names, latlng = [], []
+        self.model_lines: List[Tuple[str, ...]] = []
+        line_index: Dict[str, int] = {}
+        stop_line, stop_station, stop_minutes, stop_latlng = [], [], [], []
+        for line, station, lat, lng, minutes, model_lines in rows:
+            model_lines = model_lines or (line,)
+            if line not in line_index:
+                line_index[line] = len(line_index)
+            if station not in self.index:
+                self.index[station] = len(names)
+                names.append(station)
+                latlng.append((lat, lng))
+                self.model_lines.append(model_lines)
+            elif self.model_lines[self.index[station]] != model_lines:
+                raise ValueError(f"Rows for {station} disagree on its {MODEL_LINES_COLUMN}; set it on every row")
+            stop_line.append(line_index[line])
+            stop_station.append(self.index[station])
+            stop_minutes.append(minutes)
+            stop_latlng.append((lat, lng))
+
+        self.ids = np.arange(len(names))
+        self.names = np.array(names, dtype=str)
+        self.line_codes = np.array(list(line_index), dtype=str)
+        unknown = sorted({code for codes in self.model_lines for code in codes} - set(line_index))
+        if unknown:
+            raise ValueError(f"{MODEL_LINES_COLUMN} names lines with no stops: {', '.join(unknown)}")
+        self.lines = np.array([line_index[codes[0]] for codes in self.model_lines], dtype=np.intp)
+        self.latlng = np.array(latlng, dtype=np.float64).reshape(-1, 2)
+        self.stop_line = np.array(stop_line, dtype=np.intp)
+        self.stop_station = np.array(stop_station, dtype=np.intp)
+        self.stop_minutes = np.array(stop_minutes, dtype=np.float64)
+        self.stop_latlng = np.array(stop_latlng, dtype=np.float64).reshape(-1, 2)
+        self.stops_by_line: Dict[str, np.ndarray] = {
+            code: self.stop_station[self.stop_line == i] for i, code in enumerate(self.line_codes.tolist())
+        }
+        self._validate()
+
+    @classmethod
+    def load(cls, path: str = STATIONS_PATH) -> "StationRegistry":
+        """Read and validate a stations CSV; raises ValueError naming the offending line"""
+        rows = []
+        with open(path, newline="", encoding="utf-8") as f:
+            reader = csv.DictReader(f)
+            missing = [column for column in STATION_COLUMNS if column not in (reader.fieldnames or [])]
+            if missing:
+                raise ValueError(f"{path} is missing columns: {', '.join(missing)}")
+            for number, row in enumerate(reader, start=2):
+                try:
+                    line, station = row["line"].strip(), row["station"].strip()
+                    lat, lng, minutes = float(row["lat"]), float(row["lng"]), float(row["minutes"])
+                    model_lines = tuple(code.strip() for code in (row.get(MODEL_LINES_COLUMN) or "").split("|") if code.strip())
+                except (TypeError, ValueError):
+                    raise ValueError(f"{path}:{number}: lat, lng and minutes must be numbers") from None
+                if not line or not station:
+                    raise ValueError(f"{path}:{number}: line and station must not be empty")
+                if not (-90.0 <= lat <= 90.0 and -180.0 <= lng <= 180.0) or minutes < 0:
+                    raise ValueError(f"{path}:{number}: coordinates out of range or negative minutes")
+                rows.append((line, station, lat, lng, minutes, model_lines))
+        try:
+            return cls(rows)
+        except ValueError as e:
+            raise ValueError(f"{path}: {e}") from None
+
+    def _validate(self):
+        """Reject data that would silently break lookups, routing or the map"""
+        if not len(self.names):
+            raise ValueError("No stations")
+        # Each line's stops must be one contiguous block, so travel order is unambiguous
+        starts = np.flatnonzero(np.diff(self.stop_line) != 0) + 1
+        if len(starts) + 1 != len(self.line_codes):
+            raise ValueError("Stops of each line must be listed together")
+        for code, stops in self.stops_by_line.items():
+            if len(np.unique(stops)) != len(stops):
+                raise ValueError(f"A station is listed twice on line {code}")
+        # An interchange's rows must agree on its coordinates
+        disagree = np.flatnonzero((self.latlng[self.stop_station] != self.stop_latlng).any(axis=1))
+        if len(disagree):
+            raise ValueError(f"Conflicting coordinates for {self.names[self.stop_station[disagree[0]]]}")
+        # Distinct stations at the very same point are a copy-paste error
+        _, first, counts = np.unique(self.latlng, axis=0, return_index=True, return_counts=True)
+        if (counts > 1).any():
+            shared = self.latlng[first[counts > 1][0]]
+            raise ValueError(f"Stations share coordinates {tuple(shared.tolist())}: "
+                             f"{', '.join(self.names[(self.latlng == shared).all(axis=1)].tolist())}")
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.index
+
+    def id(self, name: str) -> Optional[int]:
+        """Registry id of a station, or None"""
+        return self.index.get(name)
+
+    def ids_of(self, names: Sequence[str]) -> np.ndarray:
+        """Registry ids of many stations; -1 for names not in the registry"""
+        index = self.index
+        return np.fromiter((index.get(name, -1) for name in names), dtype=np.intp, count=len(names))
+
+    def line_of(self, station_id: int) -> str:
+        """Line a station is reported on: the first of its model_lines"""
+        return str(self.line_codes[self.lines[station_id]])
+
+    def line_stops(self) -> Dict[str, List[Tuple[str, float]]]:
+        """Stops per line in travel order with minutes from the previous stop, as RouteNetwork takes them"""
+        return {
+            code: list(zip(self.names[self.stop_station[self.stop_line == i]].tolist(),
+                           self.stop_minutes[self.stop_line == i].tolist()))
+            for i, code in enumerate(self.line_codes.tolist())
+        }
+
+    def coordinates(self) -> Dict[str, Tuple[float, float]]:
+        """(lat, lng) by station name"""
+        return dict(zip(self.names.tolist(), map(tuple, self.latlng.tolist())))
+
+    def summaries(self) -> List[Dict]:
+        """Name, line and coordinates of every station, in id order"""
+        return [
+            {"name": name, "line": line, "lat": lat, "lng": lng}
+            for name, line, (lat, lng) in zip(self.names.tolist(), self.line_codes[self.lines].tolist(),
+                                              self.latlng.tolist())
+        ]
+
+    def serving_lines(self) -> List[List[str]]:
+        """Codes of every line stopping at each station, in id order"""
+        serving: List[List[str]] = [[] for _ in range(len(self.names))]
+        for line, station in zip(self.line_codes[self.stop_line].tolist(), self.stop_station.tolist()):
+            serving[station].append(line)
+        return serving
+
+    def encode(self, encoder: CategoryEncoder) -> StationCodes:
+        """The stations' model category ids for one model version"""
+        return StationCodes(self, encoder)
@@ -0,0 +1,84 @@
+"""Parity of the flattened forest evaluator with RandomForestClassifier.predict_proba"""
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tree_ensemble import CHUNK_ROWS, FlatForest, check_parity  # noqa: E402
+
+COLUMNS = ['Line', 'Station', 'Code', 'DayOfWeek', 'Hour']
+
+
+def fit_forest(X: np.ndarray, y: np.ndarray, **params) -> RandomForestClassifier:
+    model = RandomForestClassifier(random_state=0, **params)
+    return model.fit(pd.DataFrame(X, columns=COLUMNS[:X.shape[1]]), y)
+
+
+def sklearn_proba(model: RandomForestClassifier, X: np.ndarray) -> np.ndarray:
+    return model.predict_proba(pd.DataFrame(X, columns=list(model.feature_names_in_)))
+
+
+@pytest.fixture(scope="module")
+def categorical():
+    """Encoded rows shaped like the API's inputs, with labels depending on them"""
+    rng = np.random.default_rng(0)
+    sizes = [4, 75, 30, 7, 24]
+    X = np.column_stack([rng.integers(0, size, 3000) for size in sizes])
+    y = ((X[:, 1] % 5 == 0) ^ (X[:, 4] > 15) ^ (rng.random(len(X)) < 0.2)).astype(int)
+    return X, y, sizes
+
+
+@pytest.mark.parametrize("max_depth", [None, 3, 12])
+def test_random_rows_match_sklearn(categorical, max_depth):
+    X, y, sizes = categorical
+    model = fit_forest(X, y, n_estimators=25, max_depth=max_depth)
+    forest = FlatForest(model)
+    rows = np.column_stack([np.random.default_rng(1).integers(0, size, 2000) for size in sizes])
+    np.testing.assert_allclose(forest.predict_proba(rows), sklearn_proba(model, rows), rtol=0, atol=1e-12)
+    assert check_parity(model, forest, rows) <= 1e-12
+
+
+def test_unlimited_depth_trees_are_fully_traversed(categorical):
+    X, y, _ = categorical
+    model = fit_forest(X, y, n_estimators=10, max_depth=None, min_samples_leaf=1)
+    forest = FlatForest(model)
+    # Grown until pure, these trees are far deeper than a depth-limited forest
+    assert forest.depth == max(estimator.tree_.max_depth for estimator in model.estimators_) > 12
+    np.testing.assert_allclose(forest.predict_proba(X), sklearn_proba(model, X), rtol=0, atol=1e-12)
+    np.testing.assert_array_equal(forest.predict(X), model.predict(pd.DataFrame(X, columns=COLUMNS)))
+
+
+def test_continuous_features_and_threshold_ties():
+    rng = np.random.default_rng(2)
+    X = rng.normal(size=(1500, 4))
+    y = rng.integers(0, 3, len(X))
+    model = fit_forest(X, y, n_estimators=15, max_depth=None)
+    forest = FlatForest(model)
+    # Values exactly on split thresholds, and float64 values that only tie after the cast to float32
+    thresholds = np.concatenate([estimator.tree_.threshold[estimator.tree_.feature >= 0]
+                                 for estimator in model.estimators_])
+    on_split = rng.choice(thresholds, size=(500, 4))
+    nudged = np.nextafter(on_split, np.inf)
+    for rows in (rng.normal(size=(2 * CHUNK_ROWS + 7, 4)), on_split, nudged):
+        np.testing.assert_allclose(forest.predict_proba(rows), sklearn_proba(model, rows), rtol=0, atol=1e-12)
+
+
+def test_saved_forest_is_memory_mapped(categorical, tmp_path):
+    X, y, _ = categorical
+    model = fit_forest(X, y, n_estimators=5)
+    forest = FlatForest(model)
+    forest.save(str(tmp_path))
+    loaded = FlatForest.load(str(tmp_path))
+    assert isinstance(loaded.threshold, np.memmap) and not loaded.threshold.flags.writeable
+    assert (loaded.n_features, loaded.depth) == (forest.n_features, forest.depth)
+    np.testing.assert_array_equal(loaded.predict_proba(X), forest.predict_proba(X))
+
+
+def test_empty_input():
+    X = np.arange(40).reshape(20, 2)
+    model = fit_forest(X, np.arange(20) % 2, n_estimators=3)
+    assert FlatForest(model).predict_proba(np.empty((0, 2))).shape == (0, 2)
@@ -1,111 +1,391 @@
 #!/usr/bin/env python3
 """
 Simple model training script for TTC Delay Prediction
-This script creates a basic model when the full training data is not available
+This script creates a basic model when the full training data is not available,
+or trains on real TTC subway delay-log CSVs streamed in chunks
 """
 
 import pandas as pd
 import numpy as np
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.preprocessing import LabelEncoder
+from sklearn.metrics import accuracy_score, roc_auc_score
+from sklearn.model_selection import train_test_split
 import pickle
+import csv
+import itertools
 import os
+import time
+import argparse
+import shutil
+import contextlib
+from datetime import datetime, timezone
+from station_registry import StationRegistry
+
+FEATURES = ['Line', 'Station', 'Code', 'DayOfWeek', 'Hour']
+# Feature columns of a day-level model, as trained with --no-hour
+DAY_FEATURES = FEATURES[:-1]
+CATEGORICAL_COLUMNS = ['Line', 'Station', 'Code']
+
+# Rows generated or read per chunk; bounds the working memory of each pass
+CHUNK_ROWS = 1_000_000
+
+# A delay longer than this many minutes counts as a major delay
+MAJOR_DELAY_MINUTES = 5
+
+# Default --sweep grid; None means unlimited depth
+SWEEP_ESTIMATORS = [25, 50, 100]
+SWEEP_MAX_DEPTHS = [None, 8, 12, 16]
+SWEEP_MIN_SAMPLES_LEAF = [1, 5, 20]
+
+# Largest drop from the best held-out accuracy a swept model may have and still be exported
+ACCURACY_TOLERANCE = 0.005
+
+# Rows scored per call when measuring batch latency
+LATENCY_BATCH_ROWS = 4096
+
+# Default --sweep-report; reports/ is git-ignored so sweeps leave the working tree clean
+SWEEP_REPORT = os.path.join("reports", "sweep_results.csv")
+
+# Sample stations and lines are the API's station registry, so sample models know the whole network
+STATION_REGISTRY = StationRegistry.load()
+STATIONS = STATION_REGISTRY.names.tolist()
+LINES = STATION_REGISTRY.line_codes.tolist()
+CODES = ["MUIS", "SEC", "SIG", "PAS", "TRA", "OPE", "MED", "INV"]
+
+@contextlib.contextmanager
+def phase(name, timings):
+    """Time one training phase, printing and recording its duration"""
+    start = time.perf_counter()
+    yield
+    timings[name] = time.perf_counter() - start
+    print(f"  {name}: {timings[name]:.2f}s")
+
+def index_dtype(size):
+    """Smallest signed integer dtype that can index `size` categories"""
+    return np.min_scalar_type(-max(size, 1))
+
+
+def create_sample_data(n_samples=1000, seed=42, chunk_rows=CHUNK_ROWS):
+    """Create sample training data based on TTC patterns
+
+    Rows are generated a chunk at a time with vectorized NumPy, and the
+    categorical columns are pandas Categoricals, so tens of millions of rows
+    fit comfortably in memory.
+    """
+    rng = np.random.default_rng(seed)
+    busy_stations = np.isin(STATIONS, ["UNION STATION", "BLOOR-YONGE", "ST GEORGE"])
+    busy_codes = np.isin(CODES, ["MUIS", "SIG", "TRA"])
+
+    columns = {column: [] for column in FEATURES + ['MajorDelay']}
+    for start in range(0, n_samples, chunk_rows):
+        n = min(chunk_rows, n_samples - start)
+        station = rng.integers(0, len(STATIONS), n, dtype=index_dtype(len(STATIONS)))
+        line = rng.integers(0, len(LINES), n, dtype=index_dtype(len(LINES)))
+        code = rng.integers(0, len(CODES), n, dtype=index_dtype(len(CODES)))
+        day_of_week = rng.integers(0, 7, n, dtype=np.int8)
+        hour = rng.integers(0, 24, n, dtype=np.int8)
+
+        # Create realistic delay patterns: higher delays at busy stations,
+        # for certain codes, on weekdays and in the weekday rush hours
+        rush_hour = (day_of_week < 5) & (((hour >= 7) & (hour < 10)) | ((hour >= 16) & (hour < 19)))
+        delay_prob = (0.1 + 0.1 * busy_stations[station] + 0.15 * busy_codes[code]
+                      + 0.05 * (day_of_week < 5) + 0.1 * rush_hour)
 
-def create_sample_data():
-    """Create sample training data based on TTC patterns"""
-    
-    # Sample stations and lines
-    stations = [
-        "UNION STATION", "BLOOR-YONGE", "ST GEORGE", "SPADINA", "BAY",
-        "SHEPPARD-YONGE", "FINCH", "DOWNSVIEW", "KIPLING", "KENNEDY",
-        "DON MILLS", "SCARBOROUGH CENTRE"
-    ]
-    
-    lines = ["YU", "BD", "SRT"]
-    
-    codes = ["MUIS", "SEC", "SIG", "PAS", "TRA", "OPE", "MED", "INV"]
-    
-    # Generate sample data
-    np.random.seed(42)
-    n_samples = 1000
-    
-    data = []
-    for _ in range(n_samples):
-        station = np.random.choice(stations)
-        line = np.random.choice(lines)
-        code = np.random.choice(codes)
-        day_of_week = np.random.randint(0, 7)
-        
-        # Create realistic delay patterns
-        base_delay_prob = 0.1
-        
-        # Higher delays for certain stations
-        if station in ["UNION STATION", "BLOOR-YONGE", "ST GEORGE"]:
-            base_delay_prob += 0.1
-            
-        # Higher delays for certain codes
-        if code in ["MUIS", "SIG", "TRA"]:
-            base_delay_prob += 0.15
-            
-        # Higher delays on weekdays
-        if day_of_week < 5:
-            base_delay_prob += 0.05
-            
         # Generate delay outcome
-        major_delay = np.random.random() < base_delay_prob
-        
-        data.append({
-            'Line': line,
-            'Station': station,
-            'Code': code,
-            'DayOfWeek': day_of_week,
-            'MajorDelay': int(major_delay)
-        })
-    
+        columns['Line'].append(line)
+        columns['Station'].append(station)
+        columns['Code'].append(code)
+        columns['DayOfWeek'].append(day_of_week)
+        columns['Hour'].append(hour)
+        columns['MajorDelay'].append((rng.random(n) < delay_prob).astype(np.int8))
+
+    values = {column: np.concatenate(chunks) if chunks else np.empty(0, dtype=np.int8)
+              for column, chunks in columns.items()}
+    return pd.DataFrame({
+        'Line': pd.Categorical.from_codes(values['Line'], LINES),
+        'Station': pd.Categorical.from_codes(values['Station'], STATIONS),
+        'Code': pd.Categorical.from_codes(values['Code'], CODES),
+        'DayOfWeek': values['DayOfWeek'],
+        'Hour': values['Hour'],
+        'MajorDelay': values['MajorDelay']
+    })
+
+def read_delay_logs(paths, chunksize=CHUNK_ROWS):
+    """Stream TTC subway delay-log CSVs into a compact training frame
+
+    Each file is read chunksize rows at a time and only the model's columns are
+    kept, as integer codes, so the raw CSV text is never held whole. Memory is
+    still O(rows), since the forest is fitted on individual rows: every kept row
+    costs about 15 bytes while the files are read, and about 6 in the returned
+    frame. Rows without a delay, a parseable date or an HH:MM time are dropped,
+    and MajorDelay is a delay above MAJOR_DELAY_MINUTES minutes.
+    """
+    vocabularies = {column: {} for column in CATEGORICAL_COLUMNS}
+    columns = {column: [] for column in FEATURES + ['MajorDelay']}
+
+    for path in paths:
+        for chunk in pd.read_csv(path, usecols=['Date', 'Time', 'Line', 'Station', 'Code', 'Min Delay'],
+                                 chunksize=chunksize):
+            chunk = chunk.dropna(subset=['Min Delay'])
+            dates = pd.to_datetime(chunk['Date'], errors='coerce')
+            hours = pd.to_numeric(chunk['Time'].astype(str).str.partition(':')[0], errors='coerce')
+            keep = (dates.notna() & hours.between(0, 23)).to_numpy()
+            chunk, dates, hours = chunk[keep], dates[keep], hours[keep]
+
+            for column in CATEGORICAL_COLUMNS:
+                # Factorize the chunk, then map its uniques onto ids shared across chunks
+                codes, uniques = pd.factorize(chunk[column].astype(str))
+                vocabulary = vocabularies[column]
+                ids = np.array([vocabulary.setdefault(value, len(vocabulary)) for value in uniques], dtype=np.int32)
+                columns[column].append(ids[codes])
+            columns['DayOfWeek'].append(dates.dt.dayofweek.to_numpy(dtype=np.int8))
+            columns['Hour'].append(hours.to_numpy(dtype=np.int8))
+            columns['MajorDelay'].append((chunk['Min Delay'].to_numpy() > MAJOR_DELAY_MINUTES).astype(np.int8))
+
+    data = {}
+    for column in CATEGORICAL_COLUMNS:
+        # Categories in sorted order so their codes match LabelEncoder's
+        vocabulary = vocabularies[column]
+        categories = sorted(vocabulary)
+        order = np.empty(len(vocabulary), dtype=np.int32)
+        order[[vocabulary[value] for value in categories]] = np.arange(len(categories), dtype=np.int32)
+        ids = np.concatenate(columns[column]) if columns[column] else np.empty(0, dtype=np.int32)
+        data[column] = pd.Categorical.from_codes(order[ids], categories)
+    for column in ('DayOfWeek', 'Hour', 'MajorDelay'):
+        data[column] = np.concatenate(columns[column]) if columns[column] else np.empty(0, dtype=np.int8)
     return pd.DataFrame(data)
 
-def train_model():
-    """Train the Random Forest model"""
-    
-    print("Creating sample training data...")
-    df = create_sample_data()
-    
-    print("Preparing features...")
-    # Select features
-    features = ['Line', 'Station', 'Code', 'DayOfWeek']
-    X = df[features].copy()
-    y = df['MajorDelay']
-    
-    # Encode categorical variables
+def encode_features(df, features=FEATURES):
+    """Fit a LabelEncoder per categorical column and return (X, y, encoders)
+
+    Categorical columns are encoded by remapping their codes, so no per-row
+    string work is done; other columns go through LabelEncoder as strings.
+    Only the given feature columns are kept in X.
+    """
     encoders = {}
-    for col in ['Line', 'Station', 'Code']:
+    X = pd.DataFrame(index=df.index)
+    for col in CATEGORICAL_COLUMNS:
         encoders[col] = LabelEncoder()
-        X[col] = encoders[col].fit_transform(X[col].astype(str))
-    
-    print("Training Random Forest model...")
-    # Train model
-    model = RandomForestClassifier(n_estimators=100, random_state=42)
-    model.fit(X, y)
-    
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            categories = df[col].cat.categories.astype(str)
+            encoders[col].fit(categories)
+            X[col] = encoders[col].transform(categories)[df[col].cat.codes.to_numpy()]
+        else:
+            X[col] = encoders[col].fit_transform(df[col].astype(str))
+    X['DayOfWeek'] = df['DayOfWeek'].to_numpy()
+    if 'Hour' in features:
+        X['Hour'] = df['Hour'].to_numpy()
+    return X[features], df['MajorDelay'].to_numpy(), encoders
+
+def measure_model(model, X_test, y_test, repeats=200):
+    """Held-out quality and serving cost of a fitted forest
+
+    Single-row latency uses the flattened forest the API scores small batches
+    with; batch latency uses sklearn, which the API uses for large batches.
+    """
+    from tree_ensemble import FlatForest
+
+    proba = model.predict_proba(X_test)[:, 1]
+    blob = pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)
+    start = time.perf_counter()
+    pickle.loads(blob)
+    load_seconds = time.perf_counter() - start
+
+    def latencies(fn, n):
+        seconds = []
+        for _ in range(n):
+            start = time.perf_counter()
+            fn()
+            seconds.append(time.perf_counter() - start)
+        return np.percentile(seconds, [50, 99]) * 1000.0
+
+    rng = np.random.default_rng(0)
+    values = X_test.to_numpy()
+    forest = FlatForest(model)
+    rows = values[rng.integers(0, len(values), repeats)]
+    single = iter(rows)
+    single_p50, single_p99 = latencies(lambda: forest.predict_proba(next(single)[None, :]), repeats)
+    batch = X_test.iloc[rng.integers(0, len(values), LATENCY_BATCH_ROWS)]
+    batch_p50, batch_p99 = latencies(lambda: model.predict_proba(batch), max(5, repeats // 20))
+
+    return {
+        "accuracy": accuracy_score(y_test, model.classes_[(proba >= 0.5).astype(int)]),
+        "auc": roc_auc_score(y_test, proba) if len(np.unique(y_test)) > 1 else float("nan"),
+        "size_bytes": len(blob),
+        "nodes": forest.node_count,
+        "load_ms": load_seconds * 1000.0,
+        "single_p50_ms": single_p50,
+        "single_p99_ms": single_p99,
+        "batch_p50_ms": batch_p50,
+        "batch_p99_ms": batch_p99
+    }
+
+def sweep_models(X, y, n_jobs=-1, estimators=SWEEP_ESTIMATORS, max_depths=SWEEP_MAX_DEPTHS,
+                 min_samples_leaf=SWEEP_MIN_SAMPLES_LEAF, tolerance=ACCURACY_TOLERANCE):
+    """Fit every grid setting on a training split and measure it on a held-out split
+
+    Returns (results, model): one result dict per setting, in ascending size
+    order, and the smallest model whose accuracy is within tolerance of the best.
+    Results on the size/accuracy Pareto front are flagged with "pareto".
+    """
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+
+    results, models = [], []
+    for n_estimators, max_depth, min_leaf in itertools.product(estimators, max_depths, min_samples_leaf):
+        model = RandomForestClassifier(n_estimators=n_estimators, max_depth=max_depth, min_samples_leaf=min_leaf,
+                                       random_state=42, n_jobs=n_jobs)
+        model.fit(X_train, y_train)
+        model.n_jobs = None
+        result = {"n_estimators": n_estimators, "max_depth": max_depth, "min_samples_leaf": min_leaf}
+        result.update(measure_model(model, X_test, y_test))
+        print(f"  n_estimators={n_estimators:<4} max_depth={str(max_depth):<5} min_samples_leaf={min_leaf:<3} "
+              f"accuracy {result['accuracy']:.4f}  auc {result['auc']:.4f}  {result['size_bytes'] / 1e6:7.3f} MB  "
+              f"single p50 {result['single_p50_ms']:.3f} ms")
+        results.append(result)
+        models.append(model)
+
+    order = sorted(range(len(results)), key=lambda i: (results[i]["size_bytes"], -results[i]["accuracy"]))
+    results, models = [results[i] for i in order], [models[i] for i in order]
+
+    best_accuracy = max(result["accuracy"] for result in results)
+    chosen = None
+    most_accurate = -1.0
+    for i, result in enumerate(results):
+        # Sorted by size, so a setting is on the front if it beats every smaller one
+        result["pareto"] = result["accuracy"] > most_accurate
+        most_accurate = max(most_accurate, result["accuracy"])
+        result["selected"] = False
+        if chosen is None and result["accuracy"] >= best_accuracy - tolerance:
+            chosen = i
+    results[chosen]["selected"] = True
+    return results, models[chosen]
+
+def write_sweep_report(results, path):
+    """Write sweep results as CSV, creating the file's directory if needed"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
+
+def publish_artifacts(model_dir="models"):
+    """Copy the saved artifacts into a new model_dir/<UTC timestamp>/ version for the API to hot-reload"""
+    version = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    staging = os.path.join(model_dir, f".{version}.tmp")
+    os.makedirs(staging, exist_ok=True)
+    for path in ("random_forest_model_new_task.pkl", "label_encoders_new_task.pkl"):
+        shutil.copy2(path, os.path.join(staging, path))
+    # Rename the complete directory into place so a watching API never sees half a version
+    os.rename(staging, os.path.join(model_dir, version))
+    return version
+
+def train_model(csv_paths=None, n_samples=1000, n_jobs=-1, chunksize=CHUNK_ROWS, publish=False, model_dir="models",
+                sweep=False, sweep_options=None, sweep_report=SWEEP_REPORT, hourly=True):
+    """Train the Random Forest model, or with sweep, export the smallest one within the accuracy tolerance
+
+    Without hourly, the Hour feature is left out and the model is day-level,
+    like models trained before Hour was added.
+    """
+    timings = {}
+    features = FEATURES if hourly else DAY_FEATURES
+
+    if csv_paths:
+        print(f"Reading delay logs from {len(csv_paths)} file(s)...")
+        with phase("ingest", timings):
+            df = read_delay_logs(csv_paths, chunksize)
+    else:
+        print("Creating sample training data...")
+        with phase("generate", timings):
+            df = create_sample_data(n_samples, chunk_rows=chunksize)
+
+    print("Preparing features...")
+    with phase("encode", timings):
+        X, y, encoders = encode_features(df, features)
+    del df
+
+    if sweep:
+        print(f"Sweeping forest settings on {len(X)} rows (80% train, 20% held out)...")
+        with phase("sweep", timings):
+            results, model = sweep_models(X, y, n_jobs, **(sweep_options or {}))
+        write_sweep_report(results, sweep_report)
+        selected = next(result for result in results if result["selected"])
+        print(f"Sweep results written to: {sweep_report}")
+        print(f"Selected n_estimators={selected['n_estimators']}, max_depth={selected['max_depth']}, "
+              f"min_samples_leaf={selected['min_samples_leaf']}: accuracy {selected['accuracy']:.4f}, "
+              f"{selected['size_bytes'] / 1e6:.3f} MB, single-row p50 {selected['single_p50_ms']:.3f} ms")
+    else:
+        print(f"Training Random Forest model on {len(X)} rows (n_jobs={n_jobs})...")
+        with phase("fit", timings):
+            model = RandomForestClassifier(n_estimators=100, random_state=42, n_jobs=n_jobs)
+            model.fit(X, y)
+    # The API scores small batches per request; parallel predict would only add thread overhead
+    model.n_jobs = None
+
     print("Saving model and encoders...")
-    # Save model
-    with open("random_forest_model_new_task.pkl", "wb") as f:
-        pickle.dump(model, f)
-    
-    # Save encoders
-    with open("label_encoders_new_task.pkl", "wb") as f:
-        pickle.dump(encoders, f)
-    
+    with phase("serialize", timings):
+        # Save model
+        with open("random_forest_model_new_task.pkl", "wb") as f:
+            pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        # Save encoders
+        with open("label_encoders_new_task.pkl", "wb") as f:
+            pickle.dump(encoders, f, protocol=pickle.HIGHEST_PROTOCOL)
+
     print("Model training complete!")
     print(f"Model saved to: random_forest_model_new_task.pkl")
     print(f"Encoders saved to: label_encoders_new_task.pkl")
-    
+
     # Print some statistics
     print(f"\nTraining data shape: {X.shape}")
     print(f"Major delay rate: {y.mean():.2%}")
     print(f"Feature importance:")
     for feature, importance in zip(features, model.feature_importances_):
         print(f"  {feature}: {importance:.3f}")
+    print("Timings: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items())
+          + f", total {sum(timings.values()):.2f}s")
+
+    if publish:
+        version = publish_artifacts(model_dir)
+        print(f"\nPublished model version {version} to {os.path.join(model_dir, version)}")
 
 if __name__ == "__main__":
-    train_model()
+    parser = argparse.ArgumentParser(description="Train the TTC delay prediction model")
+    parser.add_argument("--csv", nargs="+", metavar="PATH",
+                        help="TTC subway delay-log CSV files to train on (default: generated sample data)")
+    parser.add_argument("--samples", type=int, default=1000,
+                        help="rows of sample data to generate when no CSV is given (default: 1000)")
+    parser.add_argument("--chunksize", type=int, default=CHUNK_ROWS,
+                        help=f"rows generated or read per chunk (default: {CHUNK_ROWS})")
+    parser.add_argument("--n-jobs", type=int, default=-1,
+                        help="parallel jobs for fitting the forest; -1 uses every core (default: -1)")
+    parser.add_argument("--sweep", action="store_true",
+                        help="fit a grid of forest settings and export the smallest within --accuracy-tolerance of the best")
+    parser.add_argument("--sweep-estimators", type=int, nargs="+", default=SWEEP_ESTIMATORS, metavar="N",
+                        help=f"n_estimators values to sweep (default: {SWEEP_ESTIMATORS})")
+    parser.add_argument("--sweep-max-depths", type=int, nargs="+", default=[0 if d is None else d for d in SWEEP_MAX_DEPTHS],
+                        metavar="N", help="max_depth values to sweep; 0 means unlimited (default: 0 8 12 16)")
+    parser.add_argument("--sweep-min-samples-leaf", type=int, nargs="+", default=SWEEP_MIN_SAMPLES_LEAF, metavar="N",
+                        help=f"min_samples_leaf values to sweep (default: {SWEEP_MIN_SAMPLES_LEAF})")
+    parser.add_argument("--accuracy-tolerance", type=float, default=ACCURACY_TOLERANCE,
+                        help=f"largest held-out accuracy drop from the best setting to accept (default: {ACCURACY_TOLERANCE})")
+    parser.add_argument("--sweep-report", default=SWEEP_REPORT,
+                        help=f"CSV file for the sweep measurements (default: {SWEEP_REPORT})")
+    parser.add_argument("--no-hour", action="store_true",
+                        help="leave out the Hour feature and train a day-level model")
+    parser.add_argument("--publish", action="store_true",
+                        help="also publish the artifacts as a new version for a running API to hot-reload")
+    parser.add_argument("--model-dir", default=os.environ.get("TTC_MODEL_DIR", "models"),
+                        help="directory of published model versions (default: models)")
+    args = parser.parse_args()
+    sweep_options = {
+        "estimators": args.sweep_estimators,
+        "max_depths": [depth or None for depth in args.sweep_max_depths],
+        "min_samples_leaf": args.sweep_min_samples_leaf,
+        "tolerance": args.accuracy_tolerance
+    }
+    train_model(csv_paths=args.csv, n_samples=args.samples, n_jobs=args.n_jobs, chunksize=args.chunksize,
+                publish=args.publish, model_dir=args.model_dir, sweep=args.sweep, sweep_options=sweep_options,
+                sweep_report=args.sweep_report, hourly=not args.no_hour)
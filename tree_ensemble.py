@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Flattened NumPy evaluator for the TTC delay RandomForestClassifier
+All trees are packed into shared node arrays and traversed in lock-step for a
+batch of rows, avoiding pandas and sklearn's per-call input validation
+
+Run directly to check parity against the trained model and benchmark both:
+    python tree_ensemble.py
+"""
+
+import os
+import pickle
+import time
+from typing import Optional, Tuple
+import numpy as np
+
+# Rows evaluated per traversal pass; bounds the (rows x trees) working arrays
+CHUNK_ROWS = 4096
+
+# Above roughly this many rows sklearn's compiled traversal overtakes the NumPy one
+MAX_FLAT_ROWS = 512
+
+# Rows compared against sklearn when a forest is compiled at model load
+PARITY_ROWS = 4096
+
+# Arrays written by FlatForest.save(), one .npy file each
+FOREST_ARRAYS = ["classes_", "roots", "feature", "threshold", "left", "right", "value", "internal"]
+
+
+class FlatForest:
+    """RandomForestClassifier compiled to flat feature/threshold/left/right/value arrays"""
+
+    def __init__(self, model):
+        trees = [estimator.tree_ for estimator in model.estimators_]
+        sizes = np.array([tree.node_count for tree in trees])
+        offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+
+        feature, threshold, left, right, value = [], [], [], [], []
+        for tree, offset in zip(trees, offsets):
+            nodes = np.arange(tree.node_count)
+            is_leaf = tree.children_left == -1
+            feature.append(np.where(is_leaf, 0, tree.feature))
+            threshold.append(np.where(is_leaf, np.inf, tree.threshold))
+            left.append(np.where(is_leaf, nodes, tree.children_left) + offset)
+            right.append(np.where(is_leaf, nodes, tree.children_right) + offset)
+            counts = tree.value[:, 0, :]
+            value.append(counts / counts.sum(axis=1, keepdims=True))
+
+        self.classes_ = model.classes_
+        self.n_features = int(model.n_features_in_)
+        self.roots = offsets.astype(np.intp)
+        self.feature = np.concatenate(feature).astype(np.intp)
+        self.threshold = np.concatenate(threshold).astype(np.float64)
+        self.left = np.concatenate(left).astype(np.intp)
+        self.right = np.concatenate(right).astype(np.intp)
+        self.value = np.concatenate(value).astype(np.float64)
+        self.internal = self.left != np.arange(self.node_count)
+        self.depth = max(tree.max_depth for tree in trees)
+
+    def save(self, directory: str):
+        """Write the node arrays to directory as .npy files, for load() to memory-map"""
+        os.makedirs(directory, exist_ok=True)
+        for name in FOREST_ARRAYS:
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+        np.save(os.path.join(directory, "shape.npy"), np.array([self.n_features, self.depth], dtype=np.int64))
+
+    @classmethod
+    def load(cls, directory: str, mmap_mode: Optional[str] = "r") -> "FlatForest":
+        """Forest whose arrays are read from a save()d directory; memory-mapped read-only by default,
+        so every process loading the same directory shares one copy in the page cache"""
+        forest = cls.__new__(cls)
+        for name in FOREST_ARRAYS:
+            setattr(forest, name, np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode))
+        forest.n_features, forest.depth = np.load(os.path.join(directory, "shape.npy")).tolist()
+        return forest
+
+    @property
+    def node_count(self) -> int:
+        """Total nodes across all trees"""
+        return int(self.feature.size)
+
+    def predict_proba(self, X) -> np.ndarray:
+        """Class probabilities averaged over all trees, matching RandomForestClassifier.predict_proba"""
+        # sklearn compares float32 features against float64 thresholds
+        X = np.asarray(X, dtype=np.float32)
+        return np.vstack([self._predict_chunk(X[i:i + CHUNK_ROWS]) for i in range(0, len(X), CHUNK_ROWS)]) \
+            if len(X) else np.empty((0, len(self.classes_)))
+
+    def _predict_chunk(self, X: np.ndarray) -> np.ndarray:
+        n_rows, n_trees = len(X), len(self.roots)
+        # One cursor per (row, tree) pair; only cursors still on a split node are advanced
+        node = np.tile(self.roots, n_rows)
+        offset = np.repeat(np.arange(n_rows) * self.n_features, n_trees)
+        values = X.ravel()
+        active = np.flatnonzero(self.internal[node])
+        while active.size:
+            current = node[active]
+            go_left = values[offset[active] + self.feature[current]] <= self.threshold[current]
+            following = np.where(go_left, self.left[current], self.right[current])
+            node[active] = following
+            active = active[self.internal[following]]
+        return self.value[node].reshape(n_rows, n_trees, -1).mean(axis=1)
+
+    def predict(self, X) -> np.ndarray:
+        """Most likely class per row"""
+        return self.classes_[self.predict_proba(X).argmax(axis=1)]
+
+
+def check_parity(model, forest: FlatForest, X: np.ndarray) -> float:
+    """Largest absolute probability difference between the flat forest and sklearn"""
+    import pandas as pd
+    expected = model.predict_proba(pd.DataFrame(X, columns=list(model.feature_names_in_)))
+    return float(np.abs(forest.predict_proba(X) - expected).max()) if len(X) else 0.0
+
+
+def _time_per_call(fn, repeats: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def benchmark(model, forest: FlatForest, X: np.ndarray, repeats: int = 50) -> Tuple[float, float]:
+    """Seconds per predict_proba call for (sklearn, flat forest) on X"""
+    import pandas as pd
+    columns = list(model.feature_names_in_)
+    sklearn_seconds = _time_per_call(lambda: model.predict_proba(pd.DataFrame(X, columns=columns)), repeats)
+    flat_seconds = _time_per_call(lambda: forest.predict_proba(X), repeats)
+    return sklearn_seconds, flat_seconds
+
+
+if __name__ == "__main__":
+    with open("random_forest_model_new_task.pkl", "rb") as f:
+        model = pickle.load(f)
+    with open("label_encoders_new_task.pkl", "rb") as f:
+        encoders = pickle.load(f)
+
+    forest = FlatForest(model)
+    print(f"Compiled {len(forest.roots)} trees, {forest.node_count} nodes, depth {forest.depth}")
+
+    # Every encoded input the API can see, plus out-of-range days
+    sizes = [len(encoders['Line'].classes_), len(encoders['Station'].classes_), len(encoders['Code'].classes_), 14]
+    grid = np.indices(sizes).reshape(len(sizes), -1).T
+    if model.n_features_in_ > len(sizes):
+        # Hourly model: every hour of each of those days
+        from probability_table import with_hours
+        grid = with_hours(grid)
+    difference = check_parity(model, forest, grid)
+    print(f"Parity over {len(grid)} rows: max |difference| = {difference:.2e}")
+    if difference > 1e-9:
+        raise SystemExit("Flat forest does not match sklearn predict_proba")
+
+    rng = np.random.default_rng(42)
+    for rows in (1, 16, 256, MAX_FLAT_ROWS, 4096):
+        X = grid[rng.integers(0, len(grid), rows)]
+        sklearn_seconds, flat_seconds = benchmark(model, forest, X, repeats=200 if rows < 4096 else 20)
+        print(f"{rows:>5} rows: sklearn {sklearn_seconds * 1e6:9.1f} us   flat {flat_seconds * 1e6:9.1f} us   "
+              f"speedup {sklearn_seconds / flat_seconds:5.1f}x")